@@ -0,0 +1,307 @@
+from flask import Flask, request
+import logging
+import os
+import random
+import sys
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import idempotency
+import metrics
+import structured_logging
+import twiml_cache
+
+# One app for every salon. The tenant of a webhook is resolved from its route
+# (/bot, /bot2 ... /bot6 as before), a /bot/<company_id> path parameter or the
+# Twilio To number, each through a dict built at import. Tenant content is
+# built once here and shared, so one worker pool serves all salons.
+
+# Configure logging
+structured_logging.configure('chatbot_tenants.log', level=logging.INFO)
+
+app = Flask(__name__)
+metrics.install(app)
+structured_logging.install(app)
+
+COMMON_RESPONSES = {
+    'hello': ["Hello! How can I assist you today?", "Hi there! How can I help you?", "Hey! What can I do for you?"],
+    'hi': ["Hello! How can I assist you today?", "Hi there! How can I help you?", "Hey! What can I do for you?"],
+    'bye': ["Goodbye! Have a great day!", "See you later!", "Bye! Take care!"],
+    'thank you': ["You're welcome!", "Happy to help!", "No problem at all!"],
+    'thanks': ["You're welcome!", "Happy to help!", "No problem at all!"],
+    'how are you': ["I'm just a bot, but I'm here to help you!", "I'm doing great! How about you?", "I'm here and ready to assist you!"]
+}
+
+# The Den Haag bot has the longer, emoji version of the common responses.
+DETAILED_COMMON_RESPONSES = {
+    'hello': [
+        "Hello! How can I assist you today? 😊",
+        "Hi there! How can I help you? 🤔",
+        "Hey! What can I do for you? 🙌",
+        "Greetings! How may I be of service? 👋",
+        "Hello! What can I do for you today? 😃"
+    ],
+    'hi': [
+        "Hello! How can I assist you today? 😊",
+        "Hi there! How can I help you? 🤔",
+        "Hey! What can I do for you? 🙌",
+        "Greetings! How may I be of service? 👋",
+        "Hello! What can I do for you today? 😃"
+    ],
+    'bye': [
+        "Goodbye! Have a great day! 👋",
+        "See you later! 👋",
+        "Bye! Take care! ✨",
+        "Farewell! Wishing you the best! 🌟",
+        "Catch you later! 😊"
+    ],
+    'thank you': [
+        "You're welcome! 😃",
+        "Happy to help! 😊",
+        "No problem at all! 👍",
+        "You're welcome! If you need anything else, just ask! 🙏",
+        "Glad I could assist! 😄"
+    ],
+    'thanks': [
+        "You're welcome! 😃",
+        "Happy to help! 😊",
+        "No problem at all! 👍",
+        "You're welcome! If you need anything else, just ask! 🙏",
+        "Glad I could assist! 😄"
+    ],
+    'how are you': [
+        "I'm just a bot, but I'm here to help you! 🤖",
+        "I'm doing great! How about you? 😄",
+        "I'm here and ready to assist you! 💪",
+        "I'm functioning well, thanks for asking! 😊",
+        "I'm at your service! How can I assist? 🤗"
+    ],
+    'menu': [
+        "Here's the menu! What would you like to do? 📜 1: About us 🏠, 2:Prices 💲, 3:Online booking 📅, 4:Cancel appointment ❌",
+        "Here are your options. How can I assist you today? 📋 1: About us 🏠, 2:Prices 💲, 3:Online booking 📅, 4:Cancel appointment ❌",
+        "Check out our menu below and choose an option! 🗒️ 1: About us 🏠, 2:Prices 💲, 3:Online booking 📅, 4:Cancel appointment ❌",
+        "Explore the menu and let me know what you'd like! 📑 1: About us 🏠, 2:Prices 💲, 3:Online booking 📅, 4:Cancel appointment ❌",
+        "The menu is ready for you! Choose an option. 📝 1: About us 🏠, 2:Prices 💲, 3:Online booking 📅, 4:Cancel appointment ❌"
+    ],
+    'back': [
+        "Returning to the main menu. 🔙",
+        "Going back to the main menu. 🏠",
+        "Here is the main menu again. 🔄",
+        "Navigating back to the main menu. 🏡",
+        "Returning to the main menu options. 📋"
+    ],
+    'default': [
+        "I'm not sure what you mean. Could you please clarify? 🤔",
+        "Sorry, I didn't get that. Can you please choose an option from the menu? 🙄",
+        "Oops! It looks like your message is unclear. Please try again. 😕",
+        "I didn't understand that. Please select an option from the menu. 🤷",
+        "That option is not available. Please choose from the menu. 🙁"
+    ]
+}
+
+OPTIONS = {
+    '1': "About us 🏠",
+    '2': "Prices 💲",
+    '3': "Online booking 📅",
+    '4': "Cancel appointment ❌"
+}
+
+API_GET_ENDPOINT = "https://external-api.example.com/getDetails"  # Replace with your actual API GET endpoint
+API_POST_ENDPOINT = "https://external-api.example.com/postDetails"  # Replace with your actual API POST endpoint
+
+# Shared by every tenant that fetches details from the external API.
+API_SESSION = requests.Session()
+
+
+def static_tenant(company_id, name, route):
+    return {
+        'id': company_id,
+        'name': name,
+        'route': route,
+        'flow': 'static',
+        'welcome_menu': (
+            "Hello 👋\n"
+            f"Welcome to {name}.\n"
+            "1️⃣ About us\n"
+            "2️⃣ Prices\n"
+            "3️⃣ Online booking 📅\n"
+            "4️⃣ Cancel appointment ❌\n"
+            "🔙 Back to main menu"
+        ),
+        'company_data': {
+            '1': f"{name} - About us: We provide exceptional beauty services.",
+            '2': f"{name} - Prices: Visit our website for detailed pricing information.",
+            '3': f"{name} - Online booking: You can book an appointment online at our website.",
+            '4': f"{name} - Cancel appointment: Please contact us to cancel your appointment."
+        },
+        'common_responses': COMMON_RESPONSES,
+    }
+
+
+def details_tenant(company_id, name, route):
+    return {
+        'id': company_id,
+        'name': name,
+        'route': route,
+        'flow': 'details',
+        'welcome_menu': (
+            f"Hello 👋\n"
+            f"Welcome to {name}.\n\n"
+            f"Please choose an option below:\n"
+            f"1️⃣ About us 🏠\n"
+            f"2️⃣ Prices 💲\n"
+            f"3️⃣ Online booking 📅\n"
+            f"4️⃣ Cancel appointment ❌\n"
+            f"0️⃣ Back to main menu 🔙"
+        ),
+        'company_data': {
+            '1': f"{name} - About us 🏠: We provide exceptional beauty services.",
+            '2': f"{name} - Prices 💲: Visit our website for detailed pricing information.",
+            '3': f"{name} - Online booking 📅: You can book an appointment online at our website.",
+            '4': f"{name} - Cancel appointment ❌: Please contact us to cancel your appointment."
+        },
+        'common_responses': DETAILED_COMMON_RESPONSES,
+    }
+
+
+TENANTS = {tenant['id']: tenant for tenant in [
+    details_tenant(10, 'Ezoncs Beauty Salon Den Haag', '/bot'),
+    static_tenant(14, 'Ezoncs Beauty Salon Rotterdam', '/bot2'),
+    static_tenant(17, 'Evolve Clinic Den Haag', '/bot3'),
+    static_tenant(19, 'Ezoncs Beauty Salon Amsterdam', '/bot4'),
+    static_tenant(20, 'Ezoncs Utrecht', '/bot5'),
+    static_tenant(21, 'Evolve Rotterdam', '/bot6'),
+]}
+
+TENANTS_BY_ROUTE = {tenant['route']: tenant for tenant in TENANTS.values()}
+
+
+def parse_tenant_numbers(value):
+    # TENANT_NUMBERS="whatsapp:+3170...=10,whatsapp:+3110...=14"
+    numbers = {}
+    for item in value.split(','):
+        number, _, company_id = item.strip().rpartition('=')
+        if number and company_id.isdigit() and int(company_id) in TENANTS:
+            numbers[number] = TENANTS[int(company_id)]
+        elif item.strip():
+            logging.warning("Ignoring TENANT_NUMBERS entry %r", item)
+    return numbers
+
+
+TENANTS_BY_NUMBER = parse_tenant_numbers(os.environ.get('TENANT_NUMBERS', ''))
+
+# Every tenant's fixed replies are serialized once, at import.
+TWIML = twiml_cache.TwiMLCache()
+TWIML.prerender([text for tenant in TENANTS.values() for text in
+                 [tenant['welcome_menu']]
+                 + list(tenant['company_data'].values())
+                 + [reply for replies in tenant['common_responses'].values() for reply in replies]])
+
+
+def resolve_tenant(company_id=None):
+    if company_id is not None:
+        return TENANTS.get(company_id)
+    tenant = TENANTS_BY_ROUTE.get(request.path)
+    if tenant is None:
+        tenant = TENANTS_BY_NUMBER.get(request.values.get('To', ''))
+    return tenant
+
+
+def get_company_details(tenant, option_id):
+    try:
+        response = API_SESSION.get(API_GET_ENDPOINT, params={
+            'company_id': tenant['id'],
+            'option_id': option_id
+        })
+        response.raise_for_status()
+        data = response.json()
+        return data.get('details', tenant['company_data'][option_id])
+    except requests.exceptions.RequestException as e:
+        logging.error("Failed to fetch details: %s", e)
+        return tenant['company_data'][option_id]
+
+
+def post_company_details(tenant, option_id, option_name, details):
+    try:
+        response = API_SESSION.post(API_POST_ENDPOINT, json={
+            'company_id': tenant['id'],
+            'company_name': tenant['name'],
+            'option_id': option_id,
+            'option_name': option_name,
+            'details': details
+        })
+        response.raise_for_status()
+        return response.status_code == 200
+    except requests.exceptions.RequestException as e:
+        logging.error("Failed to post details: %s", e)
+        return False
+
+
+def static_reply(tenant, incoming_msg):
+    if incoming_msg in tenant['common_responses']:
+        response = random.choice(tenant['common_responses'][incoming_msg])
+        logging.info("Responding with common response: %s", response)
+        return response
+    if incoming_msg in tenant['company_data']:
+        response = tenant['company_data'][incoming_msg]
+        logging.info("Responding with company data: %s", response)
+        return response
+    logging.info("Invalid selection, sending welcome menu.")
+    return tenant['welcome_menu']
+
+
+def details_reply(tenant, incoming_msg):
+    if incoming_msg in tenant['common_responses']:
+        response = random.choice(tenant['common_responses'][incoming_msg])
+        logging.info("Responding with common response: %s", response)
+        return response
+    if incoming_msg == '0':
+        logging.info("Returning to main menu.")
+        return tenant['welcome_menu']
+    if incoming_msg in OPTIONS:
+        option_id = incoming_msg
+        option_name = OPTIONS[option_id]
+        details = get_company_details(tenant, option_id)
+
+        post_status = post_company_details(tenant, option_id, option_name, details)
+        if post_status:
+            logging.info("Successfully posted details for option %s to external API.", option_id)
+        else:
+            logging.error("Failed to post details for option %s to external API.", option_id)
+
+        response = f"{tenant['name']} - {option_name}: {details}\n\nPress 0 to go back to the main menu 🔙."
+        logging.info("Responding with details: %s", response)
+        return response
+    logging.info("Invalid selection, sending default response.")
+    return random.choice(tenant['common_responses']['default'])
+
+
+FLOWS = {
+    'static': static_reply,
+    'details': details_reply,
+}
+
+
+@idempotency.once
+def bot(company_id=None):
+    tenant = resolve_tenant(company_id)
+    if tenant is None:
+        logging.warning("No tenant for %s (To: %s)", request.path, request.values.get('To', ''))
+        return "Unknown tenant", 404
+    metrics.tag(tenant=str(tenant['id']))
+
+    incoming_msg = request.values.get('Body', '').strip().lower()
+    session_id = request.values.get('WaId', 'default_session')
+    logging.info("[%s] Incoming message: %s from session: %s", tenant['id'], incoming_msg, session_id)
+
+    return TWIML.reply(FLOWS[tenant['flow']](tenant, incoming_msg))
+
+
+for tenant in TENANTS.values():
+    app.add_url_rule(tenant['route'], view_func=bot, methods=['POST'], endpoint=f"bot_{tenant['id']}")
+app.add_url_rule('/bot/<int:company_id>', view_func=bot, methods=['POST'])
+# Shared webhook for numbers listed in TENANT_NUMBERS.
+app.add_url_rule('/whatsapp', view_func=bot, methods=['POST'])
+
+if __name__ == '__main__':
+    app.run(debug=True)
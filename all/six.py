@@ -1,61 +1,6 @@
-from flask import Flask, request, jsonify
-from twilio.twiml.messaging_response import MessagingResponse
-import logging
-import random
-
-# Configure logging
-logging.basicConfig(filename='chatbot6.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-
-app = Flask(__name__)
-
-WELCOME_MENU = (
-    "Hello 👋\n"
-    "Welcome to Evolve Rotterdam.\n"
-    "1️⃣ About us\n"
-    "2️⃣ Prices\n"
-    "3️⃣ Online booking 📅\n"
-    "4️⃣ Cancel appointment ❌\n"
-    "🔙 Back to main menu"
-)
-
-COMPANY_DATA = {
-    '1': "Evolve Rotterdam - About us: We provide exceptional beauty services.",
-    '2': "Evolve Rotterdam - Prices: Visit our website for detailed pricing information.",
-    '3': "Evolve Rotterdam - Online booking: You can book an appointment online at our website.",
-    '4': "Evolve Rotterdam - Cancel appointment: Please contact us to cancel your appointment."
-}
-
-COMMON_RESPONSES = {
-    'hello': ["Hello! How can I assist you today?", "Hi there! How can I help you?", "Hey! What can I do for you?"],
-    'hi': ["Hello! How can I assist you today?", "Hi there! How can I help you?", "Hey! What can I do for you?"],
-    'bye': ["Goodbye! Have a great day!", "See you later!", "Bye! Take care!"],
-    'thank you': ["You're welcome!", "Happy to help!", "No problem at all!"],
-    'thanks': ["You're welcome!", "Happy to help!", "No problem at all!"],
-    'how are you': ["I'm just a bot, but I'm here to help you!", "I'm doing great! How about you?", "I'm here and ready to assist you!"]
-}
-
-@app.route('/bot6', methods=['POST'])
-def bot6():
-    incoming_msg = request.values.get('Body', '').strip().lower()
-    session_id = request.values.get('WaId', 'default_session')
-    logging.info(f"Incoming message: {incoming_msg} from session: {session_id}")
-
-    resp = MessagingResponse()
-    msg = resp.message()
-
-    if incoming_msg in COMMON_RESPONSES:
-        response = random.choice(COMMON_RESPONSES[incoming_msg])
-        logging.info(f"Responding with common response: {response}")
-        msg.body(response)
-    elif incoming_msg in COMPANY_DATA:
-        response = COMPANY_DATA[incoming_msg]
-        logging.info(f"Responding with company data: {response}")
-        msg.body(response)
-    else:
-        logging.info("Invalid selection, sending welcome menu.")
-        msg.body(WELCOME_MENU)
-
-    return str(resp)
+# Evolve Rotterdam (/bot6) is served by the multi-tenant app in multitenant.py.
+# Kept so existing deployments that start all/six.py keep working.
+from multitenant import app
 
 if __name__ == '__main__':
     app.run(debug=True)
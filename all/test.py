@@ -17,16 +17,16 @@ def test_connection():
         response = requests.post(URL, json=data)
         response.raise_for_status()
         response_json = response.json()
-        logging.info(f"API response status: {response.status_code}, response data: {response_json}")
+        logging.info("API response status: %s, response data: %s", response.status_code, response_json)
         return response_json
     except requests.exceptions.HTTPError as http_err:
-        logging.error(f"HTTP error occurred: {http_err}")
+        logging.error("HTTP error occurred: %s", http_err)
     except requests.exceptions.ConnectionError as conn_err:
-        logging.error(f"Connection error occurred: {conn_err}")
+        logging.error("Connection error occurred: %s", conn_err)
     except requests.exceptions.Timeout as timeout_err:
-        logging.error(f"Timeout error occurred: {timeout_err}")
+        logging.error("Timeout error occurred: %s", timeout_err)
     except requests.exceptions.RequestException as req_err:
-        logging.error(f"Request error occurred: {req_err}")
+        logging.error("Request error occurred: %s", req_err)
 
 if __name__ == '__main__':
     test_connection()
@@ -1,12 +1,21 @@
 from flask import Flask, request, jsonify
 from twilio.twiml.messaging_response import MessagingResponse
 import logging
+import os
 import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import metrics
+import structured_logging
+import session_store
 
 # Configure logging
-logging.basicConfig(filename='chatbot.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+structured_logging.configure('chatbot.log', level=logging.INFO)
 
 app = Flask(__name__)
+metrics.install(app)
+structured_logging.install(app)
 
 # Constants
 COMPANY_DETAILS = {
@@ -98,17 +107,17 @@ COMMON_RESPONSES = {
 def bot():
     incoming_msg = request.values.get('Body', '').strip().lower()
     session_id = request.values.get('WaId', 'default_session')
-    logging.info(f"Incoming message: {incoming_msg} from session: {session_id}")
+    logging.info("Incoming message: %s from session: %s", incoming_msg, session_id)
 
     resp = MessagingResponse()
     msg = resp.message()
 
     session_data = get_session_data(session_id)
-    logging.info(f"Session data: {session_data}")
+    logging.info("Session data: %s", session_data)
 
     if incoming_msg in COMMON_RESPONSES:
         response = random.choice(COMMON_RESPONSES[incoming_msg])
-        logging.info(f"Responding with common response: {response}")
+        logging.info("Responding with common response: %s", response)
         msg.body(response)
     elif incoming_msg == 'main menu':
         session_data.pop('company_selected', None)
@@ -122,7 +131,7 @@ def bot():
             session_data['company_selected'] = incoming_msg
             save_session_data(session_id, session_data)
             response = COMPANY_MENUS[incoming_msg]
-            logging.info(f"Company selected: {incoming_msg}, responding with menu: {response}")
+            logging.info("Company selected: %s, responding with menu: %s", incoming_msg, response)
             msg.body(response)
         else:
             logging.info("Invalid company selection, sending welcome menu.")
@@ -135,12 +144,12 @@ def handle_company_menu_selection(incoming_msg, session_data, msg):
     company_name = COMPANY_DETAILS[company_selected]['name']
     if incoming_msg == 'back':
         response = COMPANY_MENUS[company_selected]
-        logging.info(f"Returning to company menu: {response}")
+        logging.info("Returning to company menu: %s", response)
         msg.body(response)
     elif incoming_msg in ['1', '2', '3', '4']:
         option_name = {'1': 'About us', '2': 'Prices', '3': 'Online booking', '4': 'Cancel appointment'}[incoming_msg]
         response = fetch_company_details(COMPANY_DETAILS[company_selected]['id'], incoming_msg, company_name, option_name)
-        logging.info(f"Responding with company response: {response}")
+        logging.info("Responding with company response: %s", response)
         msg.body(response)
     else:
         response = "Invalid option. Please use the menu options provided:\n" + COMPANY_MENUS[company_selected]
@@ -166,13 +175,14 @@ def company_details():
 
     return jsonify(response)
 
+SESSIONS = session_store.create_store()
+metrics.gauge('bot_active_sessions', SESSIONS.count, 'Users with an unexpired session.', store='session')
+
 def get_session_data(session_id):
-    if not hasattr(get_session_data, 'sessions'):
-        get_session_data.sessions = {}
-    return get_session_data.sessions.setdefault(session_id, {})
+    return SESSIONS.get(session_id)
 
 def save_session_data(session_id, data):
-    get_session_data.sessions[session_id] = data
+    SESSIONS.save(session_id, data)
 
 if __name__ == '__main__':
     app.run(debug=True)
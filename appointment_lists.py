@@ -0,0 +1,40 @@
+import lookup_cache
+
+# The SMS bots' cancel flow: a user asks for their appointments on a day
+# ("YYYY-MM-DD email"), then sends the AppointmentID to cancel. The list is
+# cached in lookup_cache.appointments_cache. The conversation remembers which
+# list the user is choosing from, and the ID they send is checked against
+# that list before the cancellation is queued (cancel_jobs).
+
+
+def appointments_key(company_id, date, email):
+    return (company_id, email, date)
+
+
+def fetch_appointments(company_id, date, email, loader):
+    # loader makes the bot's GetAppointmentsWRTToDateAndCustomer request.
+    return lookup_cache.appointments_cache.get_or_load(appointments_key(company_id, date, email), loader)
+
+
+def set_cancel_appointment(conversations, sender, date, email):
+    conversations.save(sender, {'pending_option': 'cancel_appointment', 'date': date, 'email': email})
+
+
+def chosen_key(conversations, sender, company_id):
+    # The cache key of the list the sender is choosing from, if known.
+    conversation = conversations.get(sender)
+    if conversation.get('email'):
+        return appointments_key(company_id, conversation['date'], conversation['email'])
+    return None
+
+
+def listed_appointment_ids(key, fetch_details):
+    # AppointmentIDs in the list the user was shown, or None when that list
+    # is unknown or cannot be fetched. fetch_details is the bot's own.
+    if key is None:
+        return None
+    company_id, email, date = key
+    details = fetch_details('4', date=date, email=email)
+    if not details or not details.get('success'):
+        return None
+    return {str(appt['AppointmentID']) for appt in details.get('listofAppointments', [])}
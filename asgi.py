@@ -0,0 +1,175 @@
+import asyncio
+import json
+import logging
+import time
+from urllib.parse import parse_qs
+
+import async_booking
+import booking_client
+import cancel_jobs
+import idempotency
+import metrics
+import readiness
+import resilience
+import warmup
+import app as sms_bot
+import whatsapp
+
+# asyncio variant of the /webhook (whatsapp.py) and /sms (app.py) bots, for any
+# ASGI server:
+#
+#   uvicorn asgi:application --host 0.0.0.0 --port 8000
+#
+# Routing and replies are the bots' own reply_for functions, run on the event
+# loop. When one needs a booking platform response it does not have yet, the
+# blocking client raises UpstreamNeeded; the response is fetched with aiohttp
+# while other conversations keep being served, and reply_for runs again with it
+# available. This relies on handlers calling the platform before they change
+# any session state, which they all do. A waiting conversation holds a
+# coroutine rather than a thread, so one process can have thousands in flight.
+MAX_UPSTREAM_CALLS = 4
+
+MIMETYPE = 'application/xml'
+CONTENT_TYPE = f'{MIMETYPE}; charset=utf-8'.encode()
+
+caches_warm = readiness.register('caches_warm', readiness.Flag())
+
+
+def whatsapp_reply(sender, message):
+    return whatsapp.TWIML.document(whatsapp.reply_for(sender, message))
+
+
+def sms_reply(sender, message):
+    return sms_bot.reply_for(sender, message).encode('utf-8')
+
+
+ROUTES = {
+    '/webhook': whatsapp_reply,
+    '/sms': sms_reply,
+}
+
+_in_flight = {}
+_fetches = {}
+
+
+async def fetch_once(needed, deadline):
+    # Conversations missing the same response (a cold price list, say) share
+    # one upstream call, like lookup_cache's SingleFlight does for threads.
+    pending = _fetches.get(needed.key)
+    if pending is None:
+        pending = _fetches[needed.key] = asyncio.ensure_future(async_booking.fetch(needed, deadline))
+        pending.add_done_callback(lambda _: _fetches.pop(needed.key, None))
+    return await asyncio.shield(pending)
+
+
+async def run_handler(handler, sender, message, reply_from):
+    deadline = asyncio.get_running_loop().time() + resilience.WEBHOOK_BUDGET
+    responses = {}
+    # There is no Flask request for cancel_jobs to read the To number from.
+    reply_from_token = cancel_jobs.reply_from.set(reply_from)
+    try:
+        for _ in range(MAX_UPSTREAM_CALLS + 1):
+            token = booking_client.prefetched.set(responses)
+            try:
+                return handler(sender, message)
+            except booking_client.UpstreamNeeded as needed:
+                if len(responses) >= MAX_UPSTREAM_CALLS:
+                    raise
+                logging.debug("Fetching %s %s for %s", needed.method, needed.path, sender)
+                responses[needed.key] = await fetch_once(needed, deadline)
+            finally:
+                booking_client.prefetched.reset(token)
+    finally:
+        cancel_jobs.reply_from.reset(reply_from_token)
+
+
+async def handle_message(handler, form):
+    message = form.get('Body', '').strip().lower()
+    sender = form.get('From', '')
+    reply_from = form.get('To', '')
+    message_sid = form.get('MessageSid') or form.get('SmsMessageSid')
+    logging.info("Incoming message: %s from %s", message, sender)
+    if not message_sid:
+        return await run_handler(handler, sender, message, reply_from)
+
+    # Same replay-on-retry contract as idempotency.once, with waiting done on
+    # the loop instead of a thread.
+    reply = idempotency.lookup(message_sid)
+    if reply is not None:
+        return reply[2]
+    pending = _in_flight.get(message_sid)
+    if pending is not None:
+        return await asyncio.shield(pending)
+    pending = _in_flight[message_sid] = asyncio.ensure_future(run_handler(handler, sender, message, reply_from))
+    try:
+        body = await pending
+    finally:
+        _in_flight.pop(message_sid, None)
+    idempotency.record(message_sid, (200, MIMETYPE, body))
+    return body
+
+
+async def read_form(receive):
+    chunks = []
+    while True:
+        event = await receive()
+        chunks.append(event.get('body', b''))
+        if not event.get('more_body'):
+            break
+    return {key: values[-1] for key, values in parse_qs(b''.join(chunks).decode('utf-8')).items()}
+
+
+async def respond(send, status, body, content_type=CONTENT_TYPE):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', content_type), (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def lifespan(receive, send):
+    while True:
+        event = await receive()
+        if event['type'] == 'lifespan.startup':
+            # Warm-up runs on threads with the blocking client, off the loop.
+            warmup.start(warmup.cache_lookups(whatsapp) + warmup.cache_lookups(sms_bot), on_ready=caches_warm.set)
+            cancel_jobs.start()
+            await send({'type': 'lifespan.startup.complete'})
+        elif event['type'] == 'lifespan.shutdown':
+            warmup.stop()
+            await async_booking.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    path, method = scope['path'], scope['method']
+    if path == '/metrics' and method == 'GET':
+        await respond(send, 200, metrics.render().encode('utf-8'), metrics.CONTENT_TYPE.encode())
+        return
+    if path == '/healthz' and method == 'GET':
+        await respond(send, 200, b'ok', b'text/plain')
+        return
+    if path == '/ready' and method == 'GET':
+        ready, results = readiness.status()
+        await respond(send, 200 if ready else 503, json.dumps({'ready': ready, 'checks': results}).encode(), b'application/json')
+        return
+    handler = ROUTES.get(path)
+    if handler is None or method != 'POST':
+        await respond(send, 404 if handler is None else 405, b'', b'text/plain')
+        return
+
+    started = time.perf_counter()
+    status = 200
+    try:
+        body = await handle_message(handler, await read_form(receive))
+    except Exception as e:
+        logging.exception("Handling %s failed: %s", path, e)
+        status, body = 500, b''
+    await respond(send, status, body)
+    metrics.inc('bot_requests_total', route=path, status=str(status))
+    metrics.observe('bot_request_duration_seconds', time.perf_counter() - started, route=path)
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import os
+import time
+import aiohttp
+import requests
+
+import booking_client
+import metrics
+import resilience
+
+# asyncio counterpart of booking_client.request for asgi.py. Calls go through
+# one pooled aiohttp session and share booking_client's timeouts and
+# resilience's retry policy, backoff and circuit breakers. The result is
+# returned as a requests.Response (or the requests exception the blocking
+# client would have raised), so the synchronous handlers see no difference.
+ASYNC_POOL_LIMIT = int(os.environ.get('BOOKING_ASYNC_POOL_LIMIT', 100))
+
+_session = None
+
+
+def get_session():
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=ASYNC_POOL_LIMIT, limit_per_host=ASYNC_POOL_LIMIT)
+        _session = aiohttp.ClientSession(connector=connector)
+    return _session
+
+
+async def close():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+def _as_response(method, url, status, headers, body):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers)
+    response._content = body
+    response.url = url
+    response.encoding = 'utf-8'
+    response.request = requests.Request(method, url).prepare()
+    return response
+
+
+async def _send(method, path, time_left, connect_timeout, read_timeout, kwargs):
+    endpoint = path.split('?', 1)[0]
+    timeout = aiohttp.ClientTimeout(total=time_left,
+                                    sock_connect=min(connect_timeout or booking_client.CONNECT_TIMEOUT, time_left),
+                                    sock_read=min(read_timeout or booking_client.READ_TIMEOUT, time_left))
+    url = booking_client.url_for(path)
+    started = time.perf_counter()
+    try:
+        async with get_session().request(method, url, timeout=timeout, **kwargs) as response:
+            body = await response.read()
+    except asyncio.TimeoutError as e:
+        metrics.observe('booking_request_duration_seconds', time.perf_counter() - started, endpoint=endpoint)
+        metrics.inc('booking_request_errors_total', endpoint=endpoint, error='Timeout')
+        raise requests.exceptions.Timeout(f"{method} {url} timed out") from e
+    except aiohttp.ClientError as e:
+        metrics.observe('booking_request_duration_seconds', time.perf_counter() - started, endpoint=endpoint)
+        metrics.inc('booking_request_errors_total', endpoint=endpoint, error=type(e).__name__)
+        raise requests.exceptions.ConnectionError(f"{method} {url} failed: {e}") from e
+    metrics.observe('booking_request_duration_seconds', time.perf_counter() - started, endpoint=endpoint)
+    result = _as_response(method, url, response.status, response.headers, body)
+    if result.status_code >= 400:
+        metrics.inc('booking_request_errors_total', endpoint=endpoint, error=str(result.status_code))
+    if result.status_code in resilience.RETRYABLE_STATUS:
+        result.raise_for_status()
+    return result
+
+
+async def request(method, path, deadline, connect_timeout=None, read_timeout=None, max_attempts=None, **kwargs):
+    # Same loop as resilience.call, with the budget given as a loop.time() deadline.
+    loop = asyncio.get_running_loop()
+    endpoint = path.split('?', 1)[0]
+    breaker = resilience.get_breaker(endpoint)
+    max_attempts = max_attempts or resilience.MAX_ATTEMPTS
+    attempt = 0
+    while True:
+        time_left = deadline - loop.time()
+        if time_left < resilience.MIN_ATTEMPT_TIME:
+            raise resilience.BudgetExceededError(f"Latency budget exhausted before calling {endpoint}")
+        if not breaker.allow():
+            raise resilience.CircuitOpenError(f"Circuit for {endpoint} is open")
+        try:
+            result = await _send(method, path, time_left, connect_timeout, read_timeout, kwargs)
+        except Exception as e:
+            if not resilience.is_retryable(e):
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            attempt += 1
+            delay = resilience.backoff_delay(attempt)
+            if attempt >= max_attempts or deadline - loop.time() - delay < resilience.MIN_ATTEMPT_TIME:
+                raise
+            metrics.inc('booking_retries_total', endpoint=endpoint)
+            logging.warning("Retrying %s in %.2fs after: %s", endpoint, delay, e)
+            await asyncio.sleep(delay)
+            continue
+        breaker.record_success()
+        return result
+
+
+async def fetch(needed, deadline):
+    # Resolves a booking_client.UpstreamNeeded to the response or exception the
+    # handler's blocking call would have produced.
+    try:
+        return await request(needed.method, needed.path, deadline, **needed.kwargs)
+    except requests.exceptions.RequestException as e:
+        return e
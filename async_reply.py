@@ -0,0 +1,115 @@
+import logging
+import os
+import threading
+import xml.etree.ElementTree as ET
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from flask import Response, current_app, request
+
+# Opt-in asynchronous reply mode. The webhook answers Twilio with an empty
+# TwiML document straight away, the real handler runs on a worker thread and
+# its reply is delivered through the outbound messages API, so webhook latency
+# no longer depends on the booking platform.
+ASYNC_REPLIES = os.environ.get('ASYNC_REPLIES', '0') == '1'
+ASYNC_WORKERS = int(os.environ.get('ASYNC_WORKERS', 8))
+OUTBOUND_CLIENT = os.environ.get('OUTBOUND_CLIENT', 'twilio')
+
+EMPTY_TWIML = '<?xml version="1.0" encoding="UTF-8"?><Response />'
+
+
+class TwilioOutboundClient:
+    def __init__(self, account_sid=None, auth_token=None):
+        from twilio.rest import Client
+        self.client = Client(account_sid or os.environ.get('TWILIO_ACCOUNT_SID'),
+                             auth_token or os.environ.get('TWILIO_AUTH_TOKEN'))
+
+    def send(self, to, from_, body):
+        return self.client.messages.create(to=to, from_=from_, body=body).sid
+
+
+class LocalOutboundClient:
+    # Stand-in used in tests and local runs: records messages instead of sending them.
+    def __init__(self):
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def send(self, to, from_, body):
+        with self._lock:
+            self.sent.append({'to': to, 'from': from_, 'body': body})
+            return f"LOCAL{len(self.sent)}"
+
+
+_outbound = None
+_outbound_lock = threading.Lock()
+
+
+def get_outbound_client():
+    global _outbound
+    if _outbound is None:
+        with _outbound_lock:
+            if _outbound is None:
+                _outbound = LocalOutboundClient() if OUTBOUND_CLIENT == 'local' else TwilioOutboundClient()
+    return _outbound
+
+
+def set_outbound_client(client):
+    global _outbound
+    _outbound = client
+
+
+# One single-threaded executor per stripe: messages from the same sender always
+# land on the same stripe, so a user's replies go out in the order they wrote.
+_executors = []
+_executors_lock = threading.Lock()
+_worker = threading.local()
+
+
+def _executor_for(sender):
+    if not _executors:
+        with _executors_lock:
+            if not _executors:
+                _executors.extend(ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'reply-{i}')
+                                  for i in range(ASYNC_WORKERS))
+    return _executors[zlib.crc32(sender.encode('utf-8')) % len(_executors)]
+
+
+def message_bodies(twiml):
+    if isinstance(twiml, Response):
+        twiml = twiml.get_data(as_text=True)
+    root = ET.fromstring(str(twiml).encode('utf-8'))
+    bodies = []
+    for message in root.iter('Message'):
+        body = message.find('Body')
+        text = body.text if body is not None else message.text
+        if text:
+            bodies.append(text)
+    return bodies
+
+
+def _run(app, view, path, form, args, kwargs):
+    _worker.active = True
+    try:
+        # Replay the inbound request so the handler sees the same form values.
+        with app.test_request_context(path, method='POST', data=form):
+            app.preprocess_request()
+            twiml = view(*args, **kwargs)
+        client = get_outbound_client()
+        for body in message_bodies(twiml):
+            client.send(to=form.get('From', ''), from_=form.get('To', ''), body=body)
+    except Exception as e:
+        logging.exception("Asynchronous reply to %s failed: %s", form.get('From'), e)
+    finally:
+        _worker.active = False
+
+
+def deferred(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not ASYNC_REPLIES or getattr(_worker, 'active', False):
+            return view(*args, **kwargs)
+        form = request.values.to_dict()
+        app = current_app._get_current_object()
+        _executor_for(form.get('From', '')).submit(_run, app, view, request.path, form, args, kwargs)
+        return Response(EMPTY_TWIML, mimetype='application/xml')
+    return wrapper
@@ -0,0 +1,261 @@
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import BaseAdapter
+
+# Micro-benchmarks for the per-message CPU cost of the bots. The booking
+# platform is replaced by responses recorded in benchmarks/fixtures, served
+# through a requests adapter mounted on booking_client's session, so every
+# number here is local work only: intent matching, session lookups, TwiML
+# rendering, price-list formatting and whole webhook requests.
+#
+#   python benchmarks/bench.py                   # run, compare, append to results.jsonl
+#   python benchmarks/bench.py --check           # exit 1 on a regression
+#   python benchmarks/bench.py --record          # refresh fixtures from BOOKING_BASE_URL
+#
+# Each run is appended to benchmarks/results.jsonl and compared with the
+# previous run; a median slower by more than --threshold is reported as a
+# regression.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+FIXTURES = os.path.join(HERE, 'fixtures')
+RESULTS = os.path.join(HERE, 'results.jsonl')
+
+sys.path.insert(0, ROOT)
+
+
+def load_fixtures():
+    fixtures = {}
+    for name in os.listdir(FIXTURES):
+        if name.endswith('.json'):
+            with open(os.path.join(FIXTURES, name), 'rb') as f:
+                fixtures[name[:-len('.json')]] = f.read()
+    return fixtures
+
+
+class FixtureAdapter(BaseAdapter):
+    # Answers every booking platform call with the recorded body for its endpoint.
+    def __init__(self, fixtures):
+        super().__init__()
+        self.fixtures = fixtures
+
+    def send(self, request, **kwargs):
+        endpoint = urlparse(request.url).path.rsplit('/', 1)[-1]
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        response.encoding = 'utf-8'
+        if endpoint in self.fixtures:
+            response.status_code = 200
+            response._content = self.fixtures[endpoint]
+        else:
+            response.status_code = 404
+            response._content = b'{"success": false}'
+        response.headers['Content-Type'] = 'application/json'
+        return response
+
+    def close(self):
+        pass
+
+
+def record_fixtures(date, email, company_id):
+    import booking_client
+    recorded = {
+        'GetDataOfTBP': booking_client.post(booking_client.TBP_PATH, json={'company_id': company_id, 'option_id': '2'}),
+        'GetAppointmentsWRTToDateAndCustomer': booking_client.get(booking_client.APPOINTMENTS_PATH,
+                                                                  params={'date': date, 'email': email, 'company_id': company_id}),
+    }
+    # CancelAppointment is not recorded: calling it would cancel a real appointment.
+    for name, response in recorded.items():
+        response.raise_for_status()
+        with open(os.path.join(FIXTURES, f"{name}.json"), 'w', encoding='utf-8') as f:
+            json.dump(response.json(), f, indent=2, ensure_ascii=False)
+            f.write('\n')
+        print(f"Recorded {name} from {response.url}")
+
+
+def measure(fn, number, repeat):
+    # Per-call time in microseconds of each of `repeat` batches of `number` calls.
+    fn()
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            fn()
+        timings.append((time.perf_counter() - started) / number * 1e6)
+    return timings
+
+
+def setup_bots(fixtures):
+    # The bots configure file logging and create session databases in the
+    # working directory at import, so they are imported from a scratch one.
+    os.chdir(tempfile.mkdtemp(prefix='bench-'))
+    logging.disable(logging.CRITICAL)
+    import booking_client
+    booking_client.get_session().mount(booking_client.BASE_URL, FixtureAdapter(fixtures))
+    import app
+    import final
+    import whatsapp
+    return app, final, whatsapp
+
+
+def cycle(items):
+    state = {'i': 0}
+
+    def next_item():
+        item = items[state['i'] % len(items)]
+        state['i'] += 1
+        return item
+    return next_item
+
+
+def benchmarks(fixtures):
+    import session_store
+    import twiml_cache
+    app, final, whatsapp = setup_bots(fixtures)
+
+    messages = ['hi', 'menu', '1', '2', 'faq', 'what are your working hours?', 'set preferences', 'preferences',
+                'thank you so much', 'how much is a haircut', 'bye', '🔙', 'poll', 'something else entirely']
+    next_message = cycle(messages)
+
+    memory_store = session_store.MemorySessionStore()
+    sqlite_store = session_store.SQLiteSessionStore(path=os.path.join(os.getcwd(), 'bench-sessions.db'))
+    senders = [f"whatsapp:+3160{i:07d}" for i in range(1000)]
+    for sender in senders:
+        memory_store.save(sender, {'company_id': 10, 'company_name': 'Ezoncs Beauty Salon Den Haag'})
+        sqlite_store.save(sender, {'company_id': 10, 'company_name': 'Ezoncs Beauty Salon Den Haag'})
+    next_sender = cycle(senders)
+
+    def session_roundtrip(store):
+        def run():
+            sender = next_sender()
+            store.save(sender, store.get(sender))
+        return run
+
+    long_reply = json.loads(fixtures['GetDataOfTBP'])['companyLink'] * 20
+    conversation = cycle(['menu', '1', '1', '2', '3', '🔙', 'faq', 'hello', 'set preferences', '1', 'preferences'])
+
+    def whatsapp_turn():
+        whatsapp.TWIML.reply(whatsapp.reply_for('whatsapp:+31600000001', conversation()))
+
+    whatsapp_client = whatsapp.app.test_client()
+    app_client = app.app.test_client()
+    final_client = final.app.test_client()
+
+    def post(client, route, body):
+        def run():
+            client.post(route, data={'Body': body, 'From': 'whatsapp:+31600000002'})
+        return run
+
+    return {
+        'intent_match': lambda: whatsapp.INTENTS.match(next_message()),
+        'session_memory_roundtrip': session_roundtrip(memory_store),
+        'session_sqlite_roundtrip': session_roundtrip(sqlite_store),
+        'twiml_render': lambda: twiml_cache.render(long_reply),
+        'twiml_prerendered': lambda: whatsapp.TWIML.document(whatsapp.WELCOME_MENU),
+        'whatsapp_reply_for': whatsapp_turn,
+        'whatsapp_webhook_request': post(whatsapp_client, '/webhook', 'menu'),
+        'app_sms_price_list': post(app_client, '/sms', '2'),
+        'final_sms_price_list': post(final_client, '/sms', '2'),
+        'app_sms_common': post(app_client, '/sms', 'hello'),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def previous_run(path):
+    if not os.path.exists(path):
+        return None
+    last = None
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                last = json.loads(line)
+    return last
+
+
+def compare(current, previous, threshold):
+    regressions = []
+    print(f"{'benchmark':<28} {'median us':>10} {'min us':>10} {'previous':>10} {'change':>8}")
+    for name, result in current.items():
+        before = (previous or {}).get('results', {}).get(name)
+        change = ''
+        if before:
+            ratio = result['median_us'] / before['median_us'] - 1
+            change = f"{ratio:+.1%}"
+            if ratio > threshold:
+                regressions.append(name)
+                change += ' !'
+        previous_median = f"{before['median_us']:.2f}" if before else '-'
+        print(f"{name:<28} {result['median_us']:>10.2f} {result['min_us']:>10.2f} {previous_median:>10} {change:>8}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the message-routing hot path.")
+    parser.add_argument('--number', type=int, default=200, help="calls per batch")
+    parser.add_argument('--repeat', type=int, default=7, help="batches per benchmark")
+    parser.add_argument('--only', action='append', help="run only benchmarks whose name contains this (repeatable)")
+    parser.add_argument('--threshold', type=float, default=0.15, help="median slowdown reported as a regression")
+    parser.add_argument('--results', default=RESULTS, help="JSON lines file the run is appended to")
+    parser.add_argument('--no-save', action='store_true', help="compare without appending this run")
+    parser.add_argument('--check', action='store_true', help="exit with status 1 if any benchmark regressed")
+    parser.add_argument('--record', action='store_true', help="record fixtures from BOOKING_BASE_URL and exit")
+    parser.add_argument('--record-date', default=datetime.date.today().isoformat())
+    parser.add_argument('--record-email', default='test@example.com')
+    parser.add_argument('--record-company', type=int, default=10)
+    args = parser.parse_args()
+
+    if args.record:
+        record_fixtures(args.record_date, args.record_email, args.record_company)
+        return 0
+
+    results_path = os.path.abspath(args.results)
+    suite = benchmarks(load_fixtures())
+    results = {}
+    for name, fn in suite.items():
+        if args.only and not any(part in name for part in args.only):
+            continue
+        timings = measure(fn, args.number, args.repeat)
+        results[name] = {'median_us': round(statistics.median(timings), 3), 'min_us': round(min(timings), 3)}
+
+    previous = previous_run(results_path)
+    regressions = compare(results, previous, args.threshold)
+    if not args.no_save:
+        run = {
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'machine': platform.node(),
+            'number': args.number,
+            'repeat': args.repeat,
+            'results': results,
+        }
+        with open(results_path, 'a') as f:
+            f.write(json.dumps(run) + '\n')
+    if regressions:
+        print(f"Regressed by more than {args.threshold:.0%}: {', '.join(regressions)}")
+        if args.check:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
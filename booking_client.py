@@ -0,0 +1,125 @@
+import contextvars
+import json
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+import resilience
+
+# Shared HTTP client for test.yourbookingplatform.com. Every bot goes through
+# one pooled keep-alive session instead of opening a new connection per call.
+BASE_URL = os.environ.get('BOOKING_BASE_URL', 'https://test.yourbookingplatform.com').rstrip('/')
+
+TBP_PATH = '/Appointment/GetDataOfTBP'
+APPOINTMENTS_PATH = '/Appointment/GetAppointmentsWRTToDateAndCustomer'
+CANCEL_PATH = '/Appointment/CancelAppointment'
+
+# Pool sizing: pool_maxsize is the number of keep-alive connections kept per
+# host; with pool_block the pool never opens more than that under burst load.
+POOL_CONNECTIONS = int(os.environ.get('BOOKING_POOL_CONNECTIONS', 4))
+POOL_MAXSIZE = int(os.environ.get('BOOKING_POOL_MAXSIZE', 32))
+POOL_BLOCK = os.environ.get('BOOKING_POOL_BLOCK', '1') == '1'
+
+CONNECT_TIMEOUT = float(os.environ.get('BOOKING_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.environ.get('BOOKING_READ_TIMEOUT', 10))
+
+NO_PROXIES = {"http": None, "https": None}
+
+_session = None
+_session_lock = threading.Lock()
+
+# The asyncio server (asgi.py) runs the same synchronous handlers. It sets this
+# to the responses it already fetched with the async client; a call that is not
+# among them raises UpstreamNeeded instead of blocking the event loop, and the
+# handler is run again once that response has been fetched too.
+prefetched = contextvars.ContextVar('prefetched', default=None)
+
+
+class UpstreamNeeded(Exception):
+    def __init__(self, method, path, kwargs):
+        super().__init__(f"{method} {path} has not been fetched yet")
+        self.method = method
+        self.path = path
+        self.kwargs = kwargs
+        self.key = request_key(method, path, kwargs)
+
+
+def request_key(method, path, kwargs):
+    return method, path, json.dumps({'json': kwargs.get('json'), 'params': kwargs.get('params')}, sort_keys=True, default=str)
+
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, pool_block=POOL_BLOCK)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers.update({'Connection': 'keep-alive'})
+                _session = session
+    return _session
+
+
+def close():
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def url_for(path):
+    if path.startswith('http://') or path.startswith('https://'):
+        return path
+    return BASE_URL + path
+
+
+def request(method, path, connect_timeout=None, read_timeout=None, max_attempts=None, **kwargs):
+    responses = prefetched.get()
+    if responses is not None:
+        key = request_key(method, path, kwargs)
+        if key not in responses:
+            raise UpstreamNeeded(method, path, kwargs)
+        if isinstance(responses[key], Exception):
+            raise responses[key]
+        return responses[key]
+
+    # Each attempt's timeouts are capped by what is left of the webhook's
+    # latency budget; retryable failures (connection errors, timeouts, 429
+    # and 5xx) are retried with backoff behind a per-endpoint circuit breaker.
+    endpoint = path.split('?', 1)[0]
+
+    def send(time_left):
+        timeout = (min(connect_timeout or CONNECT_TIMEOUT, time_left), min(read_timeout or READ_TIMEOUT, time_left))
+        started = time.perf_counter()
+        try:
+            response = get_session().request(method, url_for(path), timeout=timeout, proxies=NO_PROXIES, **kwargs)
+        except requests.exceptions.RequestException as e:
+            metrics.observe('booking_request_duration_seconds', time.perf_counter() - started, endpoint=endpoint)
+            metrics.inc('booking_request_errors_total', endpoint=endpoint, error=type(e).__name__)
+            raise
+        metrics.observe('booking_request_duration_seconds', time.perf_counter() - started, endpoint=endpoint)
+        if response.status_code >= 400:
+            metrics.inc('booking_request_errors_total', endpoint=endpoint, error=str(response.status_code))
+        if response.status_code in resilience.RETRYABLE_STATUS:
+            response.raise_for_status()
+        return response
+
+    return resilience.call(endpoint, send, max_attempts=max_attempts)
+
+
+metrics.describe('booking_request_duration_seconds', 'histogram', 'Booking platform call latency per attempt.')
+metrics.describe('booking_request_errors_total', 'counter', 'Failed booking platform calls by endpoint and error.')
+
+
+def post(path, json=None, **kwargs):
+    return request('POST', path, json=json, **kwargs)
+
+
+def get(path, params=None, **kwargs):
+    return request('GET', path, params=params, **kwargs)
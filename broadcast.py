@@ -0,0 +1,235 @@
+import argparse
+import logging
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+import async_reply
+import daily_tips
+import metrics
+import preference_store
+import structured_logging
+
+# Bulk sends of daily tips and promotional offers to the users who opted into
+# them (whatsapp.PREFERENCES '1' and '3'). A campaign's message is rendered
+# once, when the campaign is created, and stored with it. Recipients are
+# streamed from preference_store's index in phone order, BROADCAST_BATCH_SIZE
+# at a time, optionally only those who opted in at one salon (--tenant), and
+# the last phone of every finished batch is checkpointed in SQLite: a
+# campaign that stops half way resumes after its last finished batch, so at
+# most one batch is sent twice. Each sending number has a token bucket
+# refilled at BROADCAST_RATE messages per second (Twilio queues and then
+# rejects with 429 whatever goes above a number's rate). A 429 stops the
+# number's bucket for the backoff period and the message is retried.
+#
+#   python broadcast.py tips
+#   python broadcast.py offers "20% off all treatments this week!" --tenant 14
+#   python broadcast.py resume
+BROADCAST_DB_PATH = os.environ.get('BROADCAST_DB_PATH', 'broadcast.db')
+BROADCAST_FROM = [number.strip() for number in os.environ.get('BROADCAST_FROM', '').split(',') if number.strip()]
+BROADCAST_RATE = float(os.environ.get('BROADCAST_RATE', 1))
+BROADCAST_BURST = int(os.environ.get('BROADCAST_BURST', 5))
+BROADCAST_WORKERS = int(os.environ.get('BROADCAST_WORKERS', 8))
+BROADCAST_BATCH_SIZE = int(os.environ.get('BROADCAST_BATCH_SIZE', 500))
+BROADCAST_MAX_ATTEMPTS = int(os.environ.get('BROADCAST_MAX_ATTEMPTS', 5))
+
+# template -> (preference the audience opted into, message)
+TEMPLATES = {
+    'tips': ('1', "{text}"),
+    'offers': ('3', "🎁 Special offer: {text}"),
+}
+
+TWILIO_TOO_MANY_REQUESTS = 20429
+
+metrics.describe('broadcast_messages_total', 'counter', 'Broadcast messages by template and result.')
+metrics.describe('broadcast_rate_limited_total', 'counter', 'Broadcast sends rejected with 429, by sending number.')
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        # Goes into debt so nothing is sent on this number for `seconds`.
+        with self._lock:
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+def is_rate_limited(error):
+    return getattr(error, 'status', None) == 429 or getattr(error, 'code', None) == TWILIO_TOO_MANY_REQUESTS
+
+
+def is_retryable(error):
+    # Rate limits, server errors and connections that never got through
+    # (ConnectTimeout is a ConnectionError). A read timeout may come after
+    # Twilio accepted the message, and anything else will not go away by
+    # trying again, so those fail at once rather than risk a second copy.
+    if isinstance(error, requests.exceptions.ConnectionError):
+        return True
+    status = getattr(error, 'status', None)
+    return is_rate_limited(error) or (isinstance(status, int) and status >= 500)
+
+
+def backoff_delay(attempt):
+    return min(60, 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+class CampaignStore:
+    def __init__(self, path=BROADCAST_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._conn().execute("CREATE TABLE IF NOT EXISTS campaigns ("
+                             "id INTEGER PRIMARY KEY AUTOINCREMENT, template TEXT NOT NULL, preference TEXT NOT NULL, "
+                             "tenant INTEGER, body TEXT NOT NULL, cursor TEXT NOT NULL DEFAULT '', sent INTEGER NOT NULL DEFAULT 0, "
+                             "failed INTEGER NOT NULL DEFAULT 0, status TEXT NOT NULL DEFAULT 'running', "
+                             "created_at REAL NOT NULL, updated_at REAL NOT NULL)")
+
+    def _conn(self):
+        # Per thread and per process, as in session_store.SQLiteSessionStore.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def create(self, template, text, tenant=None):
+        preference, message = TEMPLATES[template]
+        now = time.time()
+        return self._conn().execute("INSERT INTO campaigns (template, preference, tenant, body, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                                    (template, preference, tenant, message.format(text=text), now, now)).lastrowid
+
+    def get(self, campaign_id):
+        row = self._conn().execute("SELECT * FROM campaigns WHERE id = ?", (campaign_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def unfinished(self):
+        return [row['id'] for row in self._conn().execute("SELECT id FROM campaigns WHERE status = 'running' ORDER BY id")]
+
+    def checkpoint(self, campaign_id, cursor, sent, failed):
+        self._conn().execute("UPDATE campaigns SET cursor = ?, sent = sent + ?, failed = failed + ?, updated_at = ? WHERE id = ?",
+                             (cursor, sent, failed, time.time(), campaign_id))
+
+    def finish(self, campaign_id):
+        self._conn().execute("UPDATE campaigns SET status = 'done', updated_at = ? WHERE id = ?", (time.time(), campaign_id))
+
+
+class Broadcaster:
+    def __init__(self, audience=None, store=None, client=None, numbers=None, rate=BROADCAST_RATE, burst=BROADCAST_BURST,
+                 workers=BROADCAST_WORKERS, batch_size=BROADCAST_BATCH_SIZE):
+        self.audience = audience or preference_store.get_store()
+        self.store = store or CampaignStore()
+        self.client = client or async_reply.get_outbound_client()
+        self.numbers = numbers or BROADCAST_FROM
+        if not self.numbers:
+            raise ValueError("No sending numbers: set BROADCAST_FROM")
+        self.buckets = {number: TokenBucket(rate, burst) for number in self.numbers}
+        self.workers = workers
+        self.batch_size = batch_size
+
+    def sender_for(self, recipient):
+        # A recipient always hears from the same number.
+        return self.numbers[zlib.crc32(recipient.encode('utf-8')) % len(self.numbers)]
+
+    def deliver(self, recipient, body):
+        number = self.sender_for(recipient)
+        bucket = self.buckets[number]
+        for attempt in range(1, BROADCAST_MAX_ATTEMPTS + 1):
+            bucket.acquire()
+            try:
+                self.client.send(to=recipient, from_=number, body=body)
+                return True
+            except Exception as e:
+                if not is_retryable(e) or attempt == BROADCAST_MAX_ATTEMPTS:
+                    logging.error("Broadcast to %s failed: %s", recipient, e)
+                    return False
+                delay = backoff_delay(attempt)
+                if is_rate_limited(e):
+                    metrics.inc('broadcast_rate_limited_total', number=number)
+                    bucket.pause(delay)
+                else:
+                    time.sleep(delay)
+                logging.warning("Broadcast to %s failed, retrying in %.1fs: %s", recipient, delay, e)
+        return False
+
+    def batches(self, preference, tenant, after):
+        while True:
+            phones = self.audience.audience(preference, tenant, after, self.batch_size)
+            if not phones:
+                return
+            after = phones[-1]
+            yield after, phones
+
+    def run(self, campaign_id):
+        campaign = self.store.get(campaign_id)
+        if campaign is None or campaign['status'] == 'done':
+            return campaign
+        if campaign['cursor']:
+            logging.info("Resuming campaign %s after %s (%d sent)", campaign_id, campaign['cursor'], campaign['sent'])
+        started = time.perf_counter()
+        body = campaign['body']
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='broadcast') as pool:
+            for cursor, recipients in self.batches(campaign['preference'], campaign['tenant'], campaign['cursor']):
+                results = list(pool.map(lambda recipient: self.deliver(recipient, body), recipients))
+                sent = sum(results)
+                self.store.checkpoint(campaign_id, cursor, sent, len(results) - sent)
+                metrics.inc('broadcast_messages_total', sent, template=campaign['template'], result='sent')
+                metrics.inc('broadcast_messages_total', len(results) - sent, template=campaign['template'], result='failed')
+        self.store.finish(campaign_id)
+        campaign = self.store.get(campaign_id)
+        logging.info("Campaign %s done: %d sent, %d failed in %.1fs", campaign_id, campaign['sent'], campaign['failed'],
+                     time.perf_counter() - started)
+        return campaign
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Send a daily tip or promotional offer to opted-in users.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('tips', help="send today's tip")
+    offers = commands.add_parser('offers', help="send a promotional offer")
+    offers.add_argument('text')
+    offers.add_argument('--tenant', type=int, help="only users who opted in at this company id")
+    resume = commands.add_parser('resume', help="continue unfinished campaigns")
+    resume.add_argument('campaign_id', nargs='?', type=int)
+    args = parser.parse_args(argv)
+
+    structured_logging.configure('broadcast.log', level=logging.INFO)
+    broadcaster = Broadcaster()
+    if args.command == 'resume':
+        campaign_ids = [args.campaign_id] if args.campaign_id else broadcaster.store.unfinished()
+    else:
+        if args.command == 'tips':
+            campaign_ids = [broadcaster.store.create('tips', daily_tips.get_daily_tip())]
+        else:
+            campaign_ids = [broadcaster.store.create('offers', args.text, args.tenant)]
+    for campaign_id in campaign_ids:
+        campaign = broadcaster.run(campaign_id)
+        print(f"Campaign {campaign_id}: {campaign['sent']} sent, {campaign['failed']} failed")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,256 @@
+import contextvars
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+import requests
+from flask import has_request_context, request
+from urllib3.exceptions import NewConnectionError
+
+import async_reply
+import booking_client
+import lookup_cache
+import metrics
+import resilience
+
+# CancelAppointment is the slowest booking platform call, so it is taken off
+# the webhook. The handler queues a job in SQLite and answers "in progress"
+# straight away. A pool of worker threads makes the call, retries outages with
+# backoff, and messages the user the outcome through the outbound client.
+# Jobs are keyed by AppointmentID and sender. A sender who submits an
+# appointment whose job is still queued or running (a double tap, a Twilio
+# retry, a second worker) joins that job instead of cancelling twice. A
+# running job holds a lease; if its worker dies, another worker picks the job
+# up once the lease runs out. CancelAppointment is not idempotent, so it is
+# only sent again after failures that show the platform never processed it;
+# after a read timeout it may have, and the user is told to try again.
+# After a successful cancel, this process drops its cached copy of the
+# appointment list the ID was picked from. Other processes wait out the
+# list's short TTL.
+CANCEL_DB_PATH = os.environ.get('CANCEL_DB_PATH', 'cancel_jobs.db')
+CANCEL_WORKERS = int(os.environ.get('CANCEL_WORKERS', 4))
+CANCEL_MAX_ATTEMPTS = int(os.environ.get('CANCEL_MAX_ATTEMPTS', 6))
+CANCEL_LEASE = float(os.environ.get('CANCEL_LEASE', 60))
+CANCEL_BUDGET = float(os.environ.get('CANCEL_BUDGET', 30))
+# The outcome message goes out from the number the user wrote to: the Flask
+# request's To, or reply_from as set by asgi.py. CANCEL_REPLY_FROM is only
+# used when neither is available.
+CANCEL_REPLY_FROM = os.environ.get('CANCEL_REPLY_FROM', '')
+
+POLL_INTERVAL = 1.0
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+reply_from = contextvars.ContextVar('reply_from', default=None)
+
+metrics.describe('cancel_jobs_submitted_total', 'counter', 'Cancellations submitted, by whether they joined an existing job.')
+metrics.describe('cancel_jobs_finished_total', 'counter', 'Cancellation jobs finished, by result.')
+metrics.describe('cancel_job_retries_total', 'counter', 'Cancellation attempts rescheduled after a transient failure.')
+
+
+class CancelJobQueue:
+    def __init__(self, path=CANCEL_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS cancel_jobs ("
+                     "appointment_id TEXT NOT NULL, sender TEXT NOT NULL, reply_from TEXT NOT NULL, method TEXT NOT NULL, "
+                     "messages TEXT NOT NULL, cache_key TEXT, status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+                     "run_at REAL NOT NULL, created_at REAL NOT NULL, updated_at REAL NOT NULL, PRIMARY KEY (appointment_id, sender))")
+        # For a running job run_at is when its lease expires.
+        conn.execute("CREATE INDEX IF NOT EXISTS cancel_jobs_runnable ON cancel_jobs (run_at) WHERE status IN ('queued', 'running')")
+
+    def _conn(self):
+        # Per thread and per process, as in session_store.SQLiteSessionStore.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def submit(self, appointment_id, sender, reply_from, method, messages, cache_key=None):
+        # Returns the job's status and whether this call created it. A job
+        # that failed for good is started afresh.
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT status FROM cancel_jobs WHERE appointment_id = ? AND sender = ?",
+                               (appointment_id, sender)).fetchone()
+            if row is not None and row[0] != FAILED:
+                return row[0], False
+            conn.execute("INSERT OR REPLACE INTO cancel_jobs (appointment_id, sender, reply_from, method, messages, cache_key, "
+                         "status, attempts, run_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?, ?, ?)",
+                         (appointment_id, sender, reply_from, method, json.dumps(messages),
+                          json.dumps(cache_key) if cache_key else None, QUEUED, now, now, now))
+        return QUEUED, True
+
+    def claim(self, now, lease=CANCEL_LEASE):
+        # The subquery runs inside the UPDATE, under SQLite's write lock, so
+        # two workers never claim the same job.
+        return self._conn().execute(
+            "UPDATE cancel_jobs SET status = ?, attempts = attempts + 1, run_at = ?, updated_at = ? WHERE rowid = "
+            "(SELECT rowid FROM cancel_jobs WHERE status IN ('queued', 'running') AND run_at <= ? ORDER BY run_at LIMIT 1) "
+            "RETURNING appointment_id, sender, reply_from, method, messages, cache_key, attempts",
+            (RUNNING, now + lease, now, now)).fetchone()
+
+    def retry(self, appointment_id, sender, run_at):
+        self._conn().execute("UPDATE cancel_jobs SET status = ?, run_at = ?, updated_at = ? WHERE appointment_id = ? AND sender = ?",
+                             (QUEUED, run_at, time.time(), appointment_id, sender))
+
+    def finish(self, appointment_id, sender, status):
+        self._conn().execute("UPDATE cancel_jobs SET status = ?, updated_at = ? WHERE appointment_id = ? AND sender = ?",
+                             (status, time.time(), appointment_id, sender))
+
+    def status(self, appointment_id, sender):
+        row = self._conn().execute("SELECT status FROM cancel_jobs WHERE appointment_id = ? AND sender = ?",
+                                   (appointment_id, sender)).fetchone()
+        return row[0] if row is not None else None
+
+    def counts(self):
+        return dict(self._conn().execute("SELECT status, COUNT(*) FROM cancel_jobs GROUP BY status").fetchall())
+
+
+_queue = None
+_queue_lock = threading.Lock()
+_started_pid = None
+_wake = threading.Event()
+
+
+def get_queue():
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = CancelJobQueue()
+    return _queue
+
+
+def start(workers=CANCEL_WORKERS):
+    # Idempotent, and once per process: threads do not survive a fork.
+    global _started_pid
+    with _queue_lock:
+        if _started_pid == os.getpid():
+            return
+        _started_pid = os.getpid()
+    for number in range(workers):
+        threading.Thread(target=_work, name=f'cancel-{number}', daemon=True).start()
+
+
+def submit(appointment_id, sender, messages, method='POST', cache_key=None):
+    # Queues the cancellation and returns the webhook's reply. messages holds
+    # the bot's texts: in_progress (formatted with appointment_id), done,
+    # failed and error. cache_key is the appointments_cache key of the list
+    # the appointment was picked from.
+    appointment_id = str(appointment_id)
+    if has_request_context():
+        from_number = request.values.get('To', '')
+    else:
+        from_number = reply_from.get() or CANCEL_REPLY_FROM
+    if not from_number:
+        logging.error("No number to send the cancellation result for appointment %s from", appointment_id)
+    status, created = get_queue().submit(appointment_id, sender, from_number, method, messages, cache_key)
+    metrics.inc('cancel_jobs_submitted_total', joined='false' if created else 'true')
+    start()
+    _wake.set()
+    if created:
+        logging.info("Queued cancellation of appointment %s for %s", appointment_id, sender)
+    else:
+        logging.info("Cancellation of appointment %s already %s", appointment_id, status)
+    if status == DONE:
+        return messages['done']
+    return messages['in_progress'].format(appointment_id=appointment_id)
+
+
+def backoff_delay(attempt):
+    return min(300, 5 * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+def is_unsent(error):
+    # Failures after which the platform cannot have cancelled anything: the
+    # connection was never made, the circuit or budget stopped the call, or
+    # the platform turned the request away.
+    if isinstance(error, (requests.exceptions.ConnectTimeout, resilience.CircuitOpenError, resilience.BudgetExceededError)):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError) and error.args:
+        # Connection refused: requests wraps it in a plain ConnectionError.
+        return isinstance(getattr(error.args[0], 'reason', None), NewConnectionError)
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return error.response.status_code in (429, 503)
+    return False
+
+
+def cancel(appointment_id, method):
+    # True or False from the platform; raises on errors. One attempt per
+    # call: the job decides what is safe to send again.
+    resilience.start_budget(CANCEL_BUDGET)
+    try:
+        if method == 'GET':
+            response = booking_client.get(booking_client.CANCEL_PATH, params={'AppointmentID': int(appointment_id)}, max_attempts=1)
+        else:
+            response = booking_client.post(booking_client.CANCEL_PATH, json={'AppointmentID': int(appointment_id)}, max_attempts=1)
+    finally:
+        resilience.end_budget()
+    response.raise_for_status()
+    response_json = response.json()
+    if not response_json.get('success'):
+        logging.error("Cancellation of appointment %s failed: %s", appointment_id, response_json)
+    return bool(response_json.get('success'))
+
+
+def run(queue, job):
+    appointment_id, sender, reply_from, method, messages, cache_key, attempts = job
+    messages = json.loads(messages)
+    try:
+        result = 'done' if cancel(appointment_id, method) else 'failed'
+    except Exception as e:
+        if is_unsent(e) and attempts < CANCEL_MAX_ATTEMPTS:
+            delay = backoff_delay(attempts)
+            metrics.inc('cancel_job_retries_total')
+            logging.warning("Cancellation of appointment %s failed, retrying in %.0fs: %s", appointment_id, delay, e)
+            queue.retry(appointment_id, sender, time.time() + delay)
+            return
+        logging.error("Cancellation of appointment %s gave up after %d attempts: %s", appointment_id, attempts, e)
+        result = 'error'
+    queue.finish(appointment_id, sender, DONE if result == 'done' else FAILED)
+    if result == 'done' and cache_key:
+        lookup_cache.appointments_cache.invalidate(tuple(json.loads(cache_key)))
+    metrics.inc('cancel_jobs_finished_total', result=result)
+    try:
+        async_reply.get_outbound_client().send(to=sender, from_=reply_from, body=messages[result])
+    except Exception as e:
+        logging.error("Failed to send cancellation result for appointment %s to %s: %s", appointment_id, sender, e)
+
+
+def _work():
+    queue = get_queue()
+    while True:
+        try:
+            job = queue.claim(time.time())
+        except sqlite3.Error as e:
+            logging.error("Failed to claim a cancellation job: %s", e)
+            job = None
+        if job is None:
+            _wake.wait(POLL_INTERVAL)
+            _wake.clear()
+            continue
+        try:
+            run(queue, job)
+        except Exception:
+            # The lease brings the job back.
+            logging.exception("Cancellation job for appointment %s crashed", job[0])
+
+
+@metrics.register
+def cancel_job_metrics():
+    if _queue is None:
+        return []
+    return [('cancel_jobs', {'status': status}, count) for status, count in _queue.counts().items()]
@@ -0,0 +1,13 @@
+import random
+
+# Tips sent to users who opted into daily tips (whatsapp.PREFERENCES '1').
+# Kept apart from the bot so broadcast.py can pick one without importing it.
+DAILY_TIPS = [
+    "💡 Tip: Drink plenty of water to stay hydrated and keep your skin glowing!",
+    "💡 Tip: Regular exercise can help maintain your overall health and well-being.",
+    "💡 Tip: Always remove your makeup before going to bed to prevent skin issues."
+]
+
+
+def get_daily_tip():
+    return random.choice(DAILY_TIPS)
@@ -3,18 +3,50 @@ from twilio.twiml.messaging_response import MessagingResponse
 import logging
 import random
 import requests
-from tenacity import retry, stop_after_attempt, wait_fixed
+import booking_client
+import lookup_cache
+import resilience
+import async_reply
+import idempotency
+import metrics
+import structured_logging
+import session_store
+import price_pages
+import cancel_jobs
+import appointment_lists
 from urllib.parse import quote  # Import for URL encoding
 
 # Configure logging
-logging.basicConfig(filename='chatbot_den_haag.log', level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+structured_logging.configure('chatbot_den_haag.log', level=logging.DEBUG)
 
 app = Flask(__name__)
+metrics.install(app)
+structured_logging.install(app)
+resilience.install(app)
+
+CONVERSATIONS = session_store.Conversations(namespace='sms')
 
 # Constants
 COMPANY_NAME = 'Ezoncs Beauty Salon Den Haag 💇‍♀️✨'
 COMPANY_ID = 10
 
+# Long price lists are split into pages; "more" sends the next one.
+PRICE_LIST = price_pages.PriceList(
+    header=f"{COMPANY_NAME} - Prices 💲:\n\n",
+    line="💇‍♀️ *{ServiceName}* ({ServiceCategory}): _{Price}_\n",
+    footer="\n\nPress 0️⃣ to go back.",
+    more="\nPage {page}/{pages}. Reply *more* for the next page or 0️⃣ to go back.",
+)
+
+# Cancellations run in the background (cancel_jobs): the webhook answers with
+# in_progress and the outcome follows as a message of its own.
+CANCEL_MESSAGES = {
+    'in_progress': "⏳ Cancelling appointment {appointment_id}. We'll message you as soon as it's done.\n\nPress 0️⃣ to go back to the main menu 🔙.",
+    'done': "Appointment has been successfully cancelled.\n\nPress 0️⃣ to go back to the main menu 🔙.",
+    'failed': "Failed to cancel the appointment. Please try again later.\n\nPress 0️⃣ to go back to the main menu 🔙.",
+    'error': "Failed to cancel the appointment. Please try again later.\n\nPress 0️⃣ to go back to the main menu 🔙.",
+}
+
 # Menu options
 OPTIONS = {
     '1': "About Us 🏠",
@@ -50,31 +82,38 @@ COMMON_RESPONSES = {
 }
 
 # Fetch details from external API with retry mechanism
-@retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
 def fetch_details(option_id, date=None, email=None):
     if option_id == '4' and date and email:
-        url = 'https://test.yourbookingplatform.com/Appointment/GetAppointmentsWRTToDateAndCustomer'
+        path = booking_client.APPOINTMENTS_PATH
         params = {'date': date, 'email': email, 'company_id': COMPANY_ID}
-    else:
-        url = f'https://test.yourbookingplatform.com/Appointment/GetDataOfTBP?company_id={COMPANY_ID}&option_id={option_id}'
+        return appointment_lists.fetch_appointments(COMPANY_ID, date, email, lambda: request_details(path, params))
 
+    path = booking_client.TBP_PATH
+    params = {'company_id': COMPANY_ID, 'option_id': option_id}
+    return lookup_cache.tbp_cache.get_or_load((COMPANY_ID, option_id), lambda: request_details(path, params))
+
+def request_details(path, params):
     try:
-        response = requests.get(url)
+        response = booking_client.get(path, params=params)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
-        logging.error(f"Request error occurred: {e}")
+        logging.error("Request error occurred: %s", e)
         return None
 
 # Main route for handling incoming messages
 @app.route('/sms', methods=['POST'])
+@idempotency.once
+@async_reply.deferred
 def sms_reply():
     incoming_msg = request.form.get('Body', '').strip().lower()
     from_number = request.form.get('From')
     response = MessagingResponse()
     msg = response.message()
 
-    logging.info(f"Incoming message: {incoming_msg} from {from_number}")
+    logging.info("Incoming message: %s from %s", incoming_msg, from_number)
+
+    pending_option = CONVERSATIONS.pending_option(from_number)
 
     # Handle predefined common responses
     if incoming_msg in COMMON_RESPONSES:
@@ -99,7 +138,7 @@ def sms_reply():
         option_id = incoming_msg
         if option_id == '4':
             msg.body("Please provide the date (YYYY-MM-DD) and email for your appointment.\nExample: 2024-10-12 example@mail.com")
-            app.config['pending_option'] = '4'
+            CONVERSATIONS.set_pending_option(from_number, '4')
         else:
             details = fetch_details(option_id)
             if details and details.get('success'):
@@ -109,11 +148,7 @@ def sms_reply():
                     about_us_response = f"{COMPANY_NAME} - About us 🏠:\n{company_link}\nClick here: {company_link}\n\nPress 0️⃣ to go back."
                     msg.body(about_us_response)
                 elif option_id == '2':  # Prices
-                    prices = details.get('prices', [])
-                    prices_response = f"{COMPANY_NAME} - Prices 💲:\n\n"
-                    for price in prices:
-                        prices_response += f"💇‍♀️ *{price['ServiceName']}* ({price['ServiceCategory']}): _{price['Price']}_\n"
-                    msg.body(prices_response + "\n\nPress 0️⃣ to go back.")
+                    msg.body(PRICE_LIST.reply(CONVERSATIONS, from_number, COMPANY_ID, details.get('prices', [])))
                 elif option_id == '3':  # Online Booking
                     booking_link = quote(details.get('booking_link', 'URL not available'), safe='/:')
                     booking_response = f"{COMPANY_NAME} - Online booking 📅:\nClick here to book: {booking_link}\n\nPress 0️⃣ to go back."
@@ -121,8 +156,16 @@ def sms_reply():
             else:
                 msg.body(f"{COMPANY_NAME} - Details are currently unavailable.\n\nPress 0️⃣ to go back.")
 
+    # Next page of a long price list
+    elif pending_option == 'more_prices' and incoming_msg == 'more':
+        details = fetch_details('2')
+        if details and details.get('success'):
+            msg.body(PRICE_LIST.reply(CONVERSATIONS, from_number, COMPANY_ID, details.get('prices', []), more=True))
+        else:
+            msg.body(f"{COMPANY_NAME} - Details are currently unavailable.\n\nPress 0️⃣ to go back.")
+
     # Handle appointment cancellation (Pending option 4)
-    elif app.config.get('pending_option') == '4' and ' ' in incoming_msg:
+    elif pending_option == '4' and ' ' in incoming_msg:
         date, email = incoming_msg.split(' ', 1)
         details = fetch_details('4', date=date, email=email)
         if details and details.get('success'):
@@ -133,22 +176,21 @@ def sms_reply():
                     appointments_response += f"ID: {appt['AppointmentID']}, Time: {appt['Time']}\n"
                 appointments_response += "\nPlease provide the AppointmentID you want to cancel."
                 msg.body(appointments_response)
-                app.config['pending_option'] = 'cancel_appointment'
+                appointment_lists.set_cancel_appointment(CONVERSATIONS, from_number, date, email)
             else:
                 msg.body("No appointments found. Please try again with a different date or email.\n\nPress 0️⃣ to go back to the main menu 🔙.")
         else:
             msg.body("Invalid format. Please provide the date and email in the format 'YYYY-MM-DD email'.")
-    elif app.config.get('pending_option') == 'cancel_appointment':
+    elif pending_option == 'cancel_appointment':
         try:
             appointment_id = int(incoming_msg)
-            url = 'https://test.yourbookingplatform.com/Appointment/CancelAppointment'
-            params = {'AppointmentID': appointment_id}
-            response = requests.get(url, params=params)
-            response.raise_for_status()
-            if response.json().get('success'):
-                msg.body("Appointment has been successfully cancelled.\n\nPress 0️⃣ to go back to the main menu 🔙.")
+            key = appointment_lists.chosen_key(CONVERSATIONS, from_number, COMPANY_ID)
+            appointment_ids = appointment_lists.listed_appointment_ids(key, fetch_details)
+            if appointment_ids is not None and str(appointment_id) not in appointment_ids:
+                # Caught here instead of by the platform, after a round trip.
+                msg.body("Invalid AppointmentID. Please provide one of the IDs listed above.")
             else:
-                msg.body("Failed to cancel the appointment. Please try again later.\n\nPress 0️⃣ to go back to the main menu 🔙.")
+                msg.body(cancel_jobs.submit(appointment_id, from_number, CANCEL_MESSAGES, method='GET', cache_key=key))
         except ValueError:
             msg.body("Invalid AppointmentID. Please provide a valid number.")
     else:
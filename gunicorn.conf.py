@@ -0,0 +1,59 @@
+import multiprocessing
+import os
+
+import session_store
+
+# gunicorn picks this file up from the working directory:
+#
+#   BOT_APP=whatsapp gunicorn
+#
+# Every setting can be overridden from the environment. Graceful restarts:
+#   kill -HUP <master>   start new workers, then stop the old ones once their
+#                        in-flight requests finish (within graceful_timeout).
+#                        With preload_app the code itself is not reloaded.
+#   kill -USR2 <master>  start a new master with the new code next to the old
+#                        one; send the old master QUIT once the new workers
+#                        report ready on /ready.
+wsgi_app = 'wsgi:application'
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:' + os.environ.get('PORT', '8000'))
+
+# Conversation state in the memory backend lives inside one process, so a
+# follow-up message landing on another worker would find no session. Only
+# fork several workers when sessions are shared (SESSION_BACKEND=sqlite or
+# redis); otherwise scale with threads.
+default_workers = multiprocessing.cpu_count() * 2 + 1 if session_store.SESSION_BACKEND != 'memory' else 1
+workers = int(os.environ.get('WEB_CONCURRENCY', default_workers))
+worker_class = 'gthread'
+# Handlers mostly wait on the booking platform, so a worker needs enough
+# threads to cover the concurrent conversations it is expected to hold.
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
+
+# Build the bot's content tables once in the master and share them with the
+# workers copy-on-write.
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+# Twilio gives up on a webhook after 15 seconds; a request still running by
+# then is stuck and the worker is recycled.
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+# Recycle workers now and then, staggered so they do not all restart at once.
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 10000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 1000))
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG') or None
+errorlog = os.environ.get('GUNICORN_ERROR_LOG', '-')
+
+
+def post_fork(server, worker):
+    # Only the master's connection pool could have been created before the
+    # fork; drop it so the worker does not share its sockets.
+    import booking_client
+    booking_client.close()
+
+
+def post_worker_init(worker):
+    import wsgi
+    wsgi.start_warm_up()
+    wsgi.start_cancel_jobs()
@@ -0,0 +1,171 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, make_response, request
+
+import metrics
+from singleflight import SingleFlight
+
+# Twilio retries an inbound message when the webhook is slow, with the same
+# MessageSid. The first reply generated for a MessageSid is recorded and
+# replayed for every retry, so the handler (and the booking platform calls and
+# session changes it makes) runs once per message. A retry that arrives while
+# the first delivery is still being handled waits for it instead of running
+# in parallel. Use the sqlite backend when running more than one worker.
+IDEMPOTENCY_BACKEND = os.environ.get('IDEMPOTENCY_BACKEND', 'memory')
+IDEMPOTENCY_TTL = float(os.environ.get('IDEMPOTENCY_TTL', 60 * 60))
+IDEMPOTENCY_MAX_ENTRIES = int(os.environ.get('IDEMPOTENCY_MAX_ENTRIES', 10000))
+IDEMPOTENCY_DB_PATH = os.environ.get('IDEMPOTENCY_DB_PATH', 'idempotency.db')
+
+
+class MemoryReplyStore:
+    def __init__(self, ttl=IDEMPOTENCY_TTL, max_entries=IDEMPOTENCY_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._replies = OrderedDict()  # message_sid -> (reply, expires_at)
+        self._lock = threading.Lock()
+
+    def get(self, message_sid):
+        with self._lock:
+            entry = self._replies.get(message_sid)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                del self._replies[message_sid]
+                return None
+            return entry[0]
+
+    def put(self, message_sid, reply):
+        now = time.monotonic()
+        with self._lock:
+            self._replies[message_sid] = (reply, now + self.ttl)
+            self._replies.move_to_end(message_sid)
+            # Entries all share one TTL, so the oldest ones expire first.
+            while self._replies:
+                oldest = next(iter(self._replies.values()))
+                if len(self._replies) <= self.max_entries and oldest[1] > now:
+                    break
+                self._replies.popitem(last=False)
+
+    def count(self):
+        with self._lock:
+            return len(self._replies)
+
+
+class SQLiteReplyStore:
+    PRUNE_EVERY = 500
+
+    def __init__(self, path=IDEMPOTENCY_DB_PATH, ttl=IDEMPOTENCY_TTL, max_entries=IDEMPOTENCY_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._puts = 0
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS replies ("
+                     "message_sid TEXT PRIMARY KEY, status INTEGER NOT NULL, mimetype TEXT, body BLOB NOT NULL, expires_at REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS replies_expires_at ON replies (expires_at)")
+
+    def _conn(self):
+        # A connection opened before a fork (gunicorn preload_app) must not be
+        # used by the child, so connections are per thread and per process.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, message_sid):
+        row = self._conn().execute("SELECT status, mimetype, body FROM replies WHERE message_sid = ? AND expires_at > ?",
+                                   (message_sid, time.time())).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], bytes(row[2])
+
+    def put(self, message_sid, reply):
+        status, mimetype, body = reply
+        self._conn().execute("INSERT OR REPLACE INTO replies (message_sid, status, mimetype, body, expires_at) VALUES (?, ?, ?, ?, ?)",
+                             (message_sid, status, mimetype, body, time.time() + self.ttl))
+        self._puts += 1
+        if self._puts % self.PRUNE_EVERY == 0:
+            self.prune()
+
+    def prune(self):
+        conn = self._conn()
+        conn.execute("DELETE FROM replies WHERE expires_at <= ?", (time.time(),))
+        conn.execute("DELETE FROM replies WHERE message_sid IN ("
+                     "SELECT message_sid FROM replies ORDER BY expires_at DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM replies WHERE expires_at > ?", (time.time(),)).fetchone()[0]
+
+
+def create_store(backend=None):
+    backend = backend or IDEMPOTENCY_BACKEND
+    if backend == 'sqlite':
+        return SQLiteReplyStore()
+    if backend != 'memory':
+        logging.warning("Unknown IDEMPOTENCY_BACKEND %r, using memory", backend)
+    return MemoryReplyStore()
+
+
+store = create_store()
+flight = SingleFlight()
+replays = 0
+
+
+def lookup(message_sid):
+    # The reply recorded for an earlier delivery of this message, or None.
+    # Each hit is counted as a replay.
+    global replays
+    reply = store.get(message_sid)
+    if reply is not None:
+        replays += 1
+        logging.info("Replaying stored reply for duplicate message %s", message_sid)
+    return reply
+
+
+def record(message_sid, reply):
+    # reply is (status, mimetype, body). Server errors are not recorded so
+    # Twilio's retry gets another attempt.
+    if reply[0] < 500:
+        store.put(message_sid, reply)
+
+
+def _handle(message_sid, view, args, kwargs):
+    response = make_response(view(*args, **kwargs))
+    reply = (response.status_code, response.mimetype, response.get_data())
+    record(message_sid, reply)
+    return reply
+
+
+def once(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        message_sid = request.values.get('MessageSid') or request.values.get('SmsMessageSid')
+        if not message_sid:
+            return view(*args, **kwargs)
+
+        reply = lookup(message_sid)
+        if reply is None:
+            reply = flight.do(message_sid, lambda: _handle(message_sid, view, args, kwargs))
+        status, mimetype, body = reply
+        return Response(body, status=status, mimetype=mimetype)
+    return wrapper
+
+
+def stats():
+    return {'stored': store.count(), 'replays': replays, 'coalesced': flight.coalesced}
+
+
+@metrics.register
+def idempotency_metrics():
+    return [('idempotency_replays_total', {}, replays),
+            ('idempotency_coalesced_total', {}, flight.coalesced)]
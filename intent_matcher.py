@@ -0,0 +1,43 @@
+import re
+
+# Resolves the intent of an incoming message in one regex pass. All keyword
+# rules are compiled at import into a single alternation wrapped in a
+# lookahead, so every position of the message is tried against every rule at
+# once; the rule listed first wins when several match.
+EXACT = 'exact'
+PREFIX = 'prefix'
+SUBSTRING = 'substring'
+PATTERN = 'pattern'
+
+
+def _rule_pattern(kind, value):
+    if kind == EXACT:
+        return r'\A' + re.escape(value) + r'\Z'
+    if kind == PREFIX:
+        return r'\A' + re.escape(value)
+    if kind == SUBSTRING:
+        return re.escape(value)
+    if kind == PATTERN:
+        return value
+    raise ValueError(f"Unknown rule kind: {kind}")
+
+
+class IntentMatcher:
+    def __init__(self, rules):
+        # rules: ordered (intent, kind, value) tuples, highest priority first.
+        self.rules = list(rules)
+        alternatives = '|'.join(f'(?P<r{i}>{_rule_pattern(kind, value)})' for i, (_, kind, value) in enumerate(self.rules))
+        self._regex = re.compile(f'(?=(?:{alternatives}))')
+
+    def match(self, message):
+        best = None
+        for found in self._regex.finditer(message):
+            index = int(found.lastgroup[1:])
+            if best is None or index < best:
+                best = index
+                if best == 0:
+                    break
+        if best is None:
+            return None, None
+        intent, _, value = self.rules[best]
+        return intent, value
@@ -0,0 +1,184 @@
+import argparse
+import json
+import logging
+import math
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+# Replays multi-turn conversations against running bots at a fixed arrival
+# rate (open loop: new conversations start on schedule whether or not earlier
+# ones have finished) and reports throughput and p50/p95/p99 latency per route.
+#
+#   python loadtest/driver.py --target whatsapp=http://127.0.0.1:5000/webhook \
+#       --target sms=http://127.0.0.1:5001/sms --rate 20 --duration 60 --json results.json
+#
+# Every message gets a fresh MessageSid and every conversation its own sender,
+# as Twilio would send them.
+
+# Conversations per bot flavour; the target name selects the list.
+SCENARIOS = {
+    'whatsapp': [
+        ['hi', 'menu', '1', '1', '2', '3', '🔙', 'bye'],
+        ['menu', '2', '2', '3', 'thanks'],
+        ['faq', 'working hours', 'price', 'bye'],
+        ['set preferences', '1', 'set preferences', '2', 'preferences'],
+        ['poll', '2', 'reminder', 'yes'],
+        ['menu', '3', '4', 'help', 'feedback'],
+    ],
+    'sms': [
+        ['hello', 'menu', '1', '2', '3', '0'],
+        ['2', '3', 'thanks'],
+        ['4', '{date} {email}', '11', '0'],
+        ['menu', '4', '{date} {email}', '12', 'bye'],
+    ],
+    'bot': [
+        ['hello', '1', '2', '0', 'thanks'],
+        ['hi', '3', '4', 'bye'],
+        ['menu', '5', 'how are you'],
+    ],
+}
+
+APPOINTMENT_DATE = '2024-10-12'
+
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.late_starts = 0
+
+    def record(self, route, seconds, ok):
+        with self.lock:
+            self.latencies.setdefault(route, []).append(seconds)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    # Nearest-rank percentile.
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+_local = threading.local()
+
+
+def http_session():
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = _local.session = requests.Session()
+    return session
+
+
+def run_conversation(results, route, url, messages, number, to, timeout):
+    sender = f"whatsapp:+3160{number:07d}"
+    email = f"load{number}@example.com"
+    for message in messages:
+        body = message.format(date=APPOINTMENT_DATE, email=email)
+        form = {
+            'Body': body,
+            'From': sender,
+            'To': to,
+            'WaId': sender.split('+')[-1],
+            'MessageSid': f"SM{uuid.uuid4().hex}",
+        }
+        started = time.perf_counter()
+        try:
+            response = http_session().post(url, data=form, timeout=timeout)
+            ok = response.status_code < 400
+        except requests.exceptions.RequestException as e:
+            logging.debug("%s request failed: %s", route, e)
+            ok = False
+        results.record(route, time.perf_counter() - started, ok)
+
+
+def run(targets, rate, duration, workers, to, timeout, seed=None):
+    rng = random.Random(seed)
+    results = Results()
+    routes = list(targets)
+    total = int(rate * duration)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for number in range(total):
+            due = started + number / rate
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -0.1:
+                results.late_starts += 1
+            route = routes[number % len(routes)]
+            messages = rng.choice(SCENARIOS[route])
+            executor.submit(run_conversation, results, route, targets[route], messages, number, to, timeout)
+    elapsed = time.perf_counter() - started
+    return summarize(results, elapsed)
+
+
+def summarize(results, elapsed):
+    summary = {'elapsed': round(elapsed, 3), 'late_starts': results.late_starts, 'routes': {}}
+    everything = []
+    for route, latencies in sorted(results.latencies.items()):
+        ordered = sorted(latencies)
+        everything.extend(ordered)
+        summary['routes'][route] = route_summary(ordered, results.errors.get(route, 0), elapsed)
+    summary['total'] = route_summary(sorted(everything), sum(results.errors.values()), elapsed)
+    return summary
+
+
+def route_summary(ordered, errors, elapsed):
+    return {
+        'requests': len(ordered),
+        'errors': errors,
+        'throughput': round(len(ordered) / elapsed, 2) if elapsed else 0.0,
+        'p50_ms': round(percentile(ordered, 0.50) * 1000, 1),
+        'p95_ms': round(percentile(ordered, 0.95) * 1000, 1),
+        'p99_ms': round(percentile(ordered, 0.99) * 1000, 1),
+        'max_ms': round(ordered[-1] * 1000, 1) if ordered else 0.0,
+    }
+
+
+def print_summary(summary):
+    print(f"{'route':<10} {'requests':>9} {'errors':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    rows = list(summary['routes'].items()) + [('total', summary['total'])]
+    for route, row in rows:
+        print(f"{route:<10} {row['requests']:>9} {row['errors']:>7} {row['throughput']:>8} "
+              f"{row['p50_ms']:>8} {row['p95_ms']:>8} {row['p99_ms']:>8} {row['max_ms']:>8}")
+    if summary['late_starts']:
+        print(f"{summary['late_starts']} conversations started late; raise --workers or lower --rate.")
+
+
+def parse_target(value):
+    name, _, url = value.partition('=')
+    if name not in SCENARIOS or not url:
+        raise argparse.ArgumentTypeError(f"expected one of {', '.join(SCENARIOS)}=URL, got {value!r}")
+    return name, url
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay conversations against the bots and report latency.")
+    parser.add_argument('--target', type=parse_target, action='append', required=True,
+                        help="route=URL, e.g. whatsapp=http://127.0.0.1:5000/webhook (repeatable)")
+    parser.add_argument('--rate', type=float, default=10, help="new conversations per second")
+    parser.add_argument('--duration', type=float, default=30, help="seconds to keep starting conversations")
+    parser.add_argument('--workers', type=int, default=64)
+    parser.add_argument('--to', default='whatsapp:+14155238886', help="Twilio number the messages are sent to")
+    parser.add_argument('--timeout', type=float, default=15)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--json', help="also write the summary to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    summary = run(dict(args.target), args.rate, args.duration, args.workers, args.to, args.timeout, seed=args.seed)
+    print_summary(summary)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
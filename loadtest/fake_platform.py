@@ -0,0 +1,184 @@
+import argparse
+import json
+import logging
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Local stand-in for test.yourbookingplatform.com. Serves GetDataOfTBP,
+# GetAppointmentsWRTToDateAndCustomer and CancelAppointment with a log-normal
+# latency distribution (given as median and p99) and a configurable share of
+# error responses and stalls, so load runs do not depend on the real platform.
+#
+#   python loadtest/fake_platform.py --port 8081 --median-ms 80 --p99-ms 600 --error-rate 0.02
+#   BOOKING_BASE_URL=http://127.0.0.1:8081 python app.py
+
+DEFAULTS = {
+    'median_ms': 80.0,
+    'p99_ms': 600.0,
+    'error_rate': 0.0,
+    'error_status': 503,
+    'stall_rate': 0.0,
+    'stall_ms': 15000.0,
+    'prices': 12,
+    'appointments': 2,
+}
+
+# z-score of the 99th percentile of a standard normal distribution.
+Z_99 = 2.326
+
+
+class Platform:
+    def __init__(self, seed=None, **config):
+        self.config = dict(DEFAULTS, **config)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.errors = 0
+        self.stalls = 0
+
+    def latency(self):
+        median = self.config['median_ms'] / 1000
+        p99 = max(self.config['p99_ms'] / 1000, median)
+        sigma = math.log(p99 / median) / Z_99 if median > 0 else 0
+        with self.lock:
+            return median * math.exp(self.random.gauss(0, sigma)) if median > 0 else 0
+
+    def outcome(self):
+        # Returns 'error', 'stall' or 'ok' for the next request.
+        with self.lock:
+            roll = self.random.random()
+        if roll < self.config['error_rate']:
+            return 'error'
+        if roll < self.config['error_rate'] + self.config['stall_rate']:
+            return 'stall'
+        return 'ok'
+
+    def record(self, path, outcome):
+        with self.lock:
+            self.calls[path] = self.calls.get(path, 0) + 1
+            if outcome == 'error':
+                self.errors += 1
+            elif outcome == 'stall':
+                self.stalls += 1
+
+    def body_for(self, path, params):
+        if path.endswith('GetDataOfTBP'):
+            company_id = params.get('company_id', 10)
+            return {
+                'success': True,
+                'companyLink': f"https://test.yourbookingplatform.com/company/{company_id}",
+                'booking_link': f"https://test.yourbookingplatform.com/book/{company_id}",
+                'prices': [{'ServiceName': f"Treatment {i + 1}", 'ServiceCategory': ['Hair', 'Nails', 'Skin'][i % 3], 'Price': f"€{25 + 5 * i}"}
+                           for i in range(self.config['prices'])],
+            }
+        if path.endswith('GetAppointmentsWRTToDateAndCustomer'):
+            return {
+                'success': True,
+                'listofAppointments': [{'AppointmentID': 11 + i, 'Time': f"{10 + i:02d}:00"} for i in range(self.config['appointments'])],
+            }
+        if path.endswith('CancelAppointment'):
+            return {'success': True}
+        return None
+
+    def stats(self):
+        with self.lock:
+            return {'calls': dict(self.calls), 'errors': self.errors, 'stalls': self.stalls}
+
+
+def handler_for(platform):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def params(self, url):
+            params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            length = int(self.headers.get('Content-Length') or 0)
+            if length:
+                raw = self.rfile.read(length)
+                try:
+                    params.update(json.loads(raw))
+                except ValueError:
+                    pass
+            return params
+
+        def handle_request(self):
+            url = urlparse(self.path)
+            params = self.params(url)
+            if url.path == '/__stats':
+                self.send_json(200, platform.stats())
+                return
+
+            body = platform.body_for(url.path, params)
+            if body is None:
+                self.send_json(404, {'success': False, 'message': 'Unknown endpoint'})
+                return
+
+            outcome = platform.outcome()
+            platform.record(url.path, outcome)
+            if outcome == 'stall':
+                time.sleep(platform.config['stall_ms'] / 1000)
+            else:
+                time.sleep(platform.latency())
+            if outcome == 'error':
+                self.send_json(platform.config['error_status'], {'success': False, 'message': 'Injected error'})
+            else:
+                self.send_json(200, body)
+
+        do_GET = handle_request
+        do_POST = handle_request
+
+    return Handler
+
+
+def start(host='127.0.0.1', port=8081, seed=None, **config):
+    platform = Platform(seed=seed, **config)
+    server = ThreadingHTTPServer((host, port), handler_for(platform))
+    server.daemon_threads = True
+    server.platform = platform
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake booking platform for load tests.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--median-ms', type=float, default=DEFAULTS['median_ms'])
+    parser.add_argument('--p99-ms', type=float, default=DEFAULTS['p99_ms'])
+    parser.add_argument('--error-rate', type=float, default=DEFAULTS['error_rate'])
+    parser.add_argument('--error-status', type=int, default=DEFAULTS['error_status'])
+    parser.add_argument('--stall-rate', type=float, default=DEFAULTS['stall_rate'])
+    parser.add_argument('--stall-ms', type=float, default=DEFAULTS['stall_ms'])
+    parser.add_argument('--prices', type=int, default=DEFAULTS['prices'])
+    parser.add_argument('--appointments', type=int, default=DEFAULTS['appointments'])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    config = {key: value for key, value in vars(args).items() if key in DEFAULTS}
+    server = start(args.host, args.port, seed=args.seed, **config)
+    logging.info("Fake booking platform listening on http://%s:%s with %s", args.host, args.port, config)
+    try:
+        while True:
+            time.sleep(60)
+            logging.info("Stats: %s", server.platform.stats())
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
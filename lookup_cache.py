@@ -0,0 +1,188 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import booking_client
+import metrics
+from singleflight import SingleFlight
+
+# GetDataOfTBP answers (About us link, price list, booking link) change about
+# once a day, so they are served from memory. Entries older than ttl but
+# younger than ttl + stale_ttl are still returned immediately while a single
+# background refresh fetches a new copy. Concurrent misses for the same key
+# share one upstream request. Expired entries stay until they are evicted and
+# are served as a fallback when a reload fails; a cache without a stale window
+# (stale_ttl=0) never serves an expired entry.
+TBP_CACHE_TTL = float(os.environ.get('TBP_CACHE_TTL', 15 * 60))
+TBP_CACHE_STALE_TTL = float(os.environ.get('TBP_CACHE_STALE_TTL', 24 * 60 * 60))
+TBP_CACHE_MAX_ENTRIES = int(os.environ.get('TBP_CACHE_MAX_ENTRIES', 1024))
+# A user's appointment list for a day (GetAppointmentsWRTToDateAndCustomer),
+# kept briefly so a mistyped AppointmentID or a restarted cancel flow does not
+# fetch it again. Never served stale; the list is dropped when one of its
+# appointments is cancelled (cancel_jobs).
+APPOINTMENTS_CACHE_TTL = float(os.environ.get('APPOINTMENTS_CACHE_TTL', 5 * 60))
+APPOINTMENTS_CACHE_MAX_ENTRIES = int(os.environ.get('APPOINTMENTS_CACHE_MAX_ENTRIES', 10000))
+
+_reloading = threading.local()
+
+
+@contextmanager
+def reloading():
+    # Within this block get_or_load on the current thread always fetches a new
+    # copy, keeping the cached one if that fails. The warm-up job uses it to
+    # renew entries before they go stale.
+    _reloading.active = True
+    try:
+        yield
+    finally:
+        _reloading.active = False
+
+
+def is_cacheable(value):
+    if value is None:
+        return False
+    if isinstance(value, dict) and ('error' in value or value.get('success') is False):
+        return False
+    return True
+
+
+class TTLCache:
+    def __init__(self, ttl, stale_ttl=0, max_entries=1024, should_cache=is_cacheable):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.should_cache = should_cache
+        self.flight = SingleFlight()
+        self._entries = OrderedDict()  # key -> (value, stored_at)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.refresh_errors = 0
+        self.fallbacks = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[1] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        if not self.should_cache(value):
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_or_load(self, key, loader):
+        if getattr(_reloading, 'active', False):
+            return self.flight.do(key, lambda: self._load(key, loader))
+        refresh = False
+        with self._lock:
+            entry = self._entries.get(key)
+            age = time.monotonic() - entry[1] if entry is not None else None
+            if entry is not None and age < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None and age < self.ttl + self.stale_ttl:
+                self._entries.move_to_end(key)
+                self.stale_hits += 1
+                if key not in self._refreshing:
+                    self._refreshing.add(key)
+                    refresh = True
+            else:
+                entry = None
+                self.misses += 1
+
+        if entry is not None:
+            if refresh:
+                threading.Thread(target=self._refresh, args=(key, loader), daemon=True).start()
+            return entry[0]
+
+        if booking_client.prefetched.get() is not None:
+            # On asgi.py's event loop. Waiting on a thread's flight would block
+            # the loop, and asgi.fetch_once already shares the upstream call.
+            return self._load(key, loader)
+        return self.flight.do(key, lambda: self._load(key, loader))
+
+    def _load(self, key, loader):
+        value = loader()
+        if not self.should_cache(value):
+            # Upstream failed or the circuit is open: an old answer beats an error.
+            if not self.stale_ttl:
+                return value
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry is not None:
+                self.fallbacks += 1
+                return entry[0]
+            return value
+        self.set(key, value)
+        return value
+
+    def _refresh(self, key, loader):
+        try:
+            self.flight.do(key, lambda: self._load(key, loader))
+        except Exception as e:
+            self.refresh_errors += 1
+            logging.error("Background refresh failed for %s: %s", key, e)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def stats(self):
+        with self._lock:
+            size = len(self._entries)
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            'size': size,
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'refresh_errors': self.refresh_errors,
+            'coalesced': self.flight.coalesced,
+            'fallbacks': self.fallbacks,
+            'hit_rate': (self.hits + self.stale_hits) / lookups if lookups else 0.0,
+        }
+
+
+tbp_cache = TTLCache(TBP_CACHE_TTL, TBP_CACHE_STALE_TTL, TBP_CACHE_MAX_ENTRIES)
+appointments_cache = TTLCache(APPOINTMENTS_CACHE_TTL, 0, APPOINTMENTS_CACHE_MAX_ENTRIES)
+
+CACHES = {'tbp': tbp_cache, 'appointments': appointments_cache}
+
+
+@metrics.register
+def cache_metrics():
+    samples = []
+    for name, cache in CACHES.items():
+        stats = cache.stats()
+        labels = {'cache': name}
+        samples += [('lookup_cache_entries', labels, stats['size']),
+                    ('lookup_cache_hit_rate', labels, stats['hit_rate'])] + \
+                   [(f'lookup_cache_{counter}_total', labels, stats[counter])
+                    for counter in ('hits', 'stale_hits', 'misses', 'evictions', 'refresh_errors', 'coalesced', 'fallbacks')]
+    return samples
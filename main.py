@@ -1,15 +1,25 @@
 from flask import Flask, request, jsonify
-from twilio.twiml.messaging_response import MessagingResponse
 import logging
 import random
-import re
 import requests
-from tenacity import retry, stop_after_attempt, wait_fixed
+import booking_client
+import lookup_cache
+import resilience
+import async_reply
+import idempotency
+import metrics
+import structured_logging
+import session_store
+import intent_matcher
+import twiml_cache
 
 # Configure logging
-logging.basicConfig(filename='chatbot_log.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+structured_logging.configure('chatbot_log.log', level=logging.INFO)
 
 app = Flask(__name__)
+metrics.install(app)
+structured_logging.install(app)
+resilience.install(app)
 
 # Constants
 COMPANY_DETAILS = {
@@ -98,112 +108,118 @@ COMMON_RESPONSES = {
 }
 
 # Session management functions
+SESSIONS = session_store.create_store()
+metrics.gauge('bot_active_sessions', SESSIONS.count, 'Users with an unexpired session.', store='session')
+
 def get_session_data(session_id):
-    if not hasattr(get_session_data, 'sessions'):
-        get_session_data.sessions = {}
-    return get_session_data.sessions.setdefault(session_id, {})
+    return SESSIONS.get(session_id)
 
 def save_session_data(session_id, data):
-    get_session_data.sessions[session_id] = data
+    SESSIONS.save(session_id, data)
 
-@retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
 def fetch_company_details(company_id, option_id, date=None, email=None):
     if option_id == '4':
-        url = 'https://test.yourbookingplatform.com/Appointment/GetAppointmentsWRTToDateAndCustomer'
+        path = booking_client.APPOINTMENTS_PATH
         data = {
             'date': date,
             'email': email,
             'company_id': company_id
         }
-    else:
-        url = 'https://test.yourbookingplatform.com/Appointment/GetDataOfTBP'
-        data = {
-            'company_id': company_id,
-            'option_id': option_id
-        }
+        return post_booking_request(path, data)
+
+    path = booking_client.TBP_PATH
+    data = {
+        'company_id': company_id,
+        'option_id': option_id
+    }
+    return lookup_cache.tbp_cache.get_or_load((company_id, option_id), lambda: post_booking_request(path, data))
 
+def post_booking_request(path, data):
     try:
-        logging.debug(f"Sending POST request to {url} with data: {data}")
-        response = requests.post(url, json=data, proxies={"http": None, "https": None})
+        logging.debug("Sending POST request to %s with data: %s", path, data)
+        response = booking_client.post(path, json=data)
         response.raise_for_status()  # This will raise an HTTPError for bad responses
         response_json = response.json()
-        logging.debug(f"Received response: {response_json}")
+        logging.debug("Received response: %s", response_json)
         return response_json
     except requests.exceptions.HTTPError as http_err:
-        logging.error(f"HTTP error occurred: {http_err}")
+        logging.error("HTTP error occurred: %s", http_err)
     except requests.exceptions.RequestException as e:
-        logging.error(f"Request error occurred: {e}")
+        logging.error("Request error occurred: %s", e)
     return {"error": "Unable to fetch data at this time. Please try again later."}
 
-def generate_smart_response(message):
-    # Basic pattern matching for smart responses
-    if re.search(r'\bprice(?:s)?\b', message):
-        return "Our prices vary depending on the service. You can visit our website for detailed pricing information or let me know which specific service you’re interested in."
-    elif re.search(r'\bbook(?:ing)?|appointment\b', message):
-        return "You can book an appointment online through our website. Would you like me to guide you through the process?"
-    else:
-        return None
+# Basic pattern matching for smart responses
+SMART_RESPONSES = {
+    r'\bprice(?:s)?\b': "Our prices vary depending on the service. You can visit our website for detailed pricing information or let me know which specific service you’re interested in.",
+    r'\bbook(?:ing)?|appointment\b': "You can book an appointment online through our website. Would you like me to guide you through the process?"
+}
+
+# Keyword rules in the order the webhook checks them; the first one that matches wins.
+INTENTS = intent_matcher.IntentMatcher(
+    [('smart', intent_matcher.PATTERN, pattern) for pattern in SMART_RESPONSES]
+    + [('common', intent_matcher.SUBSTRING, keyword) for keyword in COMMON_RESPONSES]
+    + [('menu', intent_matcher.EXACT, command) for command in ['menu', 'start', 'main menu']]
+)
+
+# Static replies are serialized to TwiML once, at import.
+TWIML = twiml_cache.TwiMLCache()
+TWIML.prerender([WELCOME_MENU]
+                + list(COMPANY_MENUS.values())
+                + [details for options in COMPANY_DATA.values() for details in options.values()]
+                + list(SMART_RESPONSES.values())
+                + [reply for replies in COMMON_RESPONSES.values() for reply in replies])
 
 @app.route('/webhook', methods=['POST'])
+@idempotency.once
+@async_reply.deferred
 def webhook():
     incoming_msg = request.values.get('Body', '').strip().lower()
     from_number = request.values.get('From', '')
     session_id = from_number
     session_data = get_session_data(session_id)
-    response = MessagingResponse()
-    msg = response.message()
 
-    logging.info(f"Incoming message: {incoming_msg}")
+    logging.info("Incoming message: %s", incoming_msg)
+
+    intent, keyword = INTENTS.match(incoming_msg)
+    metrics.tag(intent=intent or 'text')
 
     # Handle smart responses
-    smart_response = generate_smart_response(incoming_msg)
-    if smart_response:
-        msg.body(smart_response)
-        return str(response)
+    if intent == 'smart':
+        return TWIML.reply(SMART_RESPONSES[keyword])
 
     # Check if the message matches any common response keywords
-    for keyword, responses in COMMON_RESPONSES.items():
-        if keyword in incoming_msg:
-            msg.body(random.choice(responses))
-            return str(response)
+    if intent == 'common':
+        return TWIML.reply(random.choice(COMMON_RESPONSES[keyword]))
 
     # Main menu logic
-    if incoming_msg in ['menu', 'start', 'main menu']:
-        msg.body(WELCOME_MENU)
+    if intent == 'menu':
         session_data.clear()  # Clear the session to start fresh
         save_session_data(session_id, session_data)
-        return str(response)
+        return TWIML.reply(WELCOME_MENU)
 
     if not session_data:
         # User selects a company
         if incoming_msg in COMPANY_DETAILS:
             session_data['company_id'] = COMPANY_DETAILS[incoming_msg]['id']
             session_data['company_name'] = COMPANY_DETAILS[incoming_msg]['name']
-            msg.body(COMPANY_MENUS[incoming_msg])
             save_session_data(session_id, session_data)
-        else:
-            msg.body("Invalid option. Please select a valid company number or type 'menu' to see the options again.")
-        return str(response)
+            return TWIML.reply(COMPANY_MENUS[incoming_msg])
+        return TWIML.reply("Invalid option. Please select a valid company number or type 'menu' to see the options again.")
 
     if 'company_id' in session_data:
         company_id = session_data['company_id']
         company_menu = COMPANY_MENUS.get(str(company_id), WELCOME_MENU)
         if incoming_msg == '🔙':
-            msg.body(WELCOME_MENU)
             session_data.clear()
             save_session_data(session_id, session_data)
-            return str(response)
+            return TWIML.reply(WELCOME_MENU)
 
         if incoming_msg in ['1', '2', '3', '4']:
-            response_data = COMPANY_DATA[company_id].get(incoming_msg, "Sorry, I couldn't find that information.")
-            msg.body(response_data)
-        else:
-            msg.body(f"Invalid option. {company_menu}")
-        return str(response)
+            return TWIML.reply(COMPANY_DATA[company_id].get(incoming_msg, "Sorry, I couldn't find that information."))
+        return TWIML.reply(f"Invalid option. {company_menu}")
 
     # If no valid input was recognized, guide the user back to the main menu
-    msg.body("I didn't understand that. Please type 'menu' to see the options.")
-    return str(response)
+    return TWIML.reply("I didn't understand that. Please type 'menu' to see the options.")
 
 if __name__ == '__main__':
     app.run(debug=True)
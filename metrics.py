@@ -0,0 +1,181 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+from flask import Response, g, has_request_context, request
+
+# Prometheus-style metrics. Counters and histograms are sharded per thread:
+# a request only ever writes to its own thread's dicts, so recording needs no
+# lock, and /metrics adds the shards together when it is scraped. Values that
+# already live elsewhere (cache stats, breaker state, session counts) are read
+# at scrape time through registered collectors instead of being duplicated.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Scrapes and health probes are not webhook traffic.
+UNTRACKED_ROUTES = {'/metrics', '/healthz', '/ready'}
+
+_local = threading.local()
+_shards = []  # (thread, counters, histograms)
+_shards_lock = threading.Lock()
+# Totals of shards whose threads have exited.
+_retired_counters = {}
+_retired_histograms = {}
+
+_descriptions = {}
+_collectors = []
+
+
+def describe(name, kind, help_text):
+    _descriptions[name] = (kind, help_text)
+
+
+def _shard():
+    shard = getattr(_local, 'shard', None)
+    if shard is None:
+        shard = _local.shard = ({}, {})
+        with _shards_lock:
+            _shards.append((threading.current_thread(), shard[0], shard[1]))
+    return shard
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, amount=1, **labels):
+    counters = _shard()[0]
+    key = _key(name, labels)
+    counters[key] = counters.get(key, 0) + amount
+
+
+def observe(name, value, **labels):
+    histograms = _shard()[1]
+    key = _key(name, labels)
+    series = histograms.get(key)
+    if series is None:
+        # One count per bucket, one for +Inf, then the sum of observed values.
+        series = histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+    series[bisect_left(BUCKETS, value)] += 1
+    series[-1] += value
+
+
+def register(collector):
+    # collector() returns an iterable of (name, labels, value) samples.
+    _collectors.append(collector)
+    return collector
+
+
+def gauge(name, fn, help_text='', **labels):
+    if help_text:
+        describe(name, 'gauge', help_text)
+    register(lambda: [(name, labels, fn())])
+
+
+def _merge(counters, histograms, shard_counters, shard_histograms):
+    for key, value in shard_counters.items():
+        counters[key] = counters.get(key, 0) + value
+    for key, series in shard_histograms.items():
+        total = histograms.get(key)
+        if total is None:
+            histograms[key] = list(series)
+        else:
+            for i, value in enumerate(series):
+                total[i] += value
+
+
+def snapshot():
+    counters, histograms = {}, {}
+    with _shards_lock:
+        live = []
+        for thread, shard_counters, shard_histograms in _shards:
+            if thread.is_alive():
+                live.append((thread, shard_counters, shard_histograms))
+            else:
+                _merge(_retired_counters, _retired_histograms, shard_counters, shard_histograms)
+        _shards[:] = live
+        _merge(counters, histograms, _retired_counters, _retired_histograms)
+    for _, shard_counters, shard_histograms in live:
+        # dict.copy() does not let the owning thread in half way through.
+        _merge(counters, histograms, shard_counters.copy(),
+               {key: list(series) for key, series in shard_histograms.copy().items()})
+    return counters, histograms
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _header(lines, name, default_kind):
+    kind, help_text = _descriptions.get(name, (default_kind, ''))
+    if help_text:
+        lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {kind}")
+
+
+def render():
+    counters, histograms = snapshot()
+    samples = {}
+    for (name, labels), value in counters.items():
+        samples.setdefault(name, []).append((labels, value))
+    for collector in list(_collectors):
+        try:
+            for name, labels, value in collector():
+                samples.setdefault(name, []).append((tuple(sorted(labels.items())), value))
+        except Exception as e:
+            logging.error("Metrics collector %s failed: %s", collector, e)
+
+    lines = []
+    for name in sorted(samples):
+        _header(lines, name, 'counter' if name.endswith('_total') else 'gauge')
+        for labels, value in sorted(samples[name]):
+            lines.append(f"{name}{_labels(labels)} {value}")
+
+    by_name = {}
+    for (name, labels), series in histograms.items():
+        by_name.setdefault(name, []).append((labels, series))
+    for name in sorted(by_name):
+        _header(lines, name, 'histogram')
+        for labels, series in sorted(by_name[name]):
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), series):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {series[-1]}")
+            lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+    return '\n'.join(lines) + '\n'
+
+
+def tag(**labels):
+    # Adds labels (tenant, intent) to the current request's latency series.
+    if has_request_context():
+        g.metric_labels = dict(getattr(g, 'metric_labels', {}), **labels)
+
+
+describe('bot_requests_total', 'counter', 'Webhook requests by route and status.')
+describe('bot_request_duration_seconds', 'histogram', 'Webhook latency by route, tenant and intent.')
+
+
+def _start_timer():
+    g.metric_started = time.perf_counter()
+
+
+def _record_request(response):
+    started = getattr(g, 'metric_started', None)
+    if started is None:
+        return response
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    if route in UNTRACKED_ROUTES:
+        return response
+    inc('bot_requests_total', route=route, status=str(response.status_code))
+    observe('bot_request_duration_seconds', time.perf_counter() - started, route=route, **getattr(g, 'metric_labels', {}))
+    return response
+
+
+def install(app):
+    app.before_request(_start_timer)
+    app.after_request(_record_request)
+    app.add_url_rule('/metrics', 'metrics', lambda: Response(render(), content_type=CONTENT_TYPE), methods=['GET'])
@@ -33,33 +33,33 @@ def test_pricing_api():
         response = requests.post(PRICING_API, json=pricing_payload)
         response.raise_for_status()
         data = response.json()
-        logging.info(f"Pricing API Response: {data}")
+        logging.info("Pricing API Response: %s", data)
     except requests.exceptions.HTTPError as http_err:
-        logging.error(f"HTTP error occurred: {http_err}")
+        logging.error("HTTP error occurred: %s", http_err)
     except Exception as err:
-        logging.error(f"Other error occurred: {err}")
+        logging.error("Other error occurred: %s", err)
 
 def test_appointment_api():
     try:
         response = requests.post(APPOINTMENT_API, json=appointment_payload)
         response.raise_for_status()
         data = response.json()
-        logging.info(f"Appointment API Response: {data}")
+        logging.info("Appointment API Response: %s", data)
     except requests.exceptions.HTTPError as http_err:
-        logging.error(f"HTTP error occurred: {http_err}")
+        logging.error("HTTP error occurred: %s", http_err)
     except Exception as err:
-        logging.error(f"Other error occurred: {err}")
+        logging.error("Other error occurred: %s", err)
 
 def test_cancel_appointment_api():
     try:
         response = requests.post(CANCEL_APPOINTMENT_API, json=cancel_appointment_payload)
         response.raise_for_status()
         data = response.json()
-        logging.info(f"Cancel Appointment API Response: {data}")
+        logging.info("Cancel Appointment API Response: %s", data)
     except requests.exceptions.HTTPError as http_err:
-        logging.error(f"HTTP error occurred: {http_err}")
+        logging.error("HTTP error occurred: %s", http_err)
     except Exception as err:
-        logging.error(f"Other error occurred: {err}")
+        logging.error("Other error occurred: %s", err)
 
 if __name__ == "__main__":
     logging.info("Testing Pricing API...")
@@ -0,0 +1,170 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+# Users' opt-ins (whatsapp.PREFERENCES: daily tips, appointment reminders,
+# promotional offers), stored per phone number in SQLite so they outlive the
+# conversation session. One row per (phone, preference) records the tenant
+# the user was talking to when they opted in. The (preference, phone) and
+# (tenant, preference, phone) indexes turn "who wants X (at salon Y)"
+# broadcast queries into range scans in phone order. Lookups on the request
+# path go through an in-process LRU cache. Entries expire after
+# PREFERENCE_CACHE_TTL seconds so another worker's changes show up, and a
+# worker's own writes drop its cached copy straight away. A read that overlaps
+# a write in this process is not cached, since it may have seen the old rows.
+PREFERENCE_DB_PATH = os.environ.get('PREFERENCE_DB_PATH', 'preferences.db')
+PREFERENCE_CACHE_TTL = float(os.environ.get('PREFERENCE_CACHE_TTL', 30))
+PREFERENCE_CACHE_SIZE = int(os.environ.get('PREFERENCE_CACHE_SIZE', 10000))
+
+NO_TENANT = 0
+# Stays under SQLite's default limit on bound parameters.
+QUERY_CHUNK = 500
+
+
+class PreferenceStore:
+    def __init__(self, path=PREFERENCE_DB_PATH, cache_ttl=PREFERENCE_CACHE_TTL, cache_size=PREFERENCE_CACHE_SIZE):
+        self.path = path
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self._local = threading.local()
+        self._cache = OrderedDict()  # phone -> (preferences, cached_at)
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS preferences ("
+                     "phone TEXT NOT NULL, preference TEXT NOT NULL, tenant INTEGER NOT NULL, updated_at REAL NOT NULL, "
+                     "PRIMARY KEY (phone, preference)) WITHOUT ROWID")
+        conn.execute("CREATE INDEX IF NOT EXISTS preferences_by_preference ON preferences (preference, phone)")
+        conn.execute("CREATE INDEX IF NOT EXISTS preferences_by_tenant ON preferences (tenant, preference, phone)")
+
+    def _conn(self):
+        # Per thread and per process, as in session_store.SQLiteSessionStore.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _cached(self, phone, now):
+        entry = self._cache.get(phone)
+        if entry is not None and now - entry[1] < self.cache_ttl:
+            self._cache.move_to_end(phone)
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        return None
+
+    def _remember(self, phone, preferences, now, writes):
+        with self._lock:
+            if self._writes != writes:
+                return
+            self._cache[phone] = (preferences, now)
+            self._cache.move_to_end(phone)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _forget(self, phone):
+        with self._lock:
+            self._writes += 1
+            self._cache.pop(phone, None)
+
+    def get(self, phone):
+        now = time.monotonic()
+        with self._lock:
+            preferences = self._cached(phone, now)
+            writes = self._writes
+        if preferences is not None:
+            return preferences
+        preferences = frozenset(row[0] for row in self._conn().execute("SELECT preference FROM preferences WHERE phone = ?", (phone,)))
+        self._remember(phone, preferences, now, writes)
+        return preferences
+
+    def get_many(self, phones):
+        now = time.monotonic()
+        found, missing = {}, []
+        with self._lock:
+            for phone in phones:
+                preferences = self._cached(phone, now)
+                if preferences is None:
+                    missing.append(phone)
+                else:
+                    found[phone] = preferences
+            writes = self._writes
+        for start in range(0, len(missing), QUERY_CHUNK):
+            chunk = missing[start:start + QUERY_CHUNK]
+            loaded = {phone: set() for phone in chunk}
+            rows = self._conn().execute(f"SELECT phone, preference FROM preferences WHERE phone IN ({','.join('?' * len(chunk))})", chunk)
+            for phone, preference in rows:
+                loaded[phone].add(preference)
+            for phone, preferences in loaded.items():
+                found[phone] = frozenset(preferences)
+                self._remember(phone, found[phone], now, writes)
+        return found
+
+    def add(self, phone, preference, tenant=None):
+        self._conn().execute("INSERT INTO preferences (phone, preference, tenant, updated_at) VALUES (?, ?, ?, ?) "
+                             "ON CONFLICT (phone, preference) DO UPDATE SET tenant = excluded.tenant, updated_at = excluded.updated_at",
+                             (phone, preference, tenant or NO_TENANT, time.time()))
+        self._forget(phone)
+
+    def remove(self, phone, preference):
+        self._conn().execute("DELETE FROM preferences WHERE phone = ? AND preference = ?", (phone, preference))
+        self._forget(phone)
+
+    def audience(self, preference, tenant=None, after='', limit=1000):
+        # Phones opted into `preference` (at `tenant`, if given) after `after`,
+        # in phone order: page through with after=<last phone returned>.
+        if tenant is None:
+            rows = self._conn().execute("SELECT phone FROM preferences WHERE preference = ? AND phone > ? ORDER BY phone LIMIT ?",
+                                        (preference, after, limit))
+        else:
+            rows = self._conn().execute("SELECT phone FROM preferences WHERE tenant = ? AND preference = ? AND phone > ? "
+                                        "ORDER BY phone LIMIT ?", (tenant, preference, after, limit))
+        return [row[0] for row in rows]
+
+    def counts(self, tenant=None):
+        if tenant is None:
+            rows = self._conn().execute("SELECT preference, COUNT(*) FROM preferences GROUP BY preference")
+        else:
+            rows = self._conn().execute("SELECT preference, COUNT(*) FROM preferences WHERE tenant = ? GROUP BY preference", (tenant,))
+        return dict(rows.fetchall())
+
+    def stats(self):
+        with self._lock:
+            size = len(self._cache)
+        lookups = self.hits + self.misses
+        return {'cached': size, 'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = PreferenceStore()
+    return _store
+
+
+@metrics.register
+def preference_metrics():
+    if _store is None:
+        return []
+    stats = _store.stats()
+    return [('preference_cache_entries', {}, stats['cached']),
+            ('preference_cache_hit_rate', {}, stats['hit_rate']),
+            ('preference_cache_hits_total', {}, stats['hits']),
+            ('preference_cache_misses_total', {}, stats['misses'])] + \
+           [('preference_subscribers', {'preference': preference}, count) for preference, count in _store.counts().items()]
@@ -0,0 +1,69 @@
+import os
+import threading
+
+# Price lists are sent one page per message: Twilio rejects message bodies
+# over 1600 characters, which a salon with a long service list easily
+# exceeds. The formatted lines are joined once per page (linear in the number
+# of services) and the rendered pages are cached per company until the
+# booking platform hands out a new price list (a new object from tbp_cache).
+# A list that fits on one page is rendered exactly as before. While pages
+# remain, the sender's conversation is in the 'more_prices' option and "more"
+# sends the next one.
+PRICE_PAGE_LIMIT = int(os.environ.get('PRICE_PAGE_LIMIT', 1600))
+
+
+class PriceList:
+    def __init__(self, header, line, footer, more, limit=PRICE_PAGE_LIMIT):
+        # line is formatted with each price dict; more ends every page but the
+        # last and is formatted with page and pages.
+        self.header = header
+        self.line = line
+        self.footer = footer
+        self.more = more
+        self.limit = limit
+        self._pages = {}  # company_id -> (prices, pages)
+        self._lock = threading.Lock()
+
+    def render(self, prices):
+        lines = [self.line.format_map(price) for price in prices]
+        if len(self.header) + sum(map(len, lines)) + len(self.footer) <= self.limit:
+            return [''.join([self.header] + lines + [self.footer])]
+
+        room = self.limit - len(self.header) - max(len(self.footer), len(self.more.format(page=999, pages=999)))
+        chunks, chunk, size = [], [], 0
+        for text in lines:
+            # A single line longer than a page still gets a page of its own.
+            if chunk and size + len(text) > room:
+                chunks.append(chunk)
+                chunk, size = [], 0
+            chunk.append(text)
+            size += len(text)
+        chunks.append(chunk)
+        return [''.join([self.header] + chunk + [self.footer if number == len(chunks) else self.more.format(page=number, pages=len(chunks))])
+                for number, chunk in enumerate(chunks, 1)]
+
+    def pages(self, company_id, prices):
+        with self._lock:
+            cached = self._pages.get(company_id)
+        if cached is not None and cached[0] is prices:
+            return cached[1]
+        pages = self.render(prices)
+        with self._lock:
+            self._pages[company_id] = (prices, pages)
+        return pages
+
+    def page(self, company_id, prices, number):
+        # Returns the page's text and the page count.
+        pages = self.pages(company_id, prices)
+        return pages[min(max(number, 1), len(pages)) - 1], len(pages)
+
+    def reply(self, conversations, sender, company_id, prices, more=False):
+        # The first page, or with more=True the one after the page last sent;
+        # conversations is a session_store.Conversations.
+        number = conversations.get(sender).get('price_page', 1) if more else 1
+        text, pages = self.page(company_id, prices, number)
+        if number < pages:
+            conversations.save(sender, {'pending_option': 'more_prices', 'price_page': number + 1})
+        elif number > 1:
+            conversations.set_pending_option(sender, None)
+        return text
@@ -0,0 +1,56 @@
+import json
+import logging
+import threading
+from flask import Response
+
+# Liveness and readiness probes for the load balancer / orchestrator.
+# /healthz answers as soon as the worker can serve a request at all; /ready
+# answers 503 until every registered check passes (the warm-up pass over the
+# booking platform lookups, typically), so a freshly started or restarted
+# worker is only sent traffic once its first replies will come from cache.
+_checks = {}
+_lock = threading.Lock()
+
+
+def register(name, check):
+    # check() returns True once that part of the worker is ready.
+    with _lock:
+        _checks[name] = check
+    return check
+
+
+class Flag:
+    def __init__(self):
+        self._event = threading.Event()
+
+    def set(self):
+        self._event.set()
+
+    def clear(self):
+        self._event.clear()
+
+    def __call__(self):
+        return self._event.is_set()
+
+
+def status():
+    with _lock:
+        checks = dict(_checks)
+    results = {}
+    for name, check in checks.items():
+        try:
+            results[name] = bool(check())
+        except Exception as e:
+            logging.error("Readiness check %s failed: %s", name, e)
+            results[name] = False
+    return all(results.values()), results
+
+
+def _ready():
+    ready, results = status()
+    return Response(json.dumps({'ready': ready, 'checks': results}), status=200 if ready else 503, mimetype='application/json')
+
+
+def install(app):
+    app.add_url_rule('/healthz', 'healthz', lambda: Response('ok', mimetype='text/plain'), methods=['GET'])
+    app.add_url_rule('/ready', 'ready', _ready, methods=['GET'])
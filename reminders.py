@@ -0,0 +1,398 @@
+import datetime
+import json
+import logging
+import os
+import signal
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from zoneinfo import ZoneInfo
+
+import async_reply
+import booking_client
+import metrics
+import structured_logging
+
+# Appointment reminders for users who opted in through whatsapp.py (preference
+# '2' or the "reminder" flow). The booking platform has no bulk "upcoming
+# appointments" call, so a sync pass asks GetAppointmentsWRTToDateAndCustomer
+# for each subscriber's email, company and day in the reminder horizon, a few
+# requests at a time. Every appointment becomes one row in a SQLite queue with
+# a partial index on the send time of pending rows. Rows due within the next
+# LOAD_WINDOW seconds are loaded into an in-memory hierarchical timing wheel,
+# which hands each one to a bounded pool of senders in the second it is due,
+# so a tick costs the same however many reminders are queued. Runs as its own
+# process next to the web workers:
+#
+#   python reminders.py
+REMINDER_DB_PATH = os.environ.get('REMINDER_DB_PATH', 'reminders.db')
+REMINDER_LEAD_TIME = float(os.environ.get('REMINDER_LEAD_TIME', 24 * 60 * 60))
+REMINDER_HORIZON_DAYS = int(os.environ.get('REMINDER_HORIZON_DAYS', 1))
+REMINDER_SYNC_INTERVAL = float(os.environ.get('REMINDER_SYNC_INTERVAL', 15 * 60))
+REMINDER_SYNC_CONCURRENCY = int(os.environ.get('REMINDER_SYNC_CONCURRENCY', 4))
+REMINDER_SEND_CONCURRENCY = int(os.environ.get('REMINDER_SEND_CONCURRENCY', 8))
+REMINDER_MAX_ATTEMPTS = int(os.environ.get('REMINDER_MAX_ATTEMPTS', 5))
+# Appointment times from the booking platform are the salons' local time.
+REMINDER_TIMEZONE = ZoneInfo(os.environ.get('REMINDER_TIMEZONE', 'Europe/Amsterdam'))
+# The WhatsApp/SMS number reminders are sent from.
+REMINDER_FROM = os.environ.get('REMINDER_FROM', '')
+
+LOAD_WINDOW = 60 * 60
+LOAD_INTERVAL = 60
+
+REMINDER_TEXT = "🔔 Reminder: you have an appointment at {company} on {date} at {time}. See you there!"
+
+metrics.describe('reminders_sent_total', 'counter', 'Appointment reminders by result.')
+metrics.describe('reminder_sync_requests_total', 'counter', 'Appointment lookups made by the reminder sync, by result.')
+
+
+class ReminderQueue:
+    def __init__(self, path=REMINDER_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS subscribers ("
+                     "sender TEXT PRIMARY KEY, email TEXT NOT NULL, companies TEXT NOT NULL, subscribed_at REAL NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS reminders ("
+                     "sender TEXT NOT NULL, appointment_id TEXT NOT NULL, company_id INTEGER NOT NULL, "
+                     "appointment_at REAL NOT NULL, send_at REAL NOT NULL, body TEXT NOT NULL, "
+                     "status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, "
+                     "PRIMARY KEY (sender, appointment_id))")
+        # Only pending rows are ever looked up by time, and they are the few.
+        conn.execute("CREATE INDEX IF NOT EXISTS reminders_due ON reminders (send_at) WHERE status = 'pending'")
+
+    def _conn(self):
+        # Per thread and per process, as in session_store.SQLiteSessionStore.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def subscribe(self, sender, email, companies):
+        # companies: {company_id: name} to look the subscriber's appointments up at.
+        self._conn().execute("INSERT OR REPLACE INTO subscribers (sender, email, companies, subscribed_at) VALUES (?, ?, ?, ?)",
+                             (sender, email, json.dumps(companies), time.time()))
+
+    def unsubscribe(self, sender):
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN")
+            conn.execute("DELETE FROM subscribers WHERE sender = ?", (sender,))
+            conn.execute("DELETE FROM reminders WHERE sender = ? AND status = 'pending'", (sender,))
+
+    def subscriber(self, sender):
+        row = self._conn().execute("SELECT email, companies FROM subscribers WHERE sender = ?", (sender,)).fetchone()
+        if row is None:
+            return None
+        return {'sender': sender, 'email': row[0], 'companies': {int(k): v for k, v in json.loads(row[1]).items()}}
+
+    def subscribers(self, batch_size=1000):
+        # Keyset pagination, so a large table is never held in memory at once.
+        last = ''
+        while True:
+            rows = self._conn().execute("SELECT sender, email, companies FROM subscribers WHERE sender > ? ORDER BY sender LIMIT ?",
+                                        (last, batch_size)).fetchall()
+            for sender, email, companies in rows:
+                yield {'sender': sender, 'email': email, 'companies': {int(k): v for k, v in json.loads(companies).items()}}
+            if len(rows) < batch_size:
+                return
+            last = rows[-1][0]
+
+    def replace_day(self, sender, company_id, day_start, day_end, reminders):
+        # Makes the reminders of one subscriber, company and day match the
+        # appointments the booking platform returned: new ones are added and
+        # cancelled pending ones dropped. A moved appointment gets a fresh
+        # reminder for its new time, even if one went out for the old time.
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany("INSERT INTO reminders (sender, appointment_id, company_id, appointment_at, send_at, body) "
+                             "VALUES (?, ?, ?, ?, ?, ?) "
+                             "ON CONFLICT (sender, appointment_id) DO UPDATE SET "
+                             "appointment_at = excluded.appointment_at, send_at = excluded.send_at, body = excluded.body, "
+                             "status = 'pending', attempts = 0 "
+                             "WHERE appointment_at != excluded.appointment_at",
+                             [(sender, r['appointment_id'], company_id, r['appointment_at'], r['send_at'], r['body']) for r in reminders])
+            ids = [r['appointment_id'] for r in reminders]
+            conn.execute(f"DELETE FROM reminders WHERE sender = ? AND company_id = ? AND status = 'pending' "
+                         f"AND appointment_at >= ? AND appointment_at < ? AND appointment_id NOT IN ({','.join('?' * len(ids))})",
+                         [sender, company_id, day_start, day_end] + ids)
+
+    def due(self, before, limit=10000):
+        return self._conn().execute("SELECT sender, appointment_id, send_at FROM reminders "
+                                    "WHERE status = 'pending' AND send_at < ? ORDER BY send_at LIMIT ?", (before, limit)).fetchall()
+
+    def claim(self, sender, appointment_id, now):
+        # Moves a due reminder to 'sending' and returns it, or None when it was
+        # sent, dropped or rescheduled since it was loaded.
+        conn = self._conn()
+        cursor = conn.execute("UPDATE reminders SET status = 'sending', attempts = attempts + 1 "
+                              "WHERE sender = ? AND appointment_id = ? AND status = 'pending' AND send_at <= ?",
+                              (sender, appointment_id, now))
+        if cursor.rowcount == 0:
+            return None
+        return conn.execute("SELECT body, appointment_at, attempts FROM reminders WHERE sender = ? AND appointment_id = ?",
+                            (sender, appointment_id)).fetchone()
+
+    def finish(self, sender, appointment_id, status, send_at=None):
+        # Only while still 'sending': a row reset by replace_day in the
+        # meantime belongs to the appointment's new time.
+        if status == 'pending':
+            self._conn().execute("UPDATE reminders SET status = 'pending', send_at = ? "
+                                 "WHERE sender = ? AND appointment_id = ? AND status = 'sending'",
+                                 (send_at, sender, appointment_id))
+        else:
+            self._conn().execute("UPDATE reminders SET status = ? WHERE sender = ? AND appointment_id = ? AND status = 'sending'",
+                                 (status, sender, appointment_id))
+
+    def recover(self):
+        # Reminders a crashed process was sending go out again; a duplicate
+        # beats a missed appointment.
+        return self._conn().execute("UPDATE reminders SET status = 'pending' WHERE status = 'sending'").rowcount
+
+    def counts(self):
+        return dict(self._conn().execute("SELECT status, COUNT(*) FROM reminders GROUP BY status").fetchall())
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = ReminderQueue()
+    return _queue
+
+
+class TimingWheel:
+    # Levels of 60 one-second slots, 60 one-minute slots and 24 one-hour
+    # slots. An item is filed in the finest level whose span covers it; when
+    # the wheel reaches a minute or hour boundary the coarse slot for it is
+    # emptied into the finer levels, so each item is moved at most twice and
+    # a tick only ever looks at the one slot that is due.
+    LEVELS = ((1, 60), (60, 60), (3600, 24))
+    SPAN = 24 * 3600
+
+    def __init__(self, now):
+        self.tick = int(now)  # last second processed
+        self.slots = [[[] for _ in range(size)] for _, size in self.LEVELS]
+        self.size = 0
+
+    def _place(self, when, item, base):
+        delta = when - base
+        for level, (resolution, size) in enumerate(self.LEVELS):
+            if delta < resolution * size:
+                self.slots[level][(when // resolution) % size].append((when, item))
+                return
+        raise ValueError(f"{when} is more than {self.SPAN}s ahead of the wheel")
+
+    def add(self, when, item):
+        # Anything already due fires on the next tick.
+        base = self.tick + 1
+        self._place(max(int(when), base), item, base)
+        self.size += 1
+
+    def advance(self, now):
+        due = []
+        for t in range(self.tick + 1, int(now) + 1):
+            for level in (2, 1):
+                resolution, size = self.LEVELS[level]
+                if t % resolution == 0:
+                    slot = self.slots[level][(t // resolution) % size]
+                    self.slots[level][(t // resolution) % size] = []
+                    for when, item in slot:
+                        self._place(when, item, t)
+            slot = self.slots[0][t % 60]
+            if slot:
+                self.slots[0][t % 60] = []
+                due.extend(item for _, item in slot)
+            self.tick = t
+        self.size -= len(due)
+        return due
+
+
+def appointment_time(date, clock):
+    return datetime.datetime.strptime(f"{date} {clock}", '%Y-%m-%d %H:%M').replace(tzinfo=REMINDER_TIMEZONE).timestamp()
+
+
+def fetch_appointments(email, company_id, date):
+    try:
+        response = booking_client.post(booking_client.APPOINTMENTS_PATH, json={'date': date, 'email': email, 'company_id': company_id})
+        response.raise_for_status()
+        details = response.json()
+    except Exception as e:
+        metrics.inc('reminder_sync_requests_total', result='error')
+        logging.error("Fetching appointments of %s at %s on %s failed: %s", email, company_id, date, e)
+        return None
+    if not details.get('success'):
+        metrics.inc('reminder_sync_requests_total', result='error')
+        return None
+    metrics.inc('reminder_sync_requests_total', result='ok')
+    return details.get('listofAppointments', [])
+
+
+def sync_day(queue, subscriber, company_id, date, now):
+    appointments = fetch_appointments(subscriber['email'], company_id, date)
+    if appointments is None:
+        # Keep what is queued rather than dropping reminders on an outage.
+        return 0
+    reminders = []
+    for appointment in appointments:
+        try:
+            appointment_at = appointment_time(date, appointment['Time'])
+        except (KeyError, ValueError) as e:
+            logging.warning("Skipping appointment %s: %s", appointment.get('AppointmentID'), e)
+            continue
+        if appointment_at <= now:
+            continue
+        reminders.append({
+            'appointment_id': str(appointment['AppointmentID']),
+            'appointment_at': appointment_at,
+            'send_at': max(appointment_at - REMINDER_LEAD_TIME, now),
+            'body': REMINDER_TEXT.format(company=subscriber['companies'][company_id], date=date, time=appointment['Time']),
+        })
+    day_start = appointment_time(date, '00:00')
+    queue.replace_day(subscriber['sender'], company_id, day_start, day_start + 24 * 60 * 60, reminders)
+    return len(reminders)
+
+
+def sync(queue, now=None):
+    now = now or time.time()
+    today = datetime.datetime.fromtimestamp(now, REMINDER_TIMEZONE).date()
+    dates = [(today + datetime.timedelta(days=i)).isoformat() for i in range(REMINDER_HORIZON_DAYS + 1)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=REMINDER_SYNC_CONCURRENCY, thread_name_prefix='reminder-sync') as pool:
+        # Subscribers are streamed from the table, so submissions are bounded
+        # by waiting on each batch before taking the next one.
+        scheduled = 0
+        batch = []
+        for subscriber in queue.subscribers():
+            batch.extend(pool.submit(sync_day, queue, subscriber, company_id, date, now)
+                         for company_id in subscriber['companies'] for date in dates)
+            if len(batch) >= 1000:
+                scheduled += sum(future.result() for future in batch)
+                batch = []
+        scheduled += sum(future.result() for future in batch)
+    logging.info("Reminder sync: %d upcoming appointments in %.2fs", scheduled, time.perf_counter() - started)
+    return scheduled
+
+
+class ReminderScheduler:
+    def __init__(self, queue=None, client=None):
+        self.queue = queue or get_queue()
+        self.client = client or async_reply.get_outbound_client()
+        self.wheel = TimingWheel(time.time())
+        self.senders = ThreadPoolExecutor(max_workers=REMINDER_SEND_CONCURRENCY, thread_name_prefix='reminder-send')
+        self._loaded = {}  # (sender, appointment_id) -> send_at it was added to the wheel for
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        metrics.register(self.collect)
+
+    def load(self, now):
+        rows = self.queue.due(now + LOAD_WINDOW)
+        added = 0
+        with self._lock:
+            for sender, appointment_id, send_at in rows:
+                key = (sender, appointment_id)
+                # An appointment moved earlier gets a second, earlier entry;
+                # claim() turns away whichever one fires out of date.
+                loaded_at = self._loaded.get(key)
+                if loaded_at is None or send_at < loaded_at:
+                    self._loaded[key] = send_at
+                    self.wheel.add(send_at, key)
+                    added += 1
+        return added
+
+    def tick(self, now):
+        with self._lock:
+            due = self.wheel.advance(now)
+        for key in due:
+            self.senders.submit(self.send, key)
+        return len(due)
+
+    def send(self, key):
+        sender, appointment_id = key
+        try:
+            now = time.time()
+            claimed = self.queue.claim(sender, appointment_id, now + 1)
+            if claimed is None:
+                return
+            body, appointment_at, attempts = claimed
+            if appointment_at <= now:
+                self.queue.finish(sender, appointment_id, 'expired')
+                metrics.inc('reminders_sent_total', result='expired')
+                return
+            try:
+                self.client.send(to=sender, from_=REMINDER_FROM, body=body)
+            except Exception as e:
+                # Rate limits (429) and outages alike: back off and try again
+                # while the reminder is still useful.
+                retry_at = now + 60 * 2 ** attempts
+                if attempts >= REMINDER_MAX_ATTEMPTS or retry_at >= appointment_at:
+                    self.queue.finish(sender, appointment_id, 'failed')
+                    metrics.inc('reminders_sent_total', result='failed')
+                    logging.error("Reminder %s to %s failed for good: %s", appointment_id, sender, e)
+                else:
+                    self.queue.finish(sender, appointment_id, 'pending', send_at=retry_at)
+                    metrics.inc('reminders_sent_total', result='retry')
+                    logging.warning("Reminder %s to %s failed, retrying in %ds: %s", appointment_id, sender, retry_at - now, e)
+                return
+            self.queue.finish(sender, appointment_id, 'sent')
+            metrics.inc('reminders_sent_total', result='sent')
+        except Exception as e:
+            logging.exception("Sending reminder %s to %s failed: %s", appointment_id, sender, e)
+        finally:
+            with self._lock:
+                self._loaded.pop(key, None)
+
+    def collect(self):
+        counts = self.queue.counts()
+        return [('reminders_queued', {'status': status}, counts.get(status, 0)) for status in ('pending', 'sending', 'sent', 'failed', 'expired')] + \
+               [('reminder_wheel_entries', {}, self.wheel.size)]
+
+    def _sync_loop(self):
+        while not self._stop.is_set():
+            try:
+                sync(self.queue)
+            except Exception as e:
+                logging.exception("Reminder sync failed: %s", e)
+            self._stop.wait(REMINDER_SYNC_INTERVAL)
+
+    def run(self):
+        recovered = self.queue.recover()
+        if recovered:
+            logging.warning("Requeued %d reminders left in 'sending'", recovered)
+        threading.Thread(target=self._sync_loop, name='reminder-sync', daemon=True).start()
+        next_load = 0
+        while not self._stop.is_set():
+            now = time.time()
+            if now >= next_load:
+                self.load(now)
+                next_load = now + LOAD_INTERVAL
+            self.tick(now)
+            self._stop.wait(1 - now % 1)
+        self.senders.shutdown(wait=True)
+
+    def stop(self, *_):
+        self._stop.set()
+
+
+def main():
+    structured_logging.configure('reminders.log', level=logging.INFO)
+    scheduler = ReminderScheduler()
+    signal.signal(signal.SIGTERM, scheduler.stop)
+    signal.signal(signal.SIGINT, scheduler.stop)
+    logging.info("Reminder scheduler started")
+    scheduler.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+import logging
+import os
+import random
+import threading
+import time
+import requests
+
+import metrics
+
+# Twilio gives a webhook 15 seconds before it times out and retries, so all
+# booking-platform work for one inbound message has to fit in WEBHOOK_BUDGET.
+WEBHOOK_BUDGET = float(os.environ.get('WEBHOOK_BUDGET', 10))
+MIN_ATTEMPT_TIME = float(os.environ.get('BOOKING_MIN_ATTEMPT_TIME', 0.5))
+MAX_ATTEMPTS = int(os.environ.get('BOOKING_MAX_ATTEMPTS', 3))
+BACKOFF_BASE = float(os.environ.get('BOOKING_BACKOFF_BASE', 0.2))
+BACKOFF_MAX = float(os.environ.get('BOOKING_BACKOFF_MAX', 2))
+
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RESET_TIMEOUT = float(os.environ.get('BREAKER_RESET_TIMEOUT', 30))
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+_budget = threading.local()
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    pass
+
+
+class BudgetExceededError(requests.exceptions.Timeout):
+    pass
+
+
+def start_budget(seconds=None):
+    _budget.deadline = time.monotonic() + (seconds or WEBHOOK_BUDGET)
+
+
+def end_budget():
+    # Threads are reused (server threads, pools, cancel_jobs workers): a
+    # deadline left behind would cut short the next call made without one.
+    _budget.deadline = None
+
+
+def remaining():
+    deadline = getattr(_budget, 'deadline', None)
+    if deadline is None:
+        return WEBHOOK_BUDGET
+    return deadline - time.monotonic()
+
+
+def _start_request_budget():
+    start_budget()
+
+
+def _end_request_budget(error=None):
+    end_budget()
+
+
+def install(app):
+    # Every webhook request gets WEBHOOK_BUDGET seconds for its platform calls.
+    app.before_request(_start_request_budget)
+    app.teardown_request(_end_request_budget)
+
+
+def is_retryable(error):
+    if isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return error.response.status_code in RETRYABLE_STATUS
+    return False
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN and not self._probing:
+                # Let exactly one request through to test the platform.
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logging.warning("Circuit for %s opened after %s failures", self.name, self.failures)
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self._probing = False
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+retries = 0
+
+
+def get_breaker(name):
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(name, CircuitBreaker(name))
+    return breaker
+
+
+def breakers():
+    return dict(_breakers)
+
+
+BREAKER_STATES = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+
+
+@metrics.register
+def breaker_metrics():
+    return [('booking_circuit_state', {'endpoint': name}, BREAKER_STATES[breaker.state]) for name, breaker in breakers().items()]
+
+
+metrics.describe('booking_retries_total', 'counter', 'Booking platform calls retried after a transient failure.')
+metrics.describe('booking_circuit_state', 'gauge', 'Circuit breaker state: 0 closed, 1 half open, 2 open.')
+
+
+def backoff_delay(attempt):
+    # Full jitter: spread retries from many workers over the whole window.
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+
+def call(endpoint, fn, max_attempts=None):
+    global retries
+    breaker = get_breaker(endpoint)
+    max_attempts = max_attempts or MAX_ATTEMPTS
+    attempt = 0
+    while True:
+        time_left = remaining()
+        if time_left < MIN_ATTEMPT_TIME:
+            raise BudgetExceededError(f"Latency budget exhausted before calling {endpoint}")
+        if not breaker.allow():
+            raise CircuitOpenError(f"Circuit for {endpoint} is open")
+        try:
+            result = fn(time_left)
+        except Exception as e:
+            if not is_retryable(e):
+                # The platform answered, it just did not like the request.
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            attempt += 1
+            delay = backoff_delay(attempt)
+            if attempt >= max_attempts or remaining() - delay < MIN_ATTEMPT_TIME:
+                raise
+            retries += 1
+            metrics.inc('booking_retries_total', endpoint=endpoint)
+            logging.warning("Retrying %s in %.2fs after: %s", endpoint, delay, e)
+            time.sleep(delay)
+            continue
+        breaker.record_success()
+        return result
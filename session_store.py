@@ -0,0 +1,291 @@
+import abc
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+# Per-user conversation sessions. Every backend expires a session after
+# SESSION_TTL seconds without activity; the in-process backend also caps the
+# number of sessions and evicts the least recently used one. Use the sqlite
+# or redis backend when running more than one worker so a user's follow-up
+# finds their session on whichever worker receives it. REDIS_URL=local runs
+# the redis backend against an in-process stand-in, for tests only.
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'memory')
+SESSION_TTL = float(os.environ.get('SESSION_TTL', 30 * 60))
+SESSION_MAX_ENTRIES = int(os.environ.get('SESSION_MAX_ENTRIES', 10000))
+SESSION_DB_PATH = os.environ.get('SESSION_DB_PATH', 'sessions.db')
+REDIS_URL = os.environ.get('REDIS_URL', '')
+CONVERSATION_TTL = 10 * 60
+
+
+def _encode_default(value):
+    if isinstance(value, set):
+        return {'__set__': sorted(value)}
+    raise TypeError(f"Cannot store {type(value).__name__} in a session")
+
+
+def _decode_hook(value):
+    if '__set__' in value:
+        return set(value['__set__'])
+    return value
+
+
+def encode(data):
+    return json.dumps(data, default=_encode_default)
+
+
+def decode(text):
+    return json.loads(text, object_hook=_decode_hook)
+
+
+class SessionStore(abc.ABC):
+    # get returns a copy: changes only reach the store through save.
+    @abc.abstractmethod
+    def get(self, session_id):
+        pass
+
+    @abc.abstractmethod
+    def save(self, session_id, data):
+        pass
+
+    @abc.abstractmethod
+    def delete(self, session_id):
+        pass
+
+    @abc.abstractmethod
+    def count(self):
+        pass
+
+
+class MemorySessionStore(SessionStore):
+    def __init__(self, ttl=SESSION_TTL, max_entries=SESSION_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # Sessions are kept encoded, like the other backends store them.
+        self._sessions = OrderedDict()  # session_id -> (encoded data, last_seen)
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, session_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None or now - entry[1] >= self.ttl:
+                self._sessions.pop(session_id, None)
+                return {}
+            self._sessions[session_id] = (entry[0], now)
+            self._sessions.move_to_end(session_id)
+        return decode(entry[0])
+
+    def save(self, session_id, data):
+        if not data:
+            self.delete(session_id)
+            return
+        data = encode(data)
+        with self._lock:
+            self._sessions[session_id] = (data, time.monotonic())
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_entries:
+                self._sessions.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def count(self):
+        now = time.monotonic()
+        with self._lock:
+            while self._sessions:
+                session_id, (data, last_seen) = next(iter(self._sessions.items()))
+                if now - last_seen < self.ttl:
+                    break
+                self._sessions.popitem(last=False)
+            return len(self._sessions)
+
+
+class SQLiteSessionStore(SessionStore):
+    # File-based store shared by every worker process on the host. WAL mode
+    # lets readers and the single writer proceed concurrently.
+    PRUNE_EVERY = 500
+
+    def __init__(self, path=SESSION_DB_PATH, namespace='session', ttl=SESSION_TTL, max_entries=SESSION_MAX_ENTRIES):
+        self.path = path
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._saves = 0
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS sessions ("
+                     "namespace TEXT NOT NULL, session_id TEXT NOT NULL, data TEXT NOT NULL, expires_at REAL NOT NULL, "
+                     "PRIMARY KEY (namespace, session_id))")
+        conn.execute("CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (namespace, expires_at)")
+
+    def _conn(self):
+        # A connection opened before a fork (gunicorn preload_app) must not be
+        # used by the child, so connections are per thread and per process.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, session_id):
+        now = time.time()
+        row = self._conn().execute("SELECT data, expires_at FROM sessions WHERE namespace = ? AND session_id = ? AND expires_at > ?",
+                                   (self.namespace, session_id, now)).fetchone()
+        if row is None:
+            return {}
+        if row[1] - now < self.ttl * 0.9:
+            # Slide the idle timeout, but not on every single read.
+            self._conn().execute("UPDATE sessions SET expires_at = ? WHERE namespace = ? AND session_id = ?",
+                                 (now + self.ttl, self.namespace, session_id))
+        return decode(row[0])
+
+    def save(self, session_id, data):
+        if not data:
+            self.delete(session_id)
+            return
+        self._conn().execute("INSERT OR REPLACE INTO sessions (namespace, session_id, data, expires_at) VALUES (?, ?, ?, ?)",
+                             (self.namespace, session_id, encode(data), time.time() + self.ttl))
+        self._saves += 1
+        if self._saves % self.PRUNE_EVERY == 0:
+            self.prune()
+
+    def delete(self, session_id):
+        self._conn().execute("DELETE FROM sessions WHERE namespace = ? AND session_id = ?", (self.namespace, session_id))
+
+    def prune(self):
+        conn = self._conn()
+        conn.execute("DELETE FROM sessions WHERE namespace = ? AND expires_at <= ?", (self.namespace, time.time()))
+        # Sliding expiry means the earliest expires_at is the least recently used.
+        conn.execute("DELETE FROM sessions WHERE namespace = ? AND session_id IN ("
+                     "SELECT session_id FROM sessions WHERE namespace = ? ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                     (self.namespace, self.namespace, self.max_entries))
+
+    def count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM sessions WHERE namespace = ? AND expires_at > ?",
+                                    (self.namespace, time.time())).fetchone()[0]
+
+
+class RedisSessionStore(SessionStore):
+    # Works with any client speaking the redis-py API (get/set/delete/expire/
+    # scan_iter). Size is bounded on the server with maxmemory-policy allkeys-lru.
+    def __init__(self, client, namespace='session', ttl=SESSION_TTL):
+        self.client = client
+        self.prefix = f"{namespace}:"
+        self.ttl = int(ttl)
+
+    def get(self, session_id):
+        key = self.prefix + session_id
+        raw = self.client.get(key)
+        if raw is None:
+            return {}
+        self.client.expire(key, self.ttl)
+        return decode(raw.decode('utf-8') if isinstance(raw, bytes) else raw)
+
+    def save(self, session_id, data):
+        if not data:
+            self.delete(session_id)
+            return
+        self.client.set(self.prefix + session_id, encode(data), ex=self.ttl)
+
+    def delete(self, session_id):
+        self.client.delete(self.prefix + session_id)
+
+    def count(self):
+        return sum(1 for _ in self.client.scan_iter(match=self.prefix + '*'))
+
+
+class LocalRedis:
+    # Minimal in-process stand-in for a Redis server, for tests and local runs.
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def _alive(self, key):
+        entry = self._data.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+            del self._data[key]
+            return None
+        return entry
+
+    def get(self, key):
+        with self._lock:
+            entry = self._alive(key)
+            return entry[0].encode('utf-8') if entry is not None else None
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ex if ex else None)
+        return True
+
+    def delete(self, *keys):
+        with self._lock:
+            return sum(1 for key in keys if self._data.pop(key, None) is not None)
+
+    def expire(self, key, seconds):
+        with self._lock:
+            entry = self._alive(key)
+            if entry is None:
+                return False
+            self._data[key] = (entry[0], time.monotonic() + seconds)
+            return True
+
+    def scan_iter(self, match='*'):
+        prefix = match.rstrip('*')
+        with self._lock:
+            keys = [key for key in list(self._data) if key.startswith(prefix) and self._alive(key) is not None]
+        return iter(keys)
+
+
+def redis_client(url=REDIS_URL):
+    if url == 'local':
+        return LocalRedis()
+    if not url:
+        # An in-process fallback would give each gunicorn worker its own
+        # sessions, which is what the redis backend is there to avoid.
+        raise ValueError("SESSION_BACKEND=redis needs REDIS_URL")
+    import redis
+    return redis.Redis.from_url(url)
+
+
+def create_store(namespace='session', backend=None, ttl=SESSION_TTL):
+    backend = backend or SESSION_BACKEND
+    if backend == 'sqlite':
+        return SQLiteSessionStore(namespace=namespace, ttl=ttl)
+    if backend == 'redis':
+        return RedisSessionStore(redis_client(), namespace=namespace, ttl=ttl)
+    if backend != 'memory':
+        logging.warning("Unknown SESSION_BACKEND %r, using memory", backend)
+    return MemorySessionStore(ttl=ttl)
+
+
+class Conversations:
+    # Menu state of the SMS bots (app, final, working, update_bot), kept per
+    # sender so one user's "4" does not put every other user into the
+    # cancellation branch.
+    def __init__(self, namespace, ttl=CONVERSATION_TTL):
+        self.store = create_store(namespace=namespace, ttl=ttl)
+        metrics.gauge('bot_active_sessions', self.store.count, 'Senders with unexpired conversation state.', store=namespace)
+
+    def get(self, sender):
+        return self.store.get(sender or '')
+
+    def save(self, sender, data):
+        self.store.save(sender or '', data)
+
+    def pending_option(self, sender):
+        return self.get(sender).get('pending_option')
+
+    def set_pending_option(self, sender, pending_option):
+        self.save(sender, {'pending_option': pending_option} if pending_option else {})
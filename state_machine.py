@@ -0,0 +1,59 @@
+# Declarative conversation routing. Handlers are registered per state for an
+# intent (resolved by intent_matcher), for literal message text such as menu
+# digits, or as the state's catch-all. Registrations are compiled into dict
+# lookups keyed by (state, intent) and (state, text), so routing a message
+# costs a few dict probes over the short list of states the session is in.
+
+
+class Turn:
+    def __init__(self, session_id, session, message, intent=None, keyword=None):
+        self.session_id = session_id
+        self.session = session
+        self.message = message
+        self.intent = intent
+        self.keyword = keyword
+
+
+class StateMachine:
+    def __init__(self):
+        self._intents = {}
+        self._texts = {}
+        self._otherwise = {}
+
+    def on_intent(self, state, *intents):
+        def register(handler):
+            for intent in intents:
+                self._intents[(state, intent)] = handler
+            return handler
+        return register
+
+    def on_text(self, state, *texts):
+        def register(handler):
+            for text in texts:
+                self._texts[(state, text)] = handler
+            return handler
+        return register
+
+    def otherwise(self, state):
+        def register(handler):
+            self._otherwise[state] = handler
+            return handler
+        return register
+
+    def resolve(self, states, turn):
+        for state in states:
+            if turn.intent is not None:
+                handler = self._intents.get((state, turn.intent))
+            else:
+                handler = self._texts.get((state, turn.message))
+            if handler is None:
+                handler = self._otherwise.get(state)
+            if handler is not None:
+                return handler
+        return None
+
+    def dispatch(self, states, turn):
+        handler = self.resolve(states, turn)
+        if handler is None:
+            return None
+        return handler(turn)
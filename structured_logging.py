@@ -0,0 +1,151 @@
+import atexit
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import uuid
+from flask import g, has_request_context, request
+
+# Log records are handed to a queue on the request thread and formatted and
+# written to disk by a QueueListener thread, so file I/O and JSON encoding stay
+# off the request path. Each line is a JSON object carrying the request id
+# (Twilio MessageSid, X-Request-Id or a generated one) and the tenant/intent
+# the handler tagged with metrics.tag(). LOG_FORMAT=text keeps the old
+# plain-text layout.
+#
+# Files rotate by size, or by time with LOG_ROTATION=time. A process rotates
+# only its own file, so forked workers (gunicorn) each write to a file named
+# after their pid, e.g. log.1234.log. With LOG_ROTATION=external all processes
+# share one file, reopened after something like logrotate has moved it.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', '')
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+LOG_ROTATION = os.environ.get('LOG_ROTATION', 'size')
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', 5))
+LOG_ROTATE_WHEN = os.environ.get('LOG_ROTATE_WHEN', 'midnight')
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+CONTEXT_FIELDS = ('request_id', 'tenant', 'intent')
+
+_listener = None
+_queue_handler = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class RequestContextFilter(logging.Filter):
+    # Runs on the calling thread, where the Flask request is still available.
+    def filter(self, record):
+        if has_request_context():
+            record.request_id = getattr(g, 'request_id', None)
+            labels = getattr(g, 'metric_labels', {})
+            record.tenant = labels.get('tenant')
+            record.intent = labels.get('intent')
+        return True
+
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    # The stock prepare() runs the formatter on the calling thread. Only the
+    # message arguments are merged here; the listener's handler does the rest.
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def _assign_request_id():
+    g.request_id = (request.values.get('MessageSid') or request.headers.get('X-Request-Id') or uuid.uuid4().hex)
+
+
+def file_handler(filename):
+    if LOG_ROTATION == 'external':
+        return logging.handlers.WatchedFileHandler(filename, encoding='utf-8')
+    if LOG_ROTATION == 'time':
+        return logging.handlers.TimedRotatingFileHandler(filename, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+    return logging.handlers.RotatingFileHandler(filename, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+
+
+def configure(filename, level=logging.INFO):
+    global _listener, _queue_handler
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL.upper() or level)
+    if _listener is not None:
+        return
+
+    handler = file_handler(filename)
+    handler.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else logging.Formatter(TEXT_FORMAT))
+    log_queue = queue.SimpleQueue()
+    _queue_handler = RecordQueueHandler(log_queue)
+    _queue_handler.addFilter(RequestContextFilter())
+    root.addHandler(_queue_handler)
+
+    _listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+
+
+@atexit.register
+def shutdown():
+    # Flushes whatever is still queued and closes the log file.
+    global _listener, _queue_handler
+    if _listener is None:
+        return
+    logging.getLogger().removeHandler(_queue_handler)
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = _queue_handler = None
+
+
+def worker_filename(filename, pid):
+    root, ext = os.path.splitext(filename)
+    return f'{root}.{pid}{ext}'
+
+
+def _restart_listener():
+    # Only the forking thread survives a fork, so a worker forked from a
+    # preloaded gunicorn master needs its own listener. The copied one still
+    # points at the parent's thread, and the copied queue holds records the
+    # parent will write itself, so both are replaced.
+    global _listener
+    if _listener is None:
+        return
+    handlers = []
+    for handler in _listener.handlers:
+        if isinstance(handler, logging.handlers.WatchedFileHandler):
+            handlers.append(handler)
+            continue
+        # Two processes rotating the same file rename it under each other.
+        handler.close()
+        worker_handler = file_handler(worker_filename(handler.baseFilename, os.getpid()))
+        worker_handler.setFormatter(handler.formatter)
+        handlers.append(worker_handler)
+    log_queue = queue.SimpleQueue()
+    _queue_handler.queue = log_queue
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+os.register_at_fork(after_in_child=_restart_listener)
+
+
+def install(app):
+    app.before_request(_assign_request_id)
@@ -0,0 +1,55 @@
+import threading
+from collections import OrderedDict
+from flask import Response
+from twilio.twiml.messaging_response import MessagingResponse
+
+# Most replies are fixed strings (menus, FAQ answers, greeting pools), so their
+# TwiML documents are serialized once at startup and served as bytes. Other
+# replies are rendered on demand; up to `memoize` of them are kept as well.
+TWIML_MIMETYPE = 'application/xml'
+
+
+def render(text):
+    response = MessagingResponse()
+    response.message().body(text)
+    return str(response).encode('utf-8')
+
+
+class TwiMLCache:
+    def __init__(self, memoize=256):
+        self.memoize = memoize
+        self._static = {}
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def prerender(self, texts):
+        for text in texts:
+            self._static[text] = render(text)
+
+    def document(self, text):
+        document = self._static.get(text)
+        if document is None and self.memoize:
+            with self._lock:
+                document = self._recent.get(text)
+                if document is not None:
+                    self._recent.move_to_end(text)
+        if document is not None:
+            self.hits += 1
+            return document
+
+        self.misses += 1
+        document = render(text)
+        if self.memoize:
+            with self._lock:
+                self._recent[text] = document
+                while len(self._recent) > self.memoize:
+                    self._recent.popitem(last=False)
+        return document
+
+    def reply(self, text):
+        return Response(self.document(text), mimetype=TWIML_MIMETYPE)
+
+    def stats(self):
+        return {'static': len(self._static), 'memoized': len(self._recent), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,103 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import lookup_cache
+import metrics
+
+# Prefetches the GetDataOfTBP answers (About us, prices, booking link) of every
+# company a bot serves, so the first user after a deploy or restart is not the
+# one paying for the upstream round trip. A pass runs at startup and then
+# every WARMUP_INTERVAL seconds, a little before the cached entries reach
+# TBP_CACHE_TTL, so they are renewed rather than left to go stale. Lookups run
+# WARMUP_CONCURRENCY at a time to keep the booking platform from seeing a
+# burst from every worker at once. WARMUP_INTERVAL=0 only warms at startup.
+WARMUP_CONCURRENCY = int(os.environ.get('WARMUP_CONCURRENCY', 4))
+WARMUP_INTERVAL = float(os.environ.get('WARMUP_INTERVAL', lookup_cache.TBP_CACHE_TTL * 0.8))
+WARMUP_OPTIONS = ('1', '2', '3')
+
+_stop = threading.Event()
+last_run = {}
+
+metrics.describe('cache_warmup_runs_total', 'counter', 'Warm-up passes over the booking platform lookups.')
+metrics.describe('cache_warmup_lookups_total', 'counter', 'Warm-up lookups by result.')
+
+
+def cache_lookups(module):
+    # The lookups a bot module makes through tbp_cache, as zero-argument
+    # callables: every company in COMPANY_DETAILS for the multi-company bots,
+    # COMPANY_ID for the /sms bots.
+    if hasattr(module, 'fetch_company_details'):
+        return [partial(module.fetch_company_details, details['id'], option_id)
+                for details in module.COMPANY_DETAILS.values() for option_id in WARMUP_OPTIONS]
+    if hasattr(module, 'fetch_details'):
+        return [partial(module.fetch_details, option_id) for option_id in WARMUP_OPTIONS]
+    return []
+
+
+def _load(lookup):
+    # True when the cache holds an answer afterwards, new or kept from before.
+    try:
+        with lookup_cache.reloading():
+            return lookup_cache.is_cacheable(lookup())
+    except Exception as e:
+        logging.error("Warm-up lookup %s failed: %s", lookup.args, e)
+        return False
+
+
+def run(lookups, concurrency=WARMUP_CONCURRENCY):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix='warm-up') as pool:
+        results = list(pool.map(_load, lookups))
+    duration = time.perf_counter() - started
+    loaded = sum(results)
+    failed = len(results) - loaded
+
+    metrics.inc('cache_warmup_runs_total')
+    metrics.inc('cache_warmup_lookups_total', loaded, result='loaded')
+    metrics.inc('cache_warmup_lookups_total', failed, result='failed')
+    last_run.update(duration=duration, loaded=loaded, failed=failed, finished_at=time.time())
+    log = logging.warning if failed else logging.info
+    log("Cache warm-up: %d lookups loaded, %d failed in %.2fs", loaded, failed, duration)
+    return last_run
+
+
+def _loop(lookups, on_ready):
+    try:
+        run(lookups)
+    finally:
+        # A failed lookup is not retried before reporting ready: the booking
+        # platform being down should not keep the worker out of rotation, the
+        # handlers already fall back to an apology for that case.
+        if on_ready is not None:
+            on_ready()
+    if WARMUP_INTERVAL <= 0:
+        return
+    while not _stop.wait(WARMUP_INTERVAL):
+        try:
+            run(lookups)
+        except Exception as e:
+            logging.error("Cache warm-up failed: %s", e)
+
+
+def start(lookups, on_ready=None):
+    _stop.clear()
+    thread = threading.Thread(target=_loop, args=(lookups, on_ready), name='warm-up', daemon=True)
+    thread.start()
+    return thread
+
+
+def stop():
+    _stop.set()
+
+
+@metrics.register
+def warmup_metrics():
+    if not last_run:
+        return []
+    return [('cache_warmup_last_duration_seconds', {}, last_run['duration']),
+            ('cache_warmup_last_failed', {}, last_run['failed']),
+            ('cache_warmup_last_finished_timestamp_seconds', {}, last_run['finished_at'])]
@@ -1,16 +1,30 @@
 from flask import Flask, request, jsonify
-from twilio.twiml.messaging_response import MessagingResponse
 import logging
 import random
 import re
 import requests
-from tenacity import retry, stop_after_attempt, wait_fixed
 from datetime import datetime
+import booking_client
+import lookup_cache
+import resilience
+import async_reply
+import idempotency
+import metrics
+import structured_logging
+import session_store
+import intent_matcher
+import state_machine
+import twiml_cache
+import reminders
+import preference_store
 
 # Configure logging
-logging.basicConfig(filename='log.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+structured_logging.configure('log.log', level=logging.INFO)
 
 app = Flask(__name__)
+metrics.install(app)
+structured_logging.install(app)
+resilience.install(app)
 
 # Constants
 COMPANY_DETAILS = {
@@ -79,12 +93,7 @@ FAQ_RESPONSES = {
     'services': "💇 We offer a variety of beauty services including haircuts, facials, and more. Let us know what you need!"
 }
 
-DAILY_TIPS = [
-    "💡 Tip: Drink plenty of water to stay hydrated and keep your skin glowing!",
-    "💡 Tip: Regular exercise can help maintain your overall health and well-being.",
-    "💡 Tip: Always remove your makeup before going to bed to prevent skin issues."
-]
-
+# Opt-ins are stored per phone number in preference_store, not in the session.
 PREFERENCES = {
     '1': 'Receive daily tips',
     '2': 'Receive appointment reminders',
@@ -92,236 +101,300 @@ PREFERENCES = {
 }
 
 # User session management
+SESSIONS = session_store.create_store()
+metrics.gauge('bot_active_sessions', SESSIONS.count, 'Users with an unexpired session.', store='session')
+
 def get_session_data(session_id):
-    if not hasattr(get_session_data, 'sessions'):
-        get_session_data.sessions = {}
-    return get_session_data.sessions.setdefault(session_id, {})
+    return SESSIONS.get(session_id)
 
 def save_session_data(session_id, data):
-    get_session_data.sessions[session_id] = data
+    SESSIONS.save(session_id, data)
 
-@retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
 def fetch_company_details(company_id, option_id, date=None, email=None):
     if option_id == '4':
-        url = 'https://test.yourbookingplatform.com/Appointment/GetAppointmentsWRTToDateAndCustomer'
+        path = booking_client.APPOINTMENTS_PATH
         data = {
             'date': date,
             'email': email,
             'company_id': company_id
         }
-    else:
-        url = 'https://test.yourbookingplatform.com/Appointment/GetDataOfTBP'
-        data = {
-            'company_id': company_id,
-            'option_id': option_id
-        }
+        return post_booking_request(path, data)
+
+    path = booking_client.TBP_PATH
+    data = {
+        'company_id': company_id,
+        'option_id': option_id
+    }
+    return lookup_cache.tbp_cache.get_or_load((company_id, option_id), lambda: post_booking_request(path, data))
 
+def post_booking_request(path, data):
     try:
-        logging.debug(f"Sending POST request to {url} with data: {data}")
-        response = requests.post(url, json=data, proxies={"http": None, "https": None})
+        logging.debug("Sending POST request to %s with data: %s", path, data)
+        response = booking_client.post(path, json=data)
         response.raise_for_status()
         response_json = response.json()
-        logging.debug(f"Received response: {response_json}")
+        logging.debug("Received response: %s", response_json)
         return response_json
     except requests.exceptions.RequestException as e:
-        logging.error(f"Request error occurred: {e}")
+        logging.error("Request error occurred: %s", e)
     return {"error": "Unable to fetch data at this time. Please try again later."}
 
-def generate_smart_response(message):
-    if re.search(r'\bprice(?:s)?\b', message):
-        return "💲 Our prices vary depending on the service. You can visit our website for detailed pricing information or let me know which specific service you’re interested in. 🖥️"
-    elif re.search(r'\bbook(?:ing)?|appointment\b', message):
-        return "📅 You can book an appointment online through our website. Would you like me to guide you through the process? 📝"
-    else:
-        return None
+SMART_RESPONSES = {
+    r'\bprice(?:s)?\b': "💲 Our prices vary depending on the service. You can visit our website for detailed pricing information or let me know which specific service you’re interested in. 🖥️",
+    r'\bbook(?:ing)?|appointment\b': "📅 You can book an appointment online through our website. Would you like me to guide you through the process? 📝"
+}
+
+# Keyword rules in the order the webhook checks them; the first one that matches wins.
+INTENTS = intent_matcher.IntentMatcher(
+    [('preferences', intent_matcher.PREFIX, 'preferences'),
+     ('set_preferences', intent_matcher.EXACT, 'set preferences')]
+    + [('faq', intent_matcher.EXACT, question) for question in FAQ_RESPONSES]
+    + [('smart', intent_matcher.PATTERN, pattern) for pattern in SMART_RESPONSES]
+    + [('common', intent_matcher.SUBSTRING, keyword) for keyword in COMMON_RESPONSES]
+    + [('menu', intent_matcher.EXACT, command) for command in ['menu', 'start', 'main menu']]
+    + [(command, intent_matcher.EXACT, command) for command in ['help', 'feedback', 'poll', 'reminder', 'bye']]
+)
+
+POLL_PROMPT = "🗳️ **Poll**: What feature would you like to see next?\n1️⃣ New Services\n2️⃣ Special Offers\n3️⃣ Loyalty Programs"
+REMINDER_PROMPT = "🔔 **Reminder**: Would you like to set a reminder for your upcoming appointments?\n1️⃣ Yes\n2️⃣ No"
+COMPANY_MENUS_BY_ID = {details['id']: COMPANY_MENUS[key] for key, details in COMPANY_DETAILS.items()}
+
+# Conversation state machine. A session is in every state whose flag it
+# carries; states are consulted in this order and the first handler wins.
+MACHINE = state_machine.StateMachine()
 
-def get_daily_tip():
-    return random.choice(DAILY_TIPS)
+FLAG_STATES = [
+    ('awaiting_post_exit_response', 'awaiting_post_exit'),
+    ('awaiting_reminder_response', 'awaiting_reminder'),
+    ('awaiting_poll_response', 'awaiting_poll')
+]
+
+def active_states(session_data):
+    states = ['preferences']
+    if 'awaiting_preference_response' in session_data:
+        states.append('awaiting_preference')
+    if 'awaiting_reminder_email' in session_data:
+        states.append('awaiting_reminder_email')
+    states.append('commands')
+    states.extend(state for flag, state in FLAG_STATES if flag in session_data)
+    if not session_data:
+        states.append('new')
+    if 'company_id' in session_data:
+        states.append('company')
+    states.append('fallback')
+    return states
+
+# Reminders are looked up by the email address appointments are booked under,
+# which the conversation does not otherwise ask for. Preference '2' is only
+# recorded once that address is known, so 'preferences' never shows reminders
+# as on while nothing would be sent.
+REMINDER_EMAIL_PROMPT = "📧 To turn on appointment reminders, please reply with the email address you book your appointments with."
+EMAIL = re.compile(r'\A[^@\s]+@[^@\s]+\.[^@\s]+\Z')
+
+def reminder_opt_in(turn):
+    # True when reminders are on; otherwise the session waits for the email.
+    if reminders.get_queue().subscriber(turn.session_id) is None:
+        turn.session['awaiting_reminder_email'] = True
+        return False
+    preference_store.get_store().add(turn.session_id, '2', tenant=turn.session.get('company_id'))
+    return True
+
+# Handle user preferences
+@MACHINE.on_intent('preferences', 'preferences')
+def show_preferences(turn):
+    preferences = preference_store.get_store().get(turn.session_id)
+    if preferences:
+        return f"Your current preferences are: {', '.join(PREFERENCES[p] for p in sorted(preferences))}"
+    return "You haven't set any preferences yet. Type 'set preferences' to choose your preferences."
+
+@MACHINE.on_intent('preferences', 'set_preferences')
+def ask_preferences(turn):
+    turn.session['awaiting_preference_response'] = True
+    save_session_data(turn.session_id, turn.session)
+    return ("Please select your preferences by typing the corresponding number:\n"
+            "1️⃣ Receive daily tips\n"
+            "2️⃣ Receive appointment reminders\n"
+            "3️⃣ Receive promotional offers")
+
+@MACHINE.otherwise('awaiting_preference')
+def add_preference(turn):
+    if turn.message not in PREFERENCES:
+        return "❗ Invalid preference option. Please choose a valid option or type 'set preferences' to try again."
+    turn.session.pop('awaiting_preference_response', None)
+    if turn.message == '2':
+        added = reminder_opt_in(turn)
+    else:
+        preference_store.get_store().add(turn.session_id, turn.message, tenant=turn.session.get('company_id'))
+        added = True
+    save_session_data(turn.session_id, turn.session)
+    if not added:
+        return REMINDER_EMAIL_PROMPT
+    return f"Preference '{PREFERENCES[turn.message]}' added. Type 'preferences' to see your current preferences or 'set preferences' to add more."
+
+# Handle FAQ, smart and common keyword responses
+@MACHINE.on_intent('commands', 'faq')
+def faq_reply(turn):
+    return FAQ_RESPONSES[turn.keyword]
+
+@MACHINE.on_intent('commands', 'smart')
+def smart_reply(turn):
+    return SMART_RESPONSES[turn.keyword]
+
+@MACHINE.on_intent('commands', 'common')
+def common_reply(turn):
+    return random.choice(COMMON_RESPONSES[turn.keyword])
+
+# Main menu logic
+@MACHINE.on_intent('commands', 'menu')
+def main_menu(turn):
+    turn.session.clear()  # Clear the session to start fresh
+    save_session_data(turn.session_id, turn.session)
+    return WELCOME_MENU
+
+@MACHINE.on_intent('commands', 'help')
+def help_reply(turn):
+    return COMMON_RESPONSES['help'][0]
+
+@MACHINE.on_intent('commands', 'feedback')
+def feedback_reply(turn):
+    return random.choice(FEEDBACK_RESPONSES)
+
+@MACHINE.on_intent('commands', 'poll')
+def start_poll(turn):
+    turn.session['awaiting_poll_response'] = True
+    save_session_data(turn.session_id, turn.session)
+    return POLL_PROMPT
+
+@MACHINE.on_intent('commands', 'reminder')
+def start_reminder(turn):
+    turn.session['awaiting_reminder_response'] = True
+    save_session_data(turn.session_id, turn.session)
+    return REMINDER_PROMPT
+
+@MACHINE.on_intent('commands', 'bye')
+def say_bye(turn):
+    turn.session['awaiting_post_exit_response'] = True
+    save_session_data(turn.session_id, turn.session)
+    return "Goodbye! Before you go, would you like to:\n1️⃣ Provide Feedback\n2️⃣ Participate in a Poll\n3️⃣ Set a Reminder\n\nReply with the number of your choice or 'No' to exit."
+
+# Handle feedback, poll, and reminder choices after "bye"
+POST_EXIT_REPLIES = {'2': POLL_PROMPT, '3': REMINDER_PROMPT}
+
+@MACHINE.on_text('awaiting_post_exit', '1', '2', '3')
+def post_exit_choice(turn):
+    turn.session.pop('awaiting_post_exit_response', None)
+    save_session_data(turn.session_id, turn.session)
+    return POST_EXIT_REPLIES.get(turn.message) or random.choice(FEEDBACK_RESPONSES)
+
+@MACHINE.on_text('awaiting_post_exit', 'no')
+def post_exit_no(turn):
+    turn.session.clear()
+    save_session_data(turn.session_id, turn.session)
+    return "Thank you for using our service. Have a great day! 🌟"
+
+# Handle reminder responses
+@MACHINE.on_text('awaiting_reminder', '1')
+def reminder_yes(turn):
+    turn.session.pop('awaiting_reminder_response', None)
+    subscribed = reminder_opt_in(turn)
+    save_session_data(turn.session_id, turn.session)
+    if not subscribed:
+        return REMINDER_EMAIL_PROMPT
+    return "🔔 **Reminder**: You will receive reminders for your upcoming appointments."
+
+@MACHINE.on_text('awaiting_reminder', '2')
+def reminder_no(turn):
+    preference_store.get_store().remove(turn.session_id, '2')
+    turn.session.pop('awaiting_reminder_response', None)
+    turn.session.pop('awaiting_reminder_email', None)
+    save_session_data(turn.session_id, turn.session)
+    reminders.get_queue().unsubscribe(turn.session_id)
+    return "You will not receive appointment reminders."
+
+@MACHINE.otherwise('awaiting_reminder_email')
+def reminder_email(turn):
+    if not EMAIL.match(turn.message):
+        # Anything else leaves the flow and is routed as usual.
+        turn.session.pop('awaiting_reminder_email', None)
+        save_session_data(turn.session_id, turn.session)
+        return MACHINE.dispatch(active_states(turn.session), turn)
+    # Without a salon picked, appointments are looked up at every salon.
+    if 'company_id' in turn.session:
+        companies = {turn.session['company_id']: turn.session['company_name']}
+    else:
+        companies = {details['id']: details['name'] for details in COMPANY_DETAILS.values()}
+    reminders.get_queue().subscribe(turn.session_id, turn.message, companies)
+    preference_store.get_store().add(turn.session_id, '2', tenant=turn.session.get('company_id'))
+    turn.session.pop('awaiting_reminder_email', None)
+    save_session_data(turn.session_id, turn.session)
+    return f"✅ Thanks! We'll remind you ahead of appointments booked with {turn.message}."
+
+# Handle poll responses
+@MACHINE.otherwise('awaiting_poll')
+def poll_answer(turn):
+    turn.session.pop('awaiting_poll_response', None)
+    save_session_data(turn.session_id, turn.session)
+    return "Thank you for participating in the poll!"
+
+# User selects a company
+@MACHINE.otherwise('new')
+def select_company(turn):
+    if turn.message not in COMPANY_DETAILS:
+        return "❗ Invalid option. Please select a valid company number or type 'menu' to see the options again. 🔄"
+    turn.session['company_id'] = COMPANY_DETAILS[turn.message]['id']
+    turn.session['company_name'] = COMPANY_DETAILS[turn.message]['name']
+    save_session_data(turn.session_id, turn.session)
+    return COMPANY_MENUS[turn.message]
+
+@MACHINE.on_text('company', '🔙')
+def back_to_main_menu(turn):
+    turn.session.clear()  # Clear session to start fresh
+    save_session_data(turn.session_id, turn.session)
+    return WELCOME_MENU
+
+@MACHINE.on_text('company', '0')
+def company_menu(turn):
+    # Return to company-specific menu
+    return COMPANY_MENUS_BY_ID.get(turn.session['company_id'], "⚠️ Error: Company menu not found. Please select your company again. 🔄")
+
+@MACHINE.on_text('company', '1', '2', '3', '4')
+def company_option(turn):
+    response_data = fetch_company_details(turn.session['company_id'], turn.message)
+    if response_data and 'error' not in response_data:
+        return DEFAULT_RESPONSES[turn.message]
+    return "⚠️ Error fetching details. Please try again later. 🔄"
+
+@MACHINE.otherwise('fallback')
+def not_understood(turn):
+    return "❓ Sorry, I didn’t understand that. Type 'Help' for assistance. 🤔"
+
+# Static replies are serialized to TwiML once, at import.
+TWIML = twiml_cache.TwiMLCache()
+TWIML.prerender([WELCOME_MENU, POLL_PROMPT, REMINDER_PROMPT]
+                + list(COMPANY_MENUS.values())
+                + list(DEFAULT_RESPONSES.values())
+                + list(FAQ_RESPONSES.values())
+                + list(SMART_RESPONSES.values())
+                + [reply for replies in COMMON_RESPONSES.values() for reply in replies]
+                + FEEDBACK_RESPONSES)
+
+def reply_for(session_id, incoming_msg):
+    session_data = get_session_data(session_id)
+    intent, keyword = INTENTS.match(incoming_msg)
+    metrics.tag(intent=intent or 'text')
+    turn = state_machine.Turn(session_id, session_data, incoming_msg, intent, keyword)
+    return MACHINE.dispatch(active_states(session_data), turn)
 
 @app.route('/webhook', methods=['POST'])
+@idempotency.once
+@async_reply.deferred
 def webhook():
     incoming_msg = request.values.get('Body', '').strip().lower()
     from_number = request.values.get('From', '')
-    session_id = from_number
-    session_data = get_session_data(session_id)
-    response = MessagingResponse()
-    msg = response.message()
-
-    logging.info(f"Incoming message: {incoming_msg}")
-
-    # Handle user preferences
-    if incoming_msg.startswith('preferences'):
-        if 'preferences' in session_data:
-            preferences = session_data['preferences']
-            msg.body(f"Your current preferences are: {', '.join(PREFERENCES[p] for p in preferences)}")
-        else:
-            msg.body("You haven't set any preferences yet. Type 'set preferences' to choose your preferences.")
-        return str(response)
-
-    if incoming_msg == 'set preferences':
-        msg.body("Please select your preferences by typing the corresponding number:\n"
-                 "1️⃣ Receive daily tips\n"
-                 "2️⃣ Receive appointment reminders\n"
-                 "3️⃣ Receive promotional offers")
-        session_data['awaiting_preference_response'] = True
-        save_session_data(session_id, session_data)
-        return str(response)
-
-    if 'awaiting_preference_response' in session_data:
-        if incoming_msg in PREFERENCES:
-            preferences = session_data.get('preferences', set())
-            preferences.add(incoming_msg)
-            session_data['preferences'] = preferences
-            msg.body(f"Preference '{PREFERENCES[incoming_msg]}' added. Type 'preferences' to see your current preferences or 'set preferences' to add more.")
-            session_data.pop('awaiting_preference_response', None)
-            save_session_data(session_id, session_data)
-        else:
-            msg.body("❗ Invalid preference option. Please choose a valid option or type 'set preferences' to try again.")
-        return str(response)
-
-    # Handle FAQ responses
-    if incoming_msg in FAQ_RESPONSES:
-        msg.body(FAQ_RESPONSES[incoming_msg])
-        return str(response)
-
-    # Handle smart responses
-    smart_response = generate_smart_response(incoming_msg)
-    if smart_response:
-        msg.body(smart_response)
-        return str(response)
-
-    # Check if the message matches any common response keywords
-    for keyword, responses in COMMON_RESPONSES.items():
-        if keyword in incoming_msg:
-            msg.body(random.choice(responses))
-            return str(response)
-
-    # Main menu logic
-    if incoming_msg in ['menu', 'start', 'main menu']:
-        msg.body(WELCOME_MENU)
-        session_data.clear()  # Clear the session to start fresh
-        save_session_data(session_id, session_data)
-        return str(response)
-
-    if incoming_msg == 'help':
-        msg.body(COMMON_RESPONSES['help'][0])
-        return str(response)
-
-    if incoming_msg == 'feedback':
-        msg.body(random.choice(FEEDBACK_RESPONSES))
-        return str(response)
-
-    if incoming_msg == 'poll':
-        # Provide poll options here
-        msg.body("🗳️ **Poll**: What feature would you like to see next?\n1️⃣ New Services\n2️⃣ Special Offers\n3️⃣ Loyalty Programs")
-        session_data['awaiting_poll_response'] = True
-        save_session_data(session_id, session_data)
-        return str(response)
-
-    if incoming_msg == 'reminder':
-        # Provide reminder options here
-        msg.body("🔔 **Reminder**: Would you like to set a reminder for your upcoming appointments?\n1️⃣ Yes\n2️⃣ No")
-        session_data['awaiting_reminder_response'] = True
-        save_session_data(session_id, session_data)
-        return str(response)
-
-    if incoming_msg == 'bye':
-        msg.body("Goodbye! Before you go, would you like to:\n1️⃣ Provide Feedback\n2️⃣ Participate in a Poll\n3️⃣ Set a Reminder\n\nReply with the number of your choice or 'No' to exit.")
-        session_data['awaiting_post_exit_response'] = True
-        save_session_data(session_id, session_data)
-        return str(response)
-
-    # Handle feedback, poll, and reminder choices after "bye"
-    if 'awaiting_post_exit_response' in session_data:
-        if incoming_msg == '1':
-            msg.body(random.choice(FEEDBACK_RESPONSES))
-            session_data.pop('awaiting_post_exit_response', None)
-            save_session_data(session_id, session_data)
-            return str(response)
-        elif incoming_msg == '2':
-            msg.body("🗳️ **Poll**: What feature would you like to see next?\n1️⃣ New Services\n2️⃣ Special Offers\n3️⃣ Loyalty Programs")
-            session_data.pop('awaiting_post_exit_response', None)
-            save_session_data(session_id, session_data)
-            return str(response)
-        elif incoming_msg == '3':
-            msg.body("🔔 **Reminder**: Would you like to set a reminder for your upcoming appointments?\n1️⃣ Yes\n2️⃣ No")
-            session_data.pop('awaiting_post_exit_response', None)
-            save_session_data(session_id, session_data)
-            return str(response)
-        elif incoming_msg == 'no':
-            msg.body("Thank you for using our service. Have a great day! 🌟")
-            session_data.clear()
-            save_session_data(session_id, session_data)
-            return str(response)
-
-    # Handle reminder responses
-    if 'awaiting_reminder_response' in session_data:
-        if incoming_msg == '1':
-            msg.body("🔔 **Reminder**: You will receive reminders for your upcoming appointments.")
-            session_data['preferences'] = session_data.get('preferences', set()) | {'2'}
-            session_data.pop('awaiting_reminder_response', None)
-            save_session_data(session_id, session_data)
-            return str(response)
-        elif incoming_msg == '2':
-            msg.body("You will not receive appointment reminders.")
-            session_data['preferences'] = session_data.get('preferences', set()) - {'2'}
-            session_data.pop('awaiting_reminder_response', None)
-            save_session_data(session_id, session_data)
-            return str(response)
-
-    # Handle poll responses
-    if 'awaiting_poll_response' in session_data:
-        # Handle poll options here
-        msg.body("Thank you for participating in the poll!")
-        session_data.pop('awaiting_poll_response', None)
-        save_session_data(session_id, session_data)
-        return str(response)
 
-    if not session_data:
-        # User selects a company
-        if incoming_msg in COMPANY_DETAILS:
-            session_data['company_id'] = COMPANY_DETAILS[incoming_msg]['id']
-            session_data['company_name'] = COMPANY_DETAILS[incoming_msg]['name']
-            msg.body(COMPANY_MENUS[incoming_msg])
-            save_session_data(session_id, session_data)
-        else:
-            msg.body("❗ Invalid option. Please select a valid company number or type 'menu' to see the options again. 🔄")
-        return str(response)
+    logging.info("Incoming message: %s", incoming_msg)
 
-    if 'company_id' in session_data:
-        company_id = session_data['company_id']
-        if incoming_msg == '🔙':
-            msg.body(WELCOME_MENU)
-            session_data.clear()  # Clear session to start fresh
-            save_session_data(session_id, session_data)
-            return str(response)
-
-        if incoming_msg == '0':
-            # Return to company-specific menu
-            company_menu = COMPANY_MENUS.get(next((key for key, value in COMPANY_DETAILS.items() if value['id'] == company_id), None))
-            if company_menu:
-                msg.body(company_menu)
-            else:
-                msg.body("⚠️ Error: Company menu not found. Please select your company again. 🔄")
-            return str(response)
-
-        if incoming_msg in ['1', '2', '3', '4']:
-            response_data = fetch_company_details(company_id, incoming_msg)
-            if response_data and 'error' not in response_data:
-                if incoming_msg == '1':
-                    msg.body(DEFAULT_RESPONSES['1'])
-                elif incoming_msg == '2':
-                    msg.body(DEFAULT_RESPONSES['2'])
-                elif incoming_msg == '3':
-                    msg.body(DEFAULT_RESPONSES['3'])
-                elif incoming_msg == '4':
-                    msg.body(DEFAULT_RESPONSES['4'])
-            else:
-                msg.body("⚠️ Error fetching details. Please try again later. 🔄")
-            return str(response)
-
-    msg.body("❓ Sorry, I didn’t understand that. Type 'Help' for assistance. 🤔")
-    return str(response)
+    return TWIML.reply(reply_for(from_number, incoming_msg))
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -3,16 +3,48 @@ from twilio.twiml.messaging_response import MessagingResponse
 import logging
 import random
 import requests
-from tenacity import retry, stop_after_attempt, wait_fixed
+import booking_client
+import lookup_cache
+import resilience
+import async_reply
+import idempotency
+import metrics
+import structured_logging
+import session_store
+import price_pages
+import cancel_jobs
+import appointment_lists
 
 # Configure logging
-logging.basicConfig(filename='chatbot_den_haag.log', level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+structured_logging.configure('chatbot_den_haag.log', level=logging.DEBUG)
 
 app = Flask(__name__)
+metrics.install(app)
+structured_logging.install(app)
+resilience.install(app)
+
+CONVERSATIONS = session_store.Conversations(namespace='sms')
 
 COMPANY_NAME = 'Ezoncs Beauty Salon Den Haag'
 COMPANY_ID = 10
 
+# Long price lists are split into pages; "more" sends the next one.
+PRICE_LIST = price_pages.PriceList(
+    header=f"{COMPANY_NAME} - Prices 💲:\n",
+    line="{ServiceName} ({ServiceCategory}): {Price}\n",
+    footer="\nPress 0 to go back to the main menu 🔙.",
+    more="\nPage {page}/{pages}. Reply 'more' for the next page, or 0 to go back to the main menu 🔙.",
+)
+
+# Cancellations run in the background (cancel_jobs): the webhook answers with
+# in_progress and the outcome follows as a message of its own.
+CANCEL_MESSAGES = {
+    'in_progress': "⏳ Cancelling appointment {appointment_id}. We'll message you as soon as it's done.\n\nPress 0 to go back to the main menu 🔙.",
+    'done': "Appointment has been successfully cancelled.\n\nPress 0 to go back to the main menu 🔙.",
+    'failed': "Failed to cancel the appointment. Please try again later.\n\nPress 0 to go back to the main menu 🔙.",
+    'error': "Failed to process your request. Please try again later.\n\nPress 0 to go back to the main menu 🔙.",
+}
+
 OPTIONS = {
     '1': "About us 🏠",
     '2': "Prices 💲",
@@ -58,57 +90,61 @@ COMMON_RESPONSES = {
     ]
 }
 
-@retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
 def fetch_details(option_id, date=None, email=None):
     if option_id == '4':
-        url = 'https://test.yourbookingplatform.com/Appointment/GetAppointmentsWRTToDateAndCustomer'
+        path = booking_client.APPOINTMENTS_PATH
         params = {
             'date': date,
             'email': email,
             'company_id': COMPANY_ID
         }
-    else:
-        url = 'https://test.yourbookingplatform.com/Appointment/GetDataOfTBP'
-        params = {
-            'company_id': COMPANY_ID,
-            'option_id': option_id
-        }
+        return appointment_lists.fetch_appointments(COMPANY_ID, date, email, lambda: request_details(path, params))
+
+    path = booking_client.TBP_PATH
+    params = {
+        'company_id': COMPANY_ID,
+        'option_id': option_id
+    }
+    return lookup_cache.tbp_cache.get_or_load((COMPANY_ID, option_id), lambda: request_details(path, params))
 
+def request_details(path, params):
     try:
-        logging.debug(f"Sending GET request to {url} with params: {params}")
-        response = requests.get(url, params=params, proxies={"http": None, "https": None})
+        logging.debug("Sending GET request to %s with params: %s", path, params)
+        response = booking_client.get(path, params=params)
         response.raise_for_status()
         response_json = response.json()
-        logging.debug(f"Received response: {response_json}")
+        logging.debug("Received response: %s", response_json)
         return response_json
     except requests.exceptions.RequestException as e:
-        logging.error(f"Request error occurred: {e}")
+        logging.error("Request error occurred: %s", e)
     return None
 
 @app.route('/sms', methods=['POST'])
+@idempotency.once
+@async_reply.deferred
 def sms_reply():
     incoming_msg = request.form.get('Body', '').strip().lower()
     from_number = request.form.get('From')
     response = MessagingResponse()
     msg = response.message()
 
-    logging.info(f"Incoming message: {incoming_msg} from {from_number}")
+    logging.info("Incoming message: %s from %s", incoming_msg, from_number)
 
-    pending_option = app.config.get('pending_option')
+    pending_option = CONVERSATIONS.pending_option(from_number)
 
     if incoming_msg in COMMON_RESPONSES:
         common_response = random.choice(COMMON_RESPONSES[incoming_msg])
         msg.body(common_response)
-        logging.info(f"Responding with common response: {common_response}")
+        logging.info("Responding with common response: %s", common_response)
     elif incoming_msg == 'menu':
         menu_response = "The menu is ready for you! Choose an option. 📝 1: About us 🏠, 2: Prices 💲, 3: Online booking 📅, 4: Cancel appointment ❌"
         msg.body(menu_response)
-        logging.info(f"Responding with menu response: {menu_response}")
+        logging.info("Responding with menu response: %s", menu_response)
     elif incoming_msg in OPTIONS:
         option_id = incoming_msg
         if option_id == '4':
             msg.body("Please provide the date (YYYY-MM-DD) and email for your appointment.")
-            app.config['pending_option'] = '4'
+            CONVERSATIONS.set_pending_option(from_number, '4')
         else:
             details = fetch_details(option_id)
             if details:
@@ -119,25 +155,28 @@ def sms_reply():
                     elif option_id == '2':
                         prices = details.get('prices', [])
                         if prices:
-                            prices_response = f"{COMPANY_NAME} - Prices 💲:\n"
-                            for price in prices:
-                                prices_response += f"{price['ServiceName']} ({price['ServiceCategory']}): {price['Price']}\n"
+                            prices_response = PRICE_LIST.reply(CONVERSATIONS, from_number, COMPANY_ID, prices)
                         else:
-                            prices_response = f"{COMPANY_NAME} - Prices 💲: Price details are currently unavailable. Please try again later."
-                        prices_response += "\nPress 0 to go back to the main menu 🔙."
+                            prices_response = f"{COMPANY_NAME} - Prices 💲: Price details are currently unavailable. Please try again later.\nPress 0 to go back to the main menu 🔙."
                         msg.body(prices_response)
                     elif option_id == '3':
                         booking_response = f"{COMPANY_NAME} - Online booking 📅: {details.get('booking_link', 'Online booking details are currently unavailable. Please try again later.')}\n\nPress 0 to go back to the main menu 🔙."
                         msg.body(booking_response)
-                    logging.info(f"Responding with details: {msg.body}")
+                    logging.info("Responding with details: %s", msg.body)
                 else:
                     error_response = f"{COMPANY_NAME} - Details are currently unavailable. Please try again later.\n\nPress 0 to go back to the main menu 🔙."
                     msg.body(error_response)
-                    logging.info(f"Responding with error details: {error_response}")
+                    logging.info("Responding with error details: %s", error_response)
             else:
                 error_response = f"{COMPANY_NAME} - Details are currently unavailable. Please try again later.\n\nPress 0 to go back to the main menu 🔙."
                 msg.body(error_response)
-                logging.info(f"Responding with error details: {error_response}")
+                logging.info("Responding with error details: %s", error_response)
+    elif pending_option == 'more_prices' and incoming_msg == 'more':
+        details = fetch_details('2')
+        if details and details.get('success') and details.get('prices'):
+            msg.body(PRICE_LIST.reply(CONVERSATIONS, from_number, COMPANY_ID, details['prices'], more=True))
+        else:
+            msg.body(f"{COMPANY_NAME} - Details are currently unavailable. Please try again later.\n\nPress 0 to go back to the main menu 🔙.")
     elif pending_option == '4':
         if ' ' in incoming_msg:
             date, email = incoming_msg.split(' ', 1)
@@ -150,45 +189,36 @@ def sms_reply():
                         appointments_response += f"ID: {appt['AppointmentID']}, Time: {appt['Time']}\n"
                     appointments_response += "\nPlease provide the AppointmentID you want to cancel."
                     msg.body(appointments_response)
-                    app.config['pending_option'] = 'cancel_appointment'
+                    appointment_lists.set_cancel_appointment(CONVERSATIONS, from_number, date, email)
                 else:
                     msg.body("No appointments found. Please try again with a different date or email.\n\nPress 0 to go back to the main menu 🔙.")
-                    app.config['pending_option'] = None
+                    CONVERSATIONS.set_pending_option(from_number, None)
             else:
                 msg.body("Failed to fetch appointments. Please try again later.\n\nPress 0 to go back to the main menu 🔙.")
-                app.config['pending_option'] = None
+                CONVERSATIONS.set_pending_option(from_number, None)
         else:
             msg.body("Invalid format. Please provide the date and email in the format 'YYYY-MM-DD email'.")
     elif pending_option == 'cancel_appointment':
         try:
             appointment_id = int(incoming_msg)
-            url = 'https://test.yourbookingplatform.com/Appointment/CancelAppointment'
-            params = {'AppointmentID': appointment_id}
-            try:
-                response = requests.get(url, params=params, proxies={"http": None, "https": None})
-                response.raise_for_status()
-                response_json = response.json()
-                if response_json.get('success'):
-                    cancel_response = "Appointment has been successfully cancelled."
-                    msg.body(cancel_response + "\n\nPress 0 to go back to the main menu 🔙.")
-                    logging.info(f"Responding with cancellation success: {cancel_response}")
-                else:
-                    msg.body("Failed to cancel the appointment. Please try again later.\n\nPress 0 to go back to the main menu 🔙.")
-                    logging.error(f"Cancellation failed: {response_json}")
-            except requests.exceptions.RequestException as req_err:
-                logging.error(f"Request error occurred: {req_err}")
-                msg.body("Failed to process your request. Please try again later.\n\nPress 0 to go back to the main menu 🔙.")
+            key = appointment_lists.chosen_key(CONVERSATIONS, from_number, COMPANY_ID)
+            appointment_ids = appointment_lists.listed_appointment_ids(key, fetch_details)
+            if appointment_ids is not None and str(appointment_id) not in appointment_ids:
+                # Caught here instead of by the platform, after a round trip.
+                msg.body("Invalid AppointmentID. Please provide one of the IDs listed above.")
+            else:
+                msg.body(cancel_jobs.submit(appointment_id, from_number, CANCEL_MESSAGES, method='GET', cache_key=key))
         except ValueError:
             msg.body("Invalid AppointmentID. Please provide a valid number.")
     elif incoming_msg == '0':
         main_menu_response = "Returning to main menu. Choose an option. 📝 1: About us 🏠, 2: Prices 💲, 3: Online booking 📅, 4: Cancel appointment ❌"
         msg.body(main_menu_response)
-        logging.info(f"{main_menu_response}")
-        app.config['pending_option'] = None
+        logging.info("%s", main_menu_response)
+        CONVERSATIONS.set_pending_option(from_number, None)
     else:
         invalid_selection_response = "Invalid selection, please try again or type 'menu' to see the options."
         msg.body(invalid_selection_response)
-        logging.info(f"{invalid_selection_response}")
+        logging.info("%s", invalid_selection_response)
         
     return str(response)
 
@@ -0,0 +1,34 @@
+import importlib
+import os
+
+import cancel_jobs
+import readiness
+import warmup
+
+# Production entry point. BOT_APP names the bot module to serve (whatsapp,
+# main, app, final, working, update_bot or all.multitenant); gunicorn.conf.py
+# loads `application` from here:
+#
+#   BOT_APP=whatsapp gunicorn
+#
+# Importing the bot builds its menus, prerendered TwiML and response tables,
+# which with preload_app happens once in the gunicorn master and is shared by
+# every forked worker. Caches are per process, so each worker warms its own
+# after it starts and only then reports ready.
+BOT_APP = os.environ.get('BOT_APP', 'whatsapp')
+
+bot = importlib.import_module(BOT_APP)
+application = bot.app
+readiness.install(application)
+
+caches_warm = readiness.register('caches_warm', readiness.Flag())
+
+
+def start_warm_up():
+    warmup.start(warmup.cache_lookups(bot), on_ready=caches_warm.set)
+
+
+def start_cancel_jobs():
+    # Also picks up cancellations a previous worker left queued or running.
+    if hasattr(bot, 'CANCEL_MESSAGES'):
+        cancel_jobs.start()